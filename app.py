@@ -1,8 +1,6 @@
 import os
 import pydeck as pdk
 import pandas as pd
-import json
-import bisect
 import streamlit as st
 import requests
 import time
@@ -15,10 +13,14 @@ import hmac
 import streamlit.components.v1 as components
 from streamlit_js_eval import streamlit_js_eval
 from openai import OpenAI
-from storage import load_data, save_data, add_run_km, check_pro_completion, add_run_km_pro
-from storage import recompute_profile, delete_runs_by_date, load_invites, save_invites, ensure_access_state, FileLock
-from storage import generate_reward_narrative
+from storage import add_run_km, check_pro_completion, add_run_km_pro, UserDataSession, StorageConflictError
+from importer import import_files, SUPPORTED_EXTENSIONS
+from route_assets import RouteRegistry
+from exporter import export_bytes, parquet_available, FORMATS as EXPORT_FORMATS, MIME_TYPES as EXPORT_MIME_TYPES
+from storage import recompute_profile, delete_runs_by_date, undo_run_km, clear_route_history, ensure_access_state, FileLock, lock_wait_stats, invite_store, seed_invites
+from storage import generate_reward_narrative, route_km, route_last_date, route_history, pro_route_ids
 from datetime import date, timedelta, datetime
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 
 if "USER_ID" not in st.session_state:
     st.session_state["USER_ID"] = None
@@ -167,29 +169,50 @@ USER_ID = st.session_state["USER_ID"]
 
 DATA_PATH = os.path.join(RW_STORAGE_DIR, f"run_data_{USER_ID}.json")
 
+# 本次 rerun 的用户数据：只读一次，所有区块共享同一个实例，结束时（或 rerun/stop 前）最多写一次
+RW = UserDataSession(DATA_PATH)
+
+def flush_user_data(durable: bool = False):
+    """durable=True：写后台队列模式下也等到真正落盘（邀请码激活、领奖等关键路径）"""
+    try:
+        RW.flush(durable=durable)
+    except StorageConflictError:
+        # 同一用户在另一个标签页已写入：不覆盖对方，提示刷新
+        st.warning("⚠️ 你的数据已在另一个页面更新，本次修改未保存。请刷新页面后重试。")
+        st.stop()
+
+def flush_and_rerun():
+    flush_user_data()
+    st.rerun()
+
+def flush_and_stop():
+    flush_user_data()
+    st.stop()
+
 INVITES_PATH = os.path.join(RW_STORAGE_DIR, "invites.json")
 INVITES_LOCK_PATH = INVITES_PATH + ".lock"
 
 # --- Seed invites on first deploy (if /tmp invites empty) ---
 SEED_PATH = os.path.join("data", "invites_seed.json")
 
-def _seed_invites_if_needed():
+# 按邀请码存储（sqlite 表 / R2 每码一个对象 / 本地每码一个文件），带状态计数
+INVITES = invite_store(INVITES_PATH)
+
+@st.cache_resource(show_spinner=False)
+def _seed_invites_once() -> bool:
     """
-    Seed invites for both local and R2 backends.
-    - If current invites is empty/missing -> write seed into the active backend (R2 or local).
-    - Uses a file lock to avoid concurrent seeding.
+    Seed invites for every backend, once per process (st.cache_resource keeps the result).
+    storage.seed_invites imports the legacy invites.json and adds the seed codes to an
+    empty store, under the invites lock (other processes / first sessions).
+    Only a successful run is cached: an exception propagates, so the next rerun retries.
     """
-    try:
-        with FileLock(INVITES_LOCK_PATH):
-            cur = load_invites(INVITES_PATH)  # <-- IMPORTANT: uses backend-aware loader
-            if isinstance(cur, dict) and len(cur) > 0:
-                return
-
-            with open(SEED_PATH, "r", encoding="utf-8") as f:
-                seed = json.load(f)
+    seed_invites(INVITES_PATH, SEED_PATH, INVITES_LOCK_PATH, INVITES)
+    return True
 
-            if isinstance(seed, dict) and len(seed) > 0:
-                save_invites(INVITES_PATH, seed)  # <-- IMPORTANT: writes to R2 when backend=r2
+def _seed_invites_if_needed():
+    # 每次 rerun 只是一次缓存命中；成功之后不再拿锁、不再读存储
+    try:
+        _seed_invites_once()
     except Exception:
         # fail-safe: don't block app startup
         pass
@@ -205,6 +228,21 @@ PASS_DURATION_DAYS = 365
 PRO_CHALLENGE_DAYS = 30
 MAX_DAILY_KM = 42.2
 ADMIN_TOKEN_ENV = "RW_ADMIN_TOKEN"
+ADMIN_PAGE_SIZE = 50
+ADMIN_EXPORT_LIMIT = 500
+
+# 导入时按用户所在时区的日历日归档（profile.timezone；默认 RW_DEFAULT_TZ）
+DEFAULT_TZ = os.getenv("RW_DEFAULT_TZ", "Asia/Shanghai")
+IMPORT_TIMEZONES = ("Asia/Shanghai", "Asia/Hong_Kong", "Asia/Singapore", "Asia/Tokyo", "Europe/London", "Europe/Berlin", "America/New_York", "America/Los_Angeles", "Australia/Sydney", "UTC")
+
+def user_tzinfo(name: str):
+    """
+    IANA 时区 -> tzinfo；找不到（系统缺 tzdata）时返回 None（= 服务器本地时区）。
+    """
+    try:
+        return ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError):
+        return None
 
 def _parse_yyyy_mm_dd_safe(s: str):
     try:
@@ -234,39 +272,27 @@ def pro_input_allowed(profile: dict) -> tuple[bool, str]:
         return False, f"⏳ 本月 Pro 挑战期为 {PRO_CHALLENGE_DAYS} 天，已于 {deadline.isoformat()} 起禁止继续输入。"
     return True, ""
 
+@st.cache_resource(show_spinner=False)
+def get_route_registry(routes_dir: str = ROUTES_DIR) -> RouteRegistry:
+    # 进程级共享：meta / 节点几何 / 总里程 / 城市站点只加载一次，按文件 mtime 失效
+    return RouteRegistry(routes_dir)
+
 def load_all_routes(routes_dir: str = ROUTES_DIR) -> dict:
-    routes = {}
-    for rid in os.listdir(routes_dir):
-        meta_path = os.path.join(routes_dir, rid, "meta.json")
-        if os.path.isfile(meta_path):
-            with open(meta_path, "r", encoding="utf-8") as f:
-                meta = json.load(f)
-            routes[rid] = meta
-    return routes
+    # {rid: meta}，只读（所有会话共享同一份）
+    return get_route_registry(routes_dir).metas()
 
 # ---------- 工具函数 ----------
-def get_route_nodes_path(route_id: str, meta: dict) -> str:
-    # 先用 meta 里的 spacing，如果没有就默认 0.5
-    spacing = meta.get("node_spacing_km", 0.5)
-    # 生成器输出的命名风格是 nodes_0p5km.json
-    spacing_str = str(spacing).replace(".", "p")
-    return os.path.join("routes", route_id, f"nodes_{spacing_str}km.json")
+def route_total_km(rid: str) -> float:
+    # 总里程：routes/index.json 目录里预计算的值；目录缺失/过期时才读节点几何（缺文件 / 坏文件 -> 0）
+    return get_route_registry().total_km(rid)
 
 
 def build_route_summary(rid: str, meta: dict, rw_data: dict) -> dict:
     # 1) 总里程
-    nodes_path = get_route_nodes_path(rid, meta)
-    try:
-        _, _, _, total_km = load_nodes(nodes_path)
-    except Exception:
-        total_km = 0.0
+    total_km = route_total_km(rid)
 
-    # 2) 当前累计：直接从 history 汇总（最稳，不依赖 route_progress 是否已回算）
-    km_done = sum(
-        float(h.get("km", 0.0))
-        for h in rw_data.get("history", [])
-        if h.get("route_id") == rid
-    )
+    # 2) 当前累计：profile.agg（写入时增量维护，不再逐条扫描 history）
+    km_done = route_km(rw_data, rid)
 
     # 3) 百分比 + 状态
     pct = (km_done / total_km) if total_km > 0 else 0.0
@@ -278,11 +304,7 @@ def build_route_summary(rid: str, meta: dict, rw_data: dict) -> dict:
         status = "进行中"
 
     # 4) 最近一次跑步日期（按 route_id 过滤）
-    last_date = None
-    for h in reversed(rw_data.get("history", [])):
-        if h.get("route_id") == rid:
-            last_date = h.get("date")
-            break
+    last_date = route_last_date(rw_data, rid)
 
     # 5) 标题/副标题
     title = meta.get("name", rid)
@@ -300,34 +322,6 @@ def build_route_summary(rid: str, meta: dict, rw_data: dict) -> dict:
         "last_date": last_date,
     }
 
-def load_route(path: str):
-    with open(path, "r", encoding="utf-8") as f:
-        data = json.load(f)
-    points = data["points"]
-    dists = [p["dist_km"] for p in points]
-    total_km = dists[-1]
-    return data, points, dists, total_km
-
-def load_nodes(path: str):
-    with open(path, "r", encoding="utf-8") as f:
-        data = json.load(f)
-    nodes = data["nodes"]
-
-    # 兼容 dist_km / cum_km 两种命名
-    key = "dist_km" if ("dist_km" in nodes[0]) else "cum_km"
-    dists = [float(n[key]) for n in nodes]
-
-    total_km = float(data.get("total_km", dists[-1]))
-    step_km = float(data.get("step_km", data.get("spacing_km", 0.5)))
-    data["step_km"] = step_km  # 统一给后面用
-
-    # 统一把距离字段也塞回 dist_km（后续代码不用改太多）
-    if key != "dist_km":
-        for n, d in zip(nodes, dists):
-            n["dist_km"] = d
-
-    return data, nodes, dists, total_km
-
 def _norm_city_item(x):
     """key_cities 允许是 ['滁州', ...] 或 [{'name':'滁州','km':123}, ...]"""
     if isinstance(x, str):
@@ -379,9 +373,10 @@ def _infer_city_km_from_nodes(city_name: str, nodes_data: list):
 
     return None
 
-def build_city_stops(meta: dict, nodes_data: list, total_km: float):
+def build_city_stops(meta: dict, nodes_data: list, total_km: float, city_km: list = None):
     """
     输出 stops: [{'name':..., 'km':...}, ...] 且 km 单调递增。
+    city_km: 与 key_cities 对齐的里程（routes/index.json 里按坐标吸附到路线上预计算）
     """
     raw = meta.get("key_cities", []) or []
     items = [_norm_city_item(x) for x in raw]
@@ -396,6 +391,8 @@ def build_city_stops(meta: dict, nodes_data: list, total_km: float):
         # 优先用 meta 里直接给的 km（未来你想做得最稳就用这个）
         if isinstance(it.get("km"), (int, float)):
             km = float(it["km"])
+        elif city_km and idx < len(city_km) and isinstance(city_km[idx], (int, float)):
+            km = float(city_km[idx])
         else:
             km = _infer_city_km_from_nodes(name, nodes_data)
 
@@ -706,15 +703,6 @@ def render_clickable_cities(stops: list, km_done: float, meta: dict, route_id: s
         with st.expander(title, expanded=False):
             st.write("点击上方「✨ 生成内容」后，这里会出现文本。")
 
-def locate_by_distance(points, dists, current_km: float):
-    total_km = dists[-1]
-    current_km = max(0.0, min(float(current_km), total_km))
-    idx = bisect.bisect_right(dists, current_km) - 1
-    idx = max(0, min(idx, len(points) - 1))
-    p = points[idx]
-    progress = current_km / total_km if total_km > 0 else 0.0
-    return p, progress, current_km, total_km
-
 def haversine_km(lat1, lon1, lat2, lon2) -> float:
     R = 6371.0088
     phi1, phi2 = math.radians(lat1), math.radians(lat2)
@@ -879,7 +867,7 @@ st.set_page_config(page_title="Running World", layout="wide")
 routes = load_all_routes()
 if not routes:
     st.error("未找到 routes/*/meta.json")
-    st.stop()
+    flush_and_stop()
 
 # view state
 if "view" not in st.session_state:
@@ -890,10 +878,8 @@ if st.session_state.view == "picker":
     st.title("🌍 Running World")
     st.write("选择一条路线进入：")
 
-    # 读取一次数据（用于进度/历史）
-    rw_data = load_data(DATA_PATH)
-    ensure_access_state(rw_data)
-    save_data(DATA_PATH, rw_data)
+    # 读取一次数据（用于进度/历史）；load_data 已做 ensure_access_state，仅在有变化时写回
+    rw_data = RW.data
 
     rw_data.setdefault("profile", {})
     rw_data["profile"].setdefault("route_progress", {})
@@ -908,13 +894,16 @@ if st.session_state.view == "picker":
         return date.today()
 
     # --- Activate pass UI ---
-        # --- Activate pass UI (invites.json based) ---
+        # --- Activate pass UI (per-code invite store) ---
     with st.expander("🔑 激活探索季票（邀请码）", expanded=False):
         code = st.text_input("输入邀请码", value="", placeholder="例如：RW-ALPHA-001")
 
-        # 小提示：展示库存情况（可选，但很实用）
-        invites = load_invites(INVITES_PATH)
-        remaining = sum(1 for v in invites.values() if isinstance(v, dict) and v.get("status") == "new")
+        # 小提示：展示库存情况（可选，但很实用）；共享锁：不会读到兑换写了一半的状态，也不互相阻塞
+        try:
+            with FileLock(INVITES_LOCK_PATH, timeout_s=2.0, shared=True):
+                remaining = INVITES.remaining()
+        except TimeoutError:
+            remaining = INVITES.remaining()
         st.caption(f"当前可用邀请码余量：{remaining}（仅你本地统计）")
 
         if st.button("激活", key="activate_pass"):
@@ -923,23 +912,18 @@ if st.session_state.view == "picker":
                 st.error("邀请码不能为空。")
             else:
                 try:
-                    with FileLock(INVITES_LOCK_PATH, timeout_s=8.0):
-                        # ⚠️ 进入锁后再 load 一次：确保读到的是“最新状态”
-                        invites = load_invites(INVITES_PATH)
-                        rec = invites.get(code)
+                    with FileLock(INVITES_LOCK_PATH, timeout_s=8.0, shared=False):
+                        # ⚠️ 只读写这一个码（读最新状态 -> new 才改成 used），与邀请码总数无关
+                        result, rec = INVITES.redeem(code, date.today().isoformat())
 
-                        if not isinstance(rec, dict):
+                        if result == "missing":
                             st.error("邀请码不存在。")
-                        elif rec.get("status") == "revoked":
+                        elif result == "revoked":
                             st.error("邀请码已作废。")
-                        elif rec.get("status") == "used":
+                        elif result == "used":
                             st.error("邀请码已被使用。")
                         else:
-                            # ✅ 邀请码有效：先写 invites.used（在锁里）
-                            rec["status"] = "used"
-                            rec["activated_at"] = date.today().isoformat()
-                            invites[code] = rec
-                            save_invites(INVITES_PATH, invites)
+                            # ✅ 邀请码有效：invites 已写为 used（在锁里）
 
                             # ✅ 再写用户数据（DATA_PATH 是按 USER_ID 分文件的，不需要全局锁）
                             prof["auth"]["mode"] = "invite"
@@ -956,10 +940,12 @@ if st.session_state.view == "picker":
                                 "notes": "alpha"
                             }
                             ensure_access_state(rw_data)
-                            save_data(DATA_PATH, rw_data)
+                            RW.mark_dirty()
+                            # 邀请码已写为 used：用户季票立刻落盘，不等到本次 rerun 结束
+                            flush_user_data(durable=True)
 
                             st.success("✅ 已激活：探索季票已生效（全路线解锁）")
-                            st.rerun()
+                            flush_and_rerun()
 
                 except TimeoutError:
                     st.warning("系统繁忙（多人同时激活中），请稍后再试一次。")
@@ -971,17 +957,13 @@ if st.session_state.view == "picker":
     # --- Phase 4.5.2: Pro 用户默认进入 Dashboard ---
     if has_all_routes:
         st.session_state.view = "pro_dashboard"
-        st.rerun()
+        flush_and_rerun()
 
     for rid in routes.keys():
-        s = sum(float(h.get("km", 0.0)) for h in rw_data.get("history", []) if h.get("route_id") == rid)
-        rw_data["profile"]["route_progress"][rid] = round(s, 3)
-
-    save_data(DATA_PATH, rw_data)
+        rw_data["profile"]["route_progress"][rid] = round(route_km(rw_data, rid), 3)
 
     if not rw_data["profile"]["route_progress"]:
         recompute_profile(rw_data)
-        save_data(DATA_PATH, rw_data)
 
     # 生成每条路线的摘要
     summaries = []
@@ -1028,7 +1010,7 @@ if st.session_state.view == "picker":
                     if st.button("进入", key=f"enter_{s['rid']}"):
                         st.session_state.active_route_id = s["rid"]
                         st.session_state.view = "main"
-                        st.rerun()
+                        flush_and_rerun()
         # --- Admin panel (hidden) ---
     with st.expander("🔧 Admin（邀请码管理）", expanded=False):
         admin_token = os.getenv(ADMIN_TOKEN_ENV, "")
@@ -1041,23 +1023,26 @@ if st.session_state.view == "picker":
             else:
                 st.success("已进入 Admin 模式")
 
-                invites = load_invites(INVITES_PATH)
-
-                def _cnt(status: str) -> int:
-                    return sum(
-                        1 for v in invites.values()
-                        if isinstance(v, dict) and v.get("status") == status
-                    )
+                try:
+                    with FileLock(INVITES_LOCK_PATH, timeout_s=2.0, shared=True):
+                        counts = INVITES.counts()
+                except TimeoutError:
+                    counts = INVITES.counts()
 
-                c_new, c_used, c_rev = _cnt("new"), _cnt("used"), _cnt("revoked")
+                c_new, c_used, c_rev = counts.get("new", 0), counts.get("used", 0), counts.get("revoked", 0)
                 st.write(f"📊 统计：new={c_new} ｜ used={c_used} ｜ revoked={c_rev}")
 
-                # Export list
-                new_codes = sorted([
-                    code for code, rec in invites.items()
-                    if isinstance(rec, dict) and rec.get("status") == "new"
-                ])
-                st.text_area("可用邀请码（复制发放）", value="\n".join(new_codes), height=150)
+                # 邀请码锁等待（本进程启动以来）
+                for mode, ls in sorted(lock_wait_stats().items()):
+                    avg_ms = 1000.0 * ls["wait_s"] / max(1, ls["acquired"] + ls["timeouts"])
+                    st.caption(
+                        f"🔒 {mode}: 获取 {int(ls['acquired'])} 次｜等待 {int(ls['contended'])} 次｜超时 {int(ls['timeouts'])} 次｜"
+                        f"平均 {avg_ms:.1f} ms｜最长 {1000.0 * ls['max_wait_s']:.1f} ms"
+                    )
+
+                # Export list（只取前 ADMIN_EXPORT_LIMIT 个，码多时不把全部拉下来）
+                new_codes = [code for code, _ in INVITES.page(status="new", limit=ADMIN_EXPORT_LIMIT)]
+                st.text_area(f"可用邀请码（复制发放，前 {ADMIN_EXPORT_LIMIT} 个）", value="\n".join(new_codes), height=150)
 
                 # Revoke tool
                 col1, col2 = st.columns([3, 1])
@@ -1071,25 +1056,37 @@ if st.session_state.view == "picker":
                         else:
                             try:
                                 with FileLock(INVITES_LOCK_PATH, timeout_s=8.0):
-                                    invites = load_invites(INVITES_PATH)
-                                    rec = invites.get(rc)
-                                    if not isinstance(rec, dict):
+                                    if INVITES.set_status(rc, "revoked") is None:
                                         st.error("该邀请码不存在。")
                                     else:
-                                        rec["status"] = "revoked"
-                                        invites[rc] = rec
-                                        save_invites(INVITES_PATH, invites)
                                         st.success(f"✅ 已作废：{rc}")
-                                        st.rerun()
+                                        flush_and_rerun()
                             except TimeoutError:
                                     st.warning("系统繁忙（多人同时操作邀请码），请稍后再试。")
 
 
-                # Table view (lightweight, no pandas needed)
+                # Table view (lightweight, no pandas needed)：按码分页，游标存在 session_state
+                pc1, pc2, pc3 = st.columns([2, 1, 1])
+                with pc1:
+                    status_filter = st.selectbox("状态", ["全部", "new", "used", "revoked"], key="admin_inv_status")
+                cursors = st.session_state.setdefault("admin_inv_cursors", {})
+                stack = cursors.setdefault(status_filter, [None])  # 每页起点（上一页最后一个码）
+                page = INVITES.page(
+                    status=None if status_filter == "全部" else status_filter,
+                    after=stack[-1],
+                    limit=ADMIN_PAGE_SIZE,
+                )
+                with pc2:
+                    if st.button("上一页", key="admin_inv_prev", disabled=len(stack) <= 1):
+                        stack.pop()
+                        flush_and_rerun()
+                with pc3:
+                    if st.button("下一页", key="admin_inv_next", disabled=len(page) < ADMIN_PAGE_SIZE):
+                        stack.append(page[-1][0])
+                        flush_and_rerun()
+
                 rows = []
-                for code, rec in sorted(invites.items()):
-                    if not isinstance(rec, dict):
-                        continue
+                for code, rec in page:
                     rows.append({
                         "code": code,
                         "status": rec.get("status", ""),
@@ -1098,19 +1095,17 @@ if st.session_state.view == "picker":
                         "activated_at": rec.get("activated_at", "")
                     })
 
-                st.write("📋 邀请码列表")
+                st.write(f"📋 邀请码列表（第 {len(stack)} 页）")
                 st.dataframe(rows, use_container_width=True, hide_index=True)
 
 
-    st.stop()
+    flush_and_stop()
 
 if st.session_state.view == "pro_dashboard":
     st.title("🏁 Running World · Pro 控制台（四线同步）")
 
-    # 载入数据
-    rw_data = load_data(DATA_PATH)
-    ensure_access_state(rw_data)
-    save_data(DATA_PATH, rw_data)
+    # 载入数据（load_data 已做 ensure_access_state，仅在有变化时写回）
+    rw_data = RW.data
 
     profile = rw_data.get("profile", {})
     v3 = profile.get("v3", {})
@@ -1134,7 +1129,7 @@ if st.session_state.view == "pro_dashboard":
         v3["pro"] = pro
         profile["v3"] = v3
         rw_data["profile"] = profile
-        save_data(DATA_PATH, rw_data)
+        RW.mark_dirty()
 
     # 顶部导航
     colX, colY = st.columns([3, 1])
@@ -1143,7 +1138,7 @@ if st.session_state.view == "pro_dashboard":
     with colY:
         if st.button("🔙 返回路线选择"):
             st.session_state.view = "picker"
-            st.rerun()
+            flush_and_rerun()
 
     st.divider()
 
@@ -1159,7 +1154,7 @@ if st.session_state.view == "pro_dashboard":
     with c1:
         go = st.button("✅ 同步提交", use_container_width=True, disabled=lock_pro)
     with c2:
-        st.caption("提示：提交后会写入每条路线的 history（同日同路线自动合并）。")
+        st.caption("提示：提交后会写入一条同步记录，计入每条 Pro 路线（同日自动合并）。")
 
     if lock_pro:
         st.info("🏁 Pro 挑战已结束：同步推进已锁定。")
@@ -1167,15 +1162,13 @@ if st.session_state.view == "pro_dashboard":
     if go and add_km > 0:
         if add_km > MAX_DAILY_KM + 1e-9:
             st.error(f"单日输入上限为 {MAX_DAILY_KM} km。")
-            st.stop()
+            flush_and_stop()
 
         add_run_km_pro(rw_data, km=float(add_km), mode="merge")
-
-        # 保存
-        save_data(DATA_PATH, rw_data)
+        RW.mark_dirty()
 
         st.success("已同步推进四条 Pro 路线。")
-        st.rerun()
+        flush_and_rerun()
 
     st.divider()
         # --- Phase 4.5.3: 完成检测（为奖励 pending 做准备）---
@@ -1208,22 +1201,11 @@ if st.session_state.view == "pro_dashboard":
         if rid not in routes:
             continue
 
-        # 当前累计（以 history 为准）
-        route_sum = 0.0
-        for h in rw_data.get("history", []):
-            if h.get("route_id") == rid:
-                try:
-                    route_sum += float(h.get("km", 0.0))
-                except Exception:
-                    pass
+        # 当前累计（profile.agg）
+        route_sum = route_km(rw_data, rid)
 
-        # 总里程：用 nodes 自动推断（与你主页面一致）
-        try:
-            nodes_path = get_route_nodes_path(rid, routes[rid])
-            _, _, _, total_km = load_nodes(nodes_path)
-            total_km = float(total_km)
-        except Exception:
-            total_km = 0.0
+        # 总里程：用 nodes 自动推断（与你主页面一致，registry 缓存）
+        total_km = float(route_total_km(rid))
 
         # 读取/修复 pro_routes[rid]
         rec = pro_routes.get(rid)
@@ -1258,27 +1240,23 @@ if st.session_state.view == "pro_dashboard":
             pro["finished_route_id"] = trigger_rid
             pro["reward_choice_at"] = today_iso
 
-    # 写回并持久化
+    # 写回（同一实例，reward_state 即为最新；有变化时在本次 rerun 结束前落盘）
     pro["routes"] = pro_routes
     v3["pro"] = pro
     profile["v3"] = v3
     rw_data["profile"] = profile
-    save_data(DATA_PATH, rw_data)
     # --- Phase 4.5.3: pending 时显示领奖入口（放在完成检测之后，确保是最新状态）---
-    rw_data = load_data(DATA_PATH)  # 关键：读回最新 reward_state
-    pro = rw_data.get("profile", {}).get("v3", {}).get("pro", {})
     if str(pro.get("reward_state")) == "pending":
         frid = pro.get("finished_route_id")
         st.info("🎁 有一条 Pro 路线已完成，奖励选择已解锁。")
         if frid and st.button("前往领奖 / 做出选择", use_container_width=True):
             st.session_state.active_route_id = frid
             st.session_state.view = "main"
-            st.rerun()
+            flush_and_rerun()
 
     # 渲染四条路线卡片（用你已有的 build_route_summary）
     st.subheader("📊 四线进度总览")
 
-    rw_data = load_data(DATA_PATH)  # 读回一次，确保是最新
     summaries = []
     for rid in PRO_ROUTE_IDS:
         if rid in routes:
@@ -1312,22 +1290,24 @@ if st.session_state.view == "pro_dashboard":
                 if st.button("进入路线详情", key=f"pro_enter_{s['rid']}"):
                     st.session_state.active_route_id = s["rid"]
                     st.session_state.view = "main"
-                    st.rerun()
+                    flush_and_rerun()
 
-    st.stop()
+    flush_and_stop()
 
 route_id = st.session_state.active_route_id
 meta = routes[route_id]
 
 # ✅ 用 meta.node_spacing_km 自动选择正确的 nodes 文件（避免总里程首次为 0 / 读错文件）
-nodes_path = get_route_nodes_path(route_id, meta)
-data, points, dists, total_km = load_nodes(nodes_path)
+# registry 里已经映射好的几何，所有会话共享
+route_entry = get_route_registry().entry(route_id)
+route_geo = route_entry.geometry
+points, dists, total_km = route_geo.points, route_geo.cum_km, route_geo.total_km
 
 st.title(f"🏃‍♂️ Running World · {meta.get('name', route_id)}")
 # =========================
 # Phase 4.6: Pro 奖励选择闸门（接受/拒绝）
 # =========================
-rw_data_gate = load_data(DATA_PATH)
+rw_data_gate = RW.data
 profile_gate = rw_data_gate.get("profile", {})
 ent_gate = profile_gate.get("entitlements", {})
 v3_gate = profile_gate.get("v3", {})
@@ -1355,9 +1335,10 @@ if is_pro_user and reward_state == "pending" and finished_rid == route_id:
         v3_gate["pro"] = pro_gate
         profile_gate["v3"] = v3_gate
         rw_data_gate["profile"] = profile_gate
-        save_data(DATA_PATH, rw_data_gate)
+        RW.mark_dirty()
+        flush_user_data(durable=True)
         st.success("已领取奖励：本次 Pro 挑战已结束。")
-        st.rerun()
+        flush_and_rerun()
 
     if decline_reward:
         pro_gate["reward_state"] = "declined"
@@ -1367,31 +1348,29 @@ if is_pro_user and reward_state == "pending" and finished_rid == route_id:
         v3_gate["pro"] = pro_gate
         profile_gate["v3"] = v3_gate
         rw_data_gate["profile"] = profile_gate
-        save_data(DATA_PATH, rw_data_gate)
+        RW.mark_dirty()
+        flush_user_data(durable=True)
         st.info("你选择继续挑战：奖励已暂时搁置，完成下一条路线后将再次触发。")
-        st.rerun()
+        flush_and_rerun()
 
 # accepted 后：可选择在单路线页面也提示“已封盘”
 if is_pro_user and reward_state == "accepted":
     st.info("🏁 Pro 挑战已结束（已接受奖励）。如需继续推进，请在后续版本开启新赛季或重置。")
 
 # Pro 用户：提供返回 Dashboard
-rw_data_tmp = load_data(DATA_PATH)
+rw_data_tmp = RW.data
 ent_tmp = rw_data_tmp.get("profile", {}).get("entitlements", {})
 if bool(ent_tmp.get("all_routes", False)):
     if st.button("⬅️ 返回 Pro 控制台"):
         st.session_state.view = "pro_dashboard"
-        st.rerun()
+        flush_and_rerun()
 
 KEY_CITIES = meta.get("key_cities", [])
 
 NEAR_CITY_KM = 25.0  # “接近城市”阈值（可调 10~30）
 
-# ====== JSON 持久化：加载数据 ======
-if "rw_data" not in st.session_state:
-    st.session_state.rw_data = load_data(DATA_PATH)
-
-rw_data = st.session_state.rw_data
+# ====== JSON 持久化：加载数据（本次 rerun 共享的实例）======
+rw_data = RW.data
 profile = rw_data["profile"]
 # ===== Phase 4.3: Pro completion reward UI =====
 v3 = profile.get("v3", {})
@@ -1404,7 +1383,7 @@ if v3.get("mode") == "pro" and pro.get("reward_state") == "pending":
         route_meta = routes.get(rid, {})
         narrative = generate_reward_narrative(route_meta)
         pro["reward_narrative"] = narrative
-        save_data(DATA_PATH, rw_data)
+        RW.mark_dirty()
 
     narr = pro.get("reward_narrative", {}) or {}
 
@@ -1431,17 +1410,19 @@ if v3.get("mode") == "pro" and pro.get("reward_state") == "pending":
         if st.button("🎉 接受奖励（结束本次挑战）", key="reward_accept"):
             pro["reward_state"] = "accepted"
             pro["reward_choice_at"] = date.today().isoformat()
-            save_data(DATA_PATH, rw_data)
+            RW.mark_dirty()
+            flush_user_data(durable=True)
             st.success("奖励已接受，本次 Pro 挑战圆满完成。")
-            st.rerun()
+            flush_and_rerun()
 
     with col2:
         if st.button("🚀 拒绝奖励（继续推进更高难度）", key="reward_decline"):
             pro["reward_state"] = "declined"
             pro["reward_choice_at"] = date.today().isoformat()
-            save_data(DATA_PATH, rw_data)
+            RW.mark_dirty()
+            flush_user_data(durable=True)
             st.info("你选择继续挑战，旅程仍在延伸。")
-            st.rerun()
+            flush_and_rerun()
 
 # ===== per-route session keys =====
 rk_key   = f"route_km__{route_id}"
@@ -1463,7 +1444,7 @@ if last_key not in st.session_state:
 
 # 侧边栏：输入累计跑量
 st.sidebar.header("📏 跑量输入")
-rw_data_lock = load_data(DATA_PATH)
+rw_data_lock = RW.data
 pro_lock = rw_data_lock.get("profile", {}).get("v3", {}).get("pro", {})
 reward_state_lock = str(pro_lock.get("reward_state", "locked"))
 lock_inputs = (reward_state_lock == "accepted")
@@ -1499,7 +1480,7 @@ if lock_inputs:
 if submit and add_km > 0:
     if add_km > MAX_DAILY_KM + 1e-9:
         st.sidebar.error(f"单日输入上限为 {MAX_DAILY_KM} km。")
-        st.stop()
+        flush_and_stop()
 
     # 判断 v3 模式（默认 free）
     v3 = profile.get("v3", {})
@@ -1520,7 +1501,7 @@ if submit and add_km > 0:
 
         # ✅ Phase 4.5+: Pro 同步推进（新逻辑）
         add_run_km_pro(rw_data, km=float(add_km), mode="merge")
-        save_data(DATA_PATH, rw_data)
+        RW.mark_dirty()
 
         # （可选）如果你仍希望在“单路线页输入”时也能立刻触发 pending，
         # 那就在这里做一次轻量完成检测：直接复用你在 pro_dashboard 里写的完成检测器。
@@ -1538,10 +1519,10 @@ if submit and add_km > 0:
         st.session_state[prev_key] = float(st.session_state[rk_key])
         rw_data["profile"]["current_route_id"] = route_id
         add_run_km(rw_data, km=float(add_km), mode="merge")
-        save_data(DATA_PATH, rw_data)
+        RW.mark_dirty()
 
         # recompute this route's progress from history
-        route_sum = sum(float(h.get("km", 0.0)) for h in rw_data.get("history", []) if h.get("route_id") == route_id)
+        route_sum = route_km(rw_data, route_id)
         profile.setdefault("route_progress", {})
         profile["route_progress"][route_id] = round(route_sum, 3)
 
@@ -1549,53 +1530,112 @@ if submit and add_km > 0:
         st.session_state[last_key] = float(add_km)
 
 
-    # 读回（确保 UI 用到的是最新 profile）
-    st.session_state.rw_data = load_data(DATA_PATH)
-    rw_data = st.session_state.rw_data
-    profile = rw_data["profile"]
-
-    st.rerun()
+    flush_and_rerun()
 
 if undo and float(st.session_state[last_key]) > 0:
     today = date.today().isoformat()
     last = float(st.session_state[last_key])
 
-    # 找到今天该路线记录并回退
-    history = rw_data.get("history", [])
-    for i in range(len(history) - 1, -1, -1):
-        item = history[i]
-        if item.get("date") == today and item.get("route_id") == route_id:
-            new_km = float(item.get("km", 0.0)) - last
-            if new_km > 1e-9:
-                item["km"] = round(new_km, 3)
-            else:
-                history.pop(i)
-            break
-
-    rw_data["history"] = history
-
-    # 重算全局 profile（streak/total等）
-    recompute_profile(rw_data)
+    # 找到今天该路线记录并回退（并重算全局 profile：streak/total等）
+    undo_run_km(rw_data, km=last, route_id=route_id, run_date=today)
 
     # 重算本路线 progress
-    route_sum = sum(float(h.get("km", 0.0)) for h in rw_data.get("history", []) if h.get("route_id") == route_id)
+    route_sum = route_km(rw_data, route_id)
     rw_data["profile"].setdefault("route_progress", {})
     rw_data["profile"]["route_progress"][route_id] = round(route_sum, 3)
 
-    save_data(DATA_PATH, rw_data)
-    st.session_state.rw_data = load_data(DATA_PATH)
-    rw_data = st.session_state.rw_data
+    RW.mark_dirty()
     profile = rw_data["profile"]
 
     # 同步 per-route session
     st.session_state[rk_key] = float(profile.get("route_progress", {}).get(route_id, 0.0))
     st.session_state[prev_key] = float(st.session_state[rk_key])
     st.session_state[last_key] = 0.0
-    st.rerun()
+    flush_and_rerun()
 
 # 再显示（这里就会是“更新后的累计”）
 st.sidebar.write(f"当前累计：**{st.session_state[rk_key]:.2f} km**")
 
+# 批量导入：Strava / Garmin 等导出的 CSV / GPX / TCX（按本地日期汇总，已有记录的日期跳过，一次写入）
+with st.sidebar.expander("📥 导入跑步记录（CSV / GPX / TCX）"):
+    uploads = st.file_uploader(
+        "选择导出文件（可多选）",
+        type=[ext.lstrip(".") for ext in SUPPORTED_EXTENSIONS],
+        accept_multiple_files=True,
+        key=f"import_files__{route_id}",
+    )
+    tz_options = list(IMPORT_TIMEZONES)
+    user_tz = str(profile.get("timezone") or DEFAULT_TZ)
+    if user_tz not in tz_options:
+        tz_options.insert(0, user_tz)
+    import_tz = st.selectbox(
+        "所在时区（活动按当地日期归档）",
+        tz_options,
+        index=tz_options.index(user_tz),
+        key=f"import_tz__{route_id}",
+    )
+    if st.button("开始导入", key=f"import_go__{route_id}", disabled=lock_inputs or not uploads):
+        if profile.get("timezone") != import_tz:
+            profile["timezone"] = import_tz
+            RW.mark_dirty()
+        v3_imp = profile.get("v3", {})
+        if isinstance(v3_imp, dict) and str(v3_imp.get("mode", "free")) == "pro":
+            # 与 add_run_km_pro 相同：计入 profile.v3.pro.routes 里的路线（去重也按这组路线判断）
+            import_targets = pro_route_ids(rw_data)
+        else:
+            import_targets = [route_id]
+
+        if not import_targets:
+            st.info("还没有 Pro 路线，无法导入。")
+        else:
+            result = import_files(
+                rw_data,
+                [(f.name, f) for f in uploads],
+                route_ids=import_targets,
+                tz=user_tzinfo(import_tz),
+                max_daily_km=MAX_DAILY_KM,
+            )
+            for msg in result.errors:
+                st.warning(f"⚠️ {msg}")
+            if result.added:
+                RW.mark_dirty()
+                for rid in import_targets:
+                    st.session_state[f"route_km__{rid}"] = float(rw_data["profile"]["route_progress"].get(rid, 0.0))
+                st.session_state[prev_key] = float(st.session_state[rk_key])
+                st.success(
+                    f"✅ 导入 {result.added} 天，共 {result.km:.1f} km"
+                    f"（已有记录跳过 {result.duplicates} 天，超出单日上限 {result.rejected} 天）"
+                )
+                flush_and_rerun()
+            else:
+                st.info(
+                    f"没有新的跑步日可导入（活动 {result.activities} 个，已有记录 {result.duplicates} 天，"
+                    f"超出单日上限 {result.rejected} 天）。"
+                )
+
+# 导出：当前用户的全部跑步记录（CSV / JSONL；装了 pyarrow 时可选 Parquet）
+with st.sidebar.expander("📤 导出跑步记录"):
+    export_formats = [f for f in EXPORT_FORMATS if f != "parquet" or parquet_available()]
+    export_fmt = st.radio("格式", export_formats, horizontal=True, key="export_fmt")
+    # 只有点了「生成导出文件」才序列化整段历史；结果按 (格式, 数据版本) 缓存在 session 里，
+    # 数据变了就作废（普通 rerun 不付出 O(history) 的编码开销）
+    export_ver = (export_fmt, rw_data["meta"].get("updated_at"), len(rw_data.get("history") or []))
+    cached_export = st.session_state.get("export_cache")
+    if cached_export and cached_export[0] != export_ver:
+        cached_export = None
+        st.session_state.pop("export_cache", None)
+    if st.button("生成导出文件", key="export_prepare"):
+        cached_export = (export_ver, export_bytes(rw_data, export_fmt, user_id=USER_ID))
+        st.session_state["export_cache"] = cached_export
+    if cached_export:
+        st.download_button(
+            "下载",
+            data=cached_export[1],
+            file_name=f"running_world_{USER_ID}_{date.today().isoformat()}.{export_fmt}",
+            mime=EXPORT_MIME_TYPES[export_fmt],
+            key="export_download",
+        )
+
 # 可选：给一个“手动校准累计”的入口（只校准当前路线）
 with st.sidebar.expander("高级：手动校准当前路线累计"):
     manual = st.number_input(
@@ -1609,35 +1649,32 @@ with st.sidebar.expander("高级：手动校准当前路线累计"):
         # 1) 校准前记录：用于“今日高亮”
         st.session_state[prev_key] = float(st.session_state[rk_key])
 
-        # 2) 清空当前路线历史（保留其他路线）
-        rw_data["history"] = [h for h in rw_data.get("history", []) if h.get("route_id") != route_id]
+        # 2) 清空当前路线历史（保留其他路线），并重算全局 streak/total 等
+        clear_route_history(rw_data, route_id)
 
         # 3) 写入当前路线的累计
         rw_data["profile"].setdefault("route_progress", {})
         rw_data["profile"]["route_progress"][route_id] = float(manual)
 
-        # 4) 你的全局 streak/total 等，建议重算一次（不想动也行）
-        recompute_profile(rw_data)
-
-        save_data(DATA_PATH, rw_data)
-
-        # 5) 读回刷新 UI
-        st.session_state.rw_data = load_data(DATA_PATH)
-        rw_data = st.session_state.rw_data
+        RW.mark_dirty()
         profile = rw_data["profile"]
 
         st.session_state[rk_key] = float(profile.get("route_progress", {}).get(route_id, 0.0))
         st.session_state[last_key] = 0.0
         st.session_state[prev_key] = float(st.session_state[rk_key])
-        st.rerun()
+        flush_and_rerun()
 
 use_ai = st.sidebar.checkbox("启用 AI 陪跑播报", value=False)
 
-# 定位当前位置
+# 定位当前位置：按累计里程二分 + 线性插值（节点间距不均匀，不能用 km / step_km 取下标）
 current_km = float(st.session_state[rk_key])
-p, progress, km_clamped, total_km = locate_by_distance(points, dists, current_km)
+cur_pos = route_geo.locate(current_km)
+p = {"lon": cur_pos.lon, "lat": cur_pos.lat, "dist_km": cur_pos.km}
+progress, km_clamped, total_km = cur_pos.progress, cur_pos.km, float(dists[-1])
 
-geo = reverse_geocode(p["lat"], p["lon"])
+# 逆地理编码用离当前位置最近的路线顶点（原始精度）：与改版前按节点查询一样，坐标集合有限，缓存能命中
+geo_i = min(cur_pos.seg + (1 if cur_pos.t >= 0.5 else 0), len(route_geo) - 1)
+geo = reverse_geocode(route_geo.lat[geo_i], route_geo.lon[geo_i])
 city = geo.get("city") or "未知地点"
 state = geo.get("state") or "未知地区"
 country = geo.get("country") or ""
@@ -1696,7 +1733,12 @@ st.markdown(f"""
 - **总里程**：{total_km:.1f} km  
 - **进度**：{progress*100:.2f}%  
 """)
-stops = build_city_stops(meta, points, total_km)
+# 城市站点表按路线版本缓存一次（只读，渲染函数不修改）
+def _route_city_stops(e) -> list:
+    city_km = [c.get("km") for c in e.catalog["key_cities"]] if e.catalog else None
+    return build_city_stops(e.meta, e.geometry.points, e.geometry.total_km, city_km=city_km)
+
+stops = route_entry.derived("city_stops", _route_city_stops)
 render_city_metro_line(stops, km_clamped, total_km)
 route_id = st.session_state.active_route_id   # 你项目里当前路线 id
 render_clickable_cities(stops, km_clamped, meta, route_id)
@@ -1720,7 +1762,7 @@ remaining_km = total_km - km_clamped
 if use_ai:
     try:
         narration = generate_narration(
-            route_name=data.get("name", "Nanjing to Beijing"),
+            route_name=meta.get("name", route_id),
             km_done=km_clamped,
             km_total=total_km,
             city=city,
@@ -1739,22 +1781,16 @@ else:
 
 # ---------- Step 6: pydeck 地图（完成段/未完成段 + 节点点阵 + 今日高亮 + 当前点） ----------
 
-STEP_KM = float(data.get("step_km", 0.5))
-
-cur_idx = min(int(km_clamped / STEP_KM), len(points) - 1)
+# 上次位置 -> 当前位置：两段都在同一个插值位置上接上（seg = 所在线段的起点下标）
 prev_km = float(st.session_state[prev_key])
-prev_idx = min(int(float(prev_km) / STEP_KM), len(points) - 1)
+prev_pos = route_geo.locate(min(prev_km, km_clamped))
 
-done_path = [[pt["lon"], pt["lat"]] for pt in points[:cur_idx + 1]]
-todo_path = [[pt["lon"], pt["lat"]] for pt in points[cur_idx:]]
+done_path = route_geo.path_to(cur_pos)
+todo_path = route_geo.path_from(cur_pos)
+today_path = route_geo.path_between(prev_pos, cur_pos)
 
-today_path = (
-    [[pt["lon"], pt["lat"]] for pt in points[max(prev_idx, 0):cur_idx + 1]]
-    if cur_idx > prev_idx else []
-)
-
-done_pts = points[:cur_idx + 1]
-today_pts = points[max(prev_idx + 1, 0):cur_idx + 1] if cur_idx > prev_idx else []
+done_pts = points[:cur_pos.seg + 1]
+today_pts = points[prev_pos.seg + 1:cur_pos.seg + 1]
 
 cur_lon, cur_lat = p["lon"], p["lat"]
 
@@ -1846,8 +1882,7 @@ st.pydeck_chart(deck, use_container_width=True)
 
 st.subheader("📚 跑步记录")
 
-history_all = rw_data.get("history", [])
-history = [h for h in history_all if h.get("route_id") == route_id]
+history = route_history(rw_data, route_id)
 
 if not history:
     st.info("暂无历史记录。提交一次“今日新增跑量”后，这里会显示你的跑步日志。")
@@ -1885,21 +1920,20 @@ with st.expander("🧹 数据管理（谨慎操作）", expanded=False):
         route_id = st.session_state.active_route_id
 
         delete_runs_by_date(rw_data, target_date=today, route_id=route_id)
-        route_sum = sum(float(h.get("km", 0.0)) for h in rw_data.get("history", []) if h.get("route_id") == route_id)
+        route_sum = route_km(rw_data, route_id)
         rw_data["profile"].setdefault("route_progress", {})
         rw_data["profile"]["route_progress"][route_id] = round(route_sum, 3)
+        # profile.agg / total_km / streak 已由 delete_runs_by_date 增量更新，无需整体重算
+        RW.mark_dirty()
 
-        recompute_profile(rw_data)
-        save_data(DATA_PATH, rw_data)
-
-        # 读回刷新 UI + 同步 session_state.total_km
-        st.session_state.rw_data = load_data(DATA_PATH)
-        rw_data = st.session_state.rw_data
+        # 刷新 UI + 同步 session_state.total_km
         profile = rw_data["profile"]
         st.session_state[rk_key] = float(profile.get("route_progress", {}).get(route_id, 0.0))
         st.session_state[last_key] = 0.0
         st.session_state[prev_key] = float(st.session_state[rk_key])
 
         st.success("已删除今天记录，并完成数据重算。")
-        st.rerun()
+        flush_and_rerun()
 
+# 本次 rerun 结束：有改动才落盘（最多一次）
+flush_user_data()
@@ -0,0 +1,161 @@
+# exporter.py
+"""
+Streaming history export: CSV, JSON Lines, and Parquet when pyarrow is installed.
+
+Rows are produced lazily from one user document (iter_rows) or from every stored user,
+one document at a time (iter_all_rows), and written in chunks -- nothing holds the full
+export in memory.
+
+    python tools/export_history.py --format csv --out all.csv
+"""
+from __future__ import annotations
+
+import csv
+import io
+import os
+from typing import IO, Any, Dict, Iterable, Iterator, Optional
+
+from storage import history_routes, json_dumps, list_user_data_paths, read_data
+
+try:
+    import pyarrow as _pa
+    import pyarrow.parquet as _pq
+except ImportError:
+    _pa = _pq = None
+
+# route_id: the route of a plain record ("" for a broadcast record)
+# route_ids: every route the run is credited to (CSV: ";"-joined, JSONL/Parquet: list)
+EXPORT_COLUMNS = ("user_id", "date", "km", "route_id", "route_ids", "note")
+
+FORMATS = ("csv", "jsonl", "parquet")
+MIME_TYPES = {"csv": "text/csv", "jsonl": "application/x-ndjson", "parquet": "application/vnd.apache.parquet"}
+
+_CHUNK_BYTES = 64 * 1024
+
+
+def parquet_available() -> bool:
+    return _pq is not None
+
+
+def iter_rows(data: Dict[str, Any], user_id: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+    """
+    One export row per history record, in history order.
+    """
+    if user_id is None:
+        user_id = str((data.get("profile") or {}).get("user_id") or "")
+    for rec in data.get("history") or []:
+        routes = history_routes(rec)
+        yield {
+            "user_id": user_id,
+            "date": rec.get("date"),
+            "km": float(rec.get("km") or 0.0),
+            "route_id": rec.get("route_id") or "",
+            "route_ids": routes,
+            "note": rec.get("note") or "",
+        }
+
+
+def iter_all_rows(storage_dir: str) -> Iterator[Dict[str, Any]]:
+    """
+    Rows of every stored user (local files, R2 users/* objects or SQLite), reading one
+    document at a time. Read-only: nothing is migrated, healed or created in storage.
+    """
+    for path in list_user_data_paths(storage_dir):
+        data = read_data(path)
+        if data is None:
+            continue
+        base = os.path.basename(path)
+        user_id = base[len("run_data_") : -len(".json")]
+        yield from iter_rows(data, user_id=user_id)
+
+
+def iter_csv(rows: Iterable[Dict[str, Any]]) -> Iterator[bytes]:
+    """
+    UTF-8 CSV (with BOM so Excel reads Chinese notes) in ~64 KiB chunks.
+    """
+    buf = io.StringIO()
+    w = csv.writer(buf)
+    buf.write("\ufeff")
+    w.writerow(EXPORT_COLUMNS)
+    for row in rows:
+        w.writerow([
+            row["user_id"], row["date"], row["km"], row["route_id"], ";".join(row["route_ids"]), row["note"],
+        ])
+        if buf.tell() >= _CHUNK_BYTES:
+            yield buf.getvalue().encode("utf-8")
+            buf.seek(0)
+            buf.truncate()
+    if buf.tell():
+        yield buf.getvalue().encode("utf-8")
+
+
+def iter_jsonl(rows: Iterable[Dict[str, Any]]) -> Iterator[bytes]:
+    """
+    One JSON object per line, in ~64 KiB chunks.
+    """
+    parts, size = [], 0
+    for row in rows:
+        line = json_dumps(row, pretty=False) + b"\n"
+        parts.append(line)
+        size += len(line)
+        if size >= _CHUNK_BYTES:
+            yield b"".join(parts)
+            parts, size = [], 0
+    if parts:
+        yield b"".join(parts)
+
+
+def write_parquet(rows: Iterable[Dict[str, Any]], dest: Any, batch_rows: int = 50_000) -> int:
+    """
+    Write rows to a Parquet file (path or binary file object) one row group per batch.
+    Needs pyarrow. Returns the number of rows written.
+    """
+    if _pq is None:
+        raise RuntimeError("Parquet export needs pyarrow (pip install pyarrow)")
+    schema = _pa.schema([
+        ("user_id", _pa.string()),
+        ("date", _pa.string()),
+        ("km", _pa.float64()),
+        ("route_id", _pa.string()),
+        ("route_ids", _pa.list_(_pa.string())),
+        ("note", _pa.string()),
+    ])
+    n = 0
+    cols: Dict[str, list] = {c: [] for c in EXPORT_COLUMNS}
+    with _pq.ParquetWriter(dest, schema) as writer:
+        for row in rows:
+            for c in EXPORT_COLUMNS:
+                cols[c].append(row[c])
+            n += 1
+            if len(cols["date"]) >= batch_rows:
+                writer.write_table(_pa.table(cols, schema=schema))
+                cols = {c: [] for c in EXPORT_COLUMNS}
+        if cols["date"] or n == 0:
+            writer.write_table(_pa.table(cols, schema=schema))
+    return n
+
+
+def export(rows: Iterable[Dict[str, Any]], fmt: str, fp: IO[bytes]) -> None:
+    """
+    Stream rows to a binary file object in the given format.
+    """
+    if fmt == "csv":
+        chunks = iter_csv(rows)
+    elif fmt == "jsonl":
+        chunks = iter_jsonl(rows)
+    elif fmt == "parquet":
+        write_parquet(rows, fp)
+        return
+    else:
+        raise ValueError(f"unknown export format: {fmt} (expected {', '.join(FORMATS)})")
+    for chunk in chunks:
+        fp.write(chunk)
+
+
+def export_bytes(data: Dict[str, Any], fmt: str, user_id: Optional[str] = None) -> bytes:
+    """
+    One user's history as a file body (for st.download_button).
+    """
+    buf = io.BytesIO()
+    export(iter_rows(data, user_id=user_id), fmt, buf)
+    return buf.getvalue()
@@ -0,0 +1,349 @@
+# importer.py
+"""
+Bulk history import from activity exports: CSV (Strava / Garmin / generic), GPX and TCX.
+
+Files are parsed as streams (csv.reader, ElementTree.iterparse with elements cleared as
+they are consumed), so a multi-year export never sits in memory as a DOM. Activities are
+summed per local calendar day, days the route already has are skipped, and the rest goes
+into the document through storage.add_runs_batch -- one in-memory batch, one save by the
+caller.
+
+    from importer import import_files
+    result = import_files(data, [("activities.csv", fp)], route_ids=["js_free_nj_zj"])
+"""
+from __future__ import annotations
+
+import csv
+import io
+import math
+import os
+import re
+from dataclasses import dataclass, field
+from datetime import date, datetime, timezone, tzinfo
+from typing import IO, Any, Dict, Iterable, Iterator, List, Optional, Tuple
+from xml.etree.ElementTree import iterparse
+
+from storage import add_runs_batch, route_has_run
+
+# (local date YYYY-MM-DD, km) for one activity
+Activity = Tuple[str, float]
+
+EARTH_RADIUS_KM = 6371.0088
+
+# CSV header aliases (compared lower-cased, stripped). The first matching column wins:
+# Strava's activities.csv has two "Distance" columns, km first, then meters.
+_CSV_DATE = ("date", "activity date", "start time", "start_time", "start_date_local", "start_date", "日期", "开始时间")
+# date columns whose naive times are UTC (Strava's activities.csv / API start_date), not local
+_CSV_DATE_UTC = ("activity date", "start_date")
+_CSV_KM = ("km", "distance_km", "distance (km)", "distance", "距离", "距离(km)", "距离（km）")
+_CSV_M = ("distance_m", "distance (m)", "distance_meters", "meters")
+_CSV_MI = ("distance (mi)", "miles", "distance_mi")
+_CSV_TYPE = ("activity type", "type", "sport", "sport_type", "活动类型", "类型")
+_CSV_DATE_FORMATS = (
+    "%b %d, %Y, %I:%M:%S %p",  # Strava: "Jan 5, 2023, 7:12:33 AM"
+    "%Y/%m/%d %H:%M:%S",
+    "%Y/%m/%d %H:%M",
+    "%Y/%m/%d",
+    "%m/%d/%Y %H:%M:%S",
+    "%m/%d/%Y",
+)
+
+_DECIMAL_COMMA = re.compile(r"^[+-]?\d*,\d{1,2}$")
+_THOUSANDS = re.compile(r"^[+-]?\d{1,3}(,\d{3})+(\.\d*)?$")
+
+_RUN_TYPES = ("run", "running", "trail run", "trail running", "virtual run", "treadmill running", "跑步", "9")
+
+
+@dataclass
+class ImportResult:
+    files: int = 0
+    activities: int = 0         # activities read (after the running-only filter)
+    skipped_activities: int = 0  # not a run / no usable date or distance
+    days: int = 0               # distinct local days found in the files
+    added: int = 0              # days written to history
+    duplicates: int = 0         # days the route(s) already had -> left untouched
+    rejected: int = 0           # days above max_daily_km
+    km: float = 0.0             # km written
+    errors: List[str] = field(default_factory=list)
+
+
+# --- helpers ---
+
+def _local(tag: str) -> str:
+    # "{namespace}trkpt" -> "trkpt"
+    return tag.rsplit("}", 1)[-1]
+
+
+def _parse_time(s: str) -> Optional[datetime]:
+    s = (s or "").strip()
+    if not s:
+        return None
+    try:
+        return datetime.fromisoformat(s[:-1] + "+00:00" if s.endswith("Z") else s)
+    except ValueError:
+        pass
+    for fmt in _CSV_DATE_FORMATS:
+        try:
+            return datetime.strptime(s, fmt)
+        except ValueError:
+            continue
+    return None
+
+
+def _local_day(dt: Optional[datetime], tz: Optional[tzinfo], naive_utc: bool = False) -> Optional[str]:
+    """
+    Calendar day of dt in tz (None = this machine's zone). Naive times are taken as UTC
+    when naive_utc is set (GPX / TCX / Strava), else as local already.
+    """
+    if dt is None:
+        return None
+    if dt.tzinfo is None and naive_utc:
+        dt = dt.replace(tzinfo=timezone.utc)
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(tz)
+    return dt.date().isoformat()
+
+
+def _haversine_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    dp, dl = p2 - p1, math.radians(lon2 - lon1)
+    a = math.sin(dp / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(dl / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def _is_run(kind: Optional[str]) -> bool:
+    # no type information -> assume a run
+    return not kind or kind.strip().lower() in _RUN_TYPES
+
+
+def _float(s: str) -> Optional[float]:
+    s = (s or "").strip()
+    if not s:
+        return None
+    if "," in s:
+        if _DECIMAL_COMMA.match(s):
+            s = s.replace(",", ".")  # decimal comma: "5,01"
+        elif _THOUSANDS.match(s):
+            s = s.replace(",", "")   # thousands separator: "1,234" / "1,234.5"
+        else:
+            return None              # ambiguous ("1,2345", "1,23,4")
+    try:
+        v = float(s)
+    except ValueError:
+        return None
+    return v if math.isfinite(v) else None
+
+
+# --- parsers: each yields one Activity per activity in the file ---
+
+def parse_csv(fp: IO, tz: Optional[tzinfo] = None, running_only: bool = True) -> Iterator[Optional[Activity]]:
+    """
+    One row per activity. Yields None for rows without a usable date/distance (counted as skipped).
+    """
+    if not isinstance(fp, io.TextIOBase):
+        fp = io.TextIOWrapper(fp, encoding="utf-8-sig", newline="")
+    reader = csv.reader(fp)
+    header = next(reader, None)
+    if not header:
+        return
+    cols = [h.strip().lstrip("\ufeff").lower() for h in header]
+
+    def find(names) -> Optional[int]:
+        for i, c in enumerate(cols):
+            if c in names:
+                return i
+        return None
+
+    i_date, i_type = find(_CSV_DATE), find(_CSV_TYPE)
+    date_utc = i_date is not None and cols[i_date] in _CSV_DATE_UTC
+    i_dist, scale = find(_CSV_KM), 1.0
+    if i_dist is None:
+        i_dist, scale = find(_CSV_M), 0.001
+    if i_dist is None:
+        i_dist, scale = find(_CSV_MI), 1.609344
+    if i_date is None or i_dist is None:
+        raise ValueError("CSV needs a date column and a distance column (km / m / mi)")
+
+    for row in reader:
+        if len(row) <= max(i_date, i_dist):
+            yield None
+            continue
+        if running_only and i_type is not None and i_type < len(row) and not _is_run(row[i_type]):
+            yield None
+            continue
+        # date-only values ("2024/03/01") are calendar days already, in any column
+        day = _local_day(_parse_time(row[i_date]), tz, naive_utc=date_utc and ":" in row[i_date])
+        km = _float(row[i_dist])
+        yield (day, km * scale) if day and km and km > 0 else None
+
+
+def parse_gpx(fp: IO, tz: Optional[tzinfo] = None, running_only: bool = True) -> Iterator[Optional[Activity]]:
+    """
+    One <trk> per activity: distance = sum of great-circle steps between consecutive
+    <trkpt> of each <trkseg>; the day comes from the first point time (else <metadata><time>).
+    """
+    meta_time: Optional[str] = None
+    kind: Optional[str] = None
+    first_time: Optional[str] = None
+    km = 0.0
+    prev: Optional[Tuple[float, float]] = None
+    in_trk = False
+    root = None
+    for event, elem in iterparse(fp, events=("start", "end")):
+        tag = _local(elem.tag)
+        if event == "start":
+            if root is None:
+                root = elem
+            if tag == "trk":
+                in_trk, kind, first_time, km = True, None, None, 0.0
+            elif tag == "trkseg":
+                prev = None
+            continue
+
+        if tag == "trkpt":
+            try:
+                pt = (float(elem.get("lat")), float(elem.get("lon")))
+            except (TypeError, ValueError):
+                pt = None
+            if pt is not None:
+                if prev is not None:
+                    km += _haversine_km(prev[0], prev[1], pt[0], pt[1])
+                prev = pt
+            if first_time is None:
+                for child in elem:
+                    if _local(child.tag) == "time":
+                        first_time = child.text
+                        break
+            elem.clear()
+        elif tag == "time" and not in_trk and meta_time is None:
+            meta_time = elem.text
+        elif tag == "type" and in_trk:
+            kind = elem.text
+        elif tag == "trk":
+            in_trk = False
+            day = _local_day(_parse_time(first_time or meta_time or ""), tz, naive_utc=True)
+            if running_only and not _is_run(kind):
+                yield None
+            else:
+                yield (day, km) if day and km > 0 else None
+            if root is not None:
+                root.clear()  # drop the finished track
+
+
+def parse_tcx(fp: IO, tz: Optional[tzinfo] = None, running_only: bool = True) -> Iterator[Optional[Activity]]:
+    """
+    One <Activity> per activity: distance = sum of <Lap><DistanceMeters>, day from the
+    activity <Id> (its start time) or else the first lap's StartTime. Trackpoints are
+    discarded as they stream.
+    """
+    sport: Optional[str] = None
+    start: Optional[str] = None
+    meters = 0.0
+    root = None
+    for event, elem in iterparse(fp, events=("start", "end")):
+        tag = _local(elem.tag)
+        if event == "start":
+            if root is None:
+                root = elem
+            if tag == "Activity":
+                sport, start, meters = elem.get("Sport"), None, 0.0
+            elif tag == "Lap" and start is None:
+                start = elem.get("StartTime")
+            continue
+
+        if tag == "Trackpoint":
+            elem.clear()
+        elif tag == "Lap":
+            for child in elem:
+                if _local(child.tag) == "DistanceMeters":
+                    meters += _float(child.text or "") or 0.0
+                    break
+            elem.clear()
+        elif tag == "Id" and start is None:
+            start = elem.text
+        elif tag == "Activity":
+            day = _local_day(_parse_time(start or ""), tz, naive_utc=True)
+            if running_only and not _is_run(sport):
+                yield None
+            else:
+                yield (day, meters / 1000.0) if day and meters > 0 else None
+            if root is not None:
+                root.clear()
+
+
+_PARSERS = {".csv": parse_csv, ".gpx": parse_gpx, ".tcx": parse_tcx}
+
+SUPPORTED_EXTENSIONS = tuple(sorted(_PARSERS))
+
+
+def iter_activities(name: str, fp: IO, tz: Optional[tzinfo] = None, running_only: bool = True) -> Iterator[Optional[Activity]]:
+    ext = os.path.splitext(name or "")[1].lower()
+    parser = _PARSERS.get(ext)
+    if parser is None:
+        raise ValueError(f"unsupported file type: {name} (expected {', '.join(SUPPORTED_EXTENSIONS)})")
+    return parser(fp, tz=tz, running_only=running_only)
+
+
+def daily_km(activities: Iterable[Optional[Activity]], result: Optional[ImportResult] = None) -> Dict[str, float]:
+    """
+    Sum activities per day. None entries only count as skipped.
+    """
+    days: Dict[str, float] = {}
+    for act in activities:
+        if act is None:
+            if result is not None:
+                result.skipped_activities += 1
+            continue
+        day, km = act
+        days[day] = days.get(day, 0.0) + km
+        if result is not None:
+            result.activities += 1
+    return days
+
+
+# --- import into a user document ---
+
+def import_files(
+    data: Dict[str, Any],
+    files: Iterable[Tuple[str, IO]],
+    route_ids: List[str],
+    tz: Optional[tzinfo] = None,
+    running_only: bool = True,
+    max_daily_km: Optional[float] = None,
+    note: str = "import",
+) -> ImportResult:
+    """
+    Parse every (name, binary file) pair, merge per day across files, skip days any of
+    route_ids already has (re-importing the same export is a no-op), and add the rest in
+    one batch. Mutates `data`; the caller saves it. A broken file is reported in
+    result.errors and does not stop the others.
+
+    tz is the user's zone: activities are bucketed by their calendar day there (None =
+    this machine's zone, only right when the server runs in the user's zone).
+    """
+    result = ImportResult()
+    days: Dict[str, float] = {}
+    for name, fp in files:
+        result.files += 1
+        try:
+            for day, km in daily_km(iter_activities(name, fp, tz=tz, running_only=running_only), result).items():
+                days[day] = days.get(day, 0.0) + km
+        except (ValueError, SyntaxError, UnicodeDecodeError) as e:  # ParseError is a SyntaxError
+            result.errors.append(f"{name}: {e}")
+    result.days = len(days)
+
+    today = date.today().isoformat()
+    runs: List[Tuple[str, float]] = []
+    for day, km in days.items():
+        km = round(km, 3)
+        if any(route_has_run(data, rid, day) for rid in route_ids):
+            result.duplicates += 1
+        elif day > today or km <= 0 or (max_daily_km is not None and km > max_daily_km + 1e-9):
+            result.rejected += 1
+        else:
+            runs.append((day, km))
+
+    if runs:
+        result.added = add_runs_batch(data, runs, route_ids, note=note)
+        result.km = round(sum(km for _, km in runs), 3)
+    return result
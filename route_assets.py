@@ -0,0 +1,648 @@
+# route_assets.py
+"""
+Compiled binary route geometry, opened with mmap.
+
+route_with_dist.json / nodes_<spacing>km.json are compiled (tools/compile_routes.py, or
+tools/build_route.py right after it writes the JSON) into a sibling .bin file:
+
+    header (32 bytes, little-endian):
+        magic "RWRT" | version u16 | flags u16 | count u32 | reserved u32 |
+        total_km f64 | step_km f64
+    lon[count] f64 | lat[count] f64 | cum_km[count] f64
+
+Opening one is an mmap plus three zero-copy memoryviews: no JSON parse, no per-point
+dicts, and the pages are shared through the OS page cache by every process that maps the
+same file. load_route_geometry() falls back to the JSON (and recompiles it when the .bin
+is missing or older than the JSON and the directory is writable).
+"""
+from __future__ import annotations
+
+import bisect
+import hashlib
+import json
+import math
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import threading
+import time
+from array import array
+from types import MappingProxyType
+from typing import Any, Callable, Dict, Iterable, List, Mapping, NamedTuple, Optional, Sequence, Tuple, Union
+
+try:
+    import numpy as _np
+except ImportError:
+    _np = None
+
+ASSET_MAGIC = b"RWRT"
+ASSET_VERSION = 1
+ASSET_EXT = ".bin"
+_HEADER = struct.Struct("<4sHHIIdd")  # 32 bytes: keeps the float64 arrays 8-byte aligned
+
+_NATIVE_LE = sys.byteorder == "little"
+
+
+def asset_path(json_path: str) -> str:
+    return os.path.splitext(json_path)[0] + ASSET_EXT
+
+
+def _read_json_points(json_path: str):
+    """
+    (lon, lat, cum_km arrays, total_km, step_km) from a route_with_dist / nodes JSON.
+    """
+    with open(json_path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    pts = data.get("nodes") if isinstance(data.get("nodes"), list) else data.get("points")
+    if not pts:
+        raise ValueError(f"route file has no points/nodes: {json_path}")
+    # 兼容 dist_km / cum_km 两种命名
+    key = "dist_km" if "dist_km" in pts[0] else "cum_km"
+    lon, lat, cum = array("d"), array("d"), array("d")
+    for p in pts:
+        lon.append(float(p["lon"]))
+        lat.append(float(p["lat"]))
+        cum.append(float(p[key]))
+    total_km = float(data.get("total_km", cum[-1]))
+    step_km = float(data.get("step_km", data.get("spacing_km", 0.0)) or 0.0)
+    return lon, lat, cum, total_km, step_km
+
+
+def compile_route_asset(json_path: str, out_path: Optional[str] = None) -> str:
+    """
+    Compile a route JSON into the binary asset (atomic replace); returns the asset path.
+    """
+    out_path = out_path or asset_path(json_path)
+    lon, lat, cum, total_km, step_km = _read_json_points(json_path)
+    if not _NATIVE_LE:
+        for a in (lon, lat, cum):
+            a.byteswap()
+    header = _HEADER.pack(ASSET_MAGIC, ASSET_VERSION, 0, len(cum), 0, total_km, step_km)
+    fd, tmp_path = tempfile.mkstemp(prefix="rw_", suffix=".tmp", dir=os.path.dirname(out_path) or ".")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(header)
+            f.write(lon.tobytes())
+            f.write(lat.tobytes())
+            f.write(cum.tobytes())
+        os.replace(tmp_path, out_path)
+    finally:
+        if os.path.exists(tmp_path):
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+    return out_path
+
+
+class _PointSeq(Sequence):
+    """
+    Read-only list-of-dicts view ({"lon", "lat", "dist_km", "cum_km"}) over the arrays, for
+    code written against the JSON nodes. Dicts are built only for the points touched.
+    """
+
+    __slots__ = ("_g",)
+
+    def __init__(self, geometry: "RouteGeometry"):
+        self._g = geometry
+
+    def __len__(self) -> int:
+        return len(self._g)
+
+    def __getitem__(self, i: Union[int, slice]) -> Any:
+        if isinstance(i, slice):
+            return [self._g.point(j) for j in range(*i.indices(len(self._g)))]
+        return self._g.point(i)
+
+
+class Position(NamedTuple):
+    """
+    A point at a cumulative distance along a route, linearly interpolated between the two
+    route points around it: cum_km[seg] <= km <= cum_km[seg + 1], t = fraction of that
+    segment (t = 1 only at the route end; seg = 0, t = 0 for a one-point route).
+    """
+    km: float        # clamped to [0, route end]
+    lon: float
+    lat: float
+    seg: int
+    t: float
+    progress: float  # km / route end, 0..1
+
+
+class PositionBatch(NamedTuple):
+    """
+    locate_batch() result: one column per Position field, aligned with the input distances.
+    NumPy arrays when numpy is installed, else array("d") / array("q").
+    """
+    km: Any
+    lon: Any
+    lat: Any
+    seg: Any
+    t: Any
+    progress: Any
+
+
+class RouteGeometry:
+    """
+    lon / lat / cum_km as float64 sequences (memoryviews into the mapped file, or arrays
+    when built from JSON), plus total_km and step_km. Treat as immutable.
+
+    Positions come from a bisect on cum_km (O(log n)), so irregular point spacing is
+    exact -- never index by km / step_km.
+    """
+
+    __slots__ = ("path", "lon", "lat", "cum_km", "total_km", "step_km", "points", "_mm")
+
+    def __init__(self, lon, lat, cum_km, total_km: float, step_km: float, path: str = "", mm: Optional[mmap.mmap] = None):
+        self.path = path
+        self.lon, self.lat, self.cum_km = lon, lat, cum_km
+        self.total_km = float(total_km)
+        self.step_km = float(step_km)
+        self._mm = mm  # keeps the mapping alive as long as the views
+        self.points = _PointSeq(self)
+
+    def __len__(self) -> int:
+        return len(self.cum_km)
+
+    def point(self, i: int) -> Dict[str, float]:
+        d = self.cum_km[i]
+        return {"lon": self.lon[i], "lat": self.lat[i], "dist_km": d, "cum_km": d}
+
+    def coords(self, start: int = 0, stop: Optional[int] = None) -> List[List[float]]:
+        """
+        [[lon, lat], ...] for points[start:stop] (pydeck PathLayer format).
+        """
+        lon, lat = self.lon[start:stop], self.lat[start:stop]
+        return [[x, y] for x, y in zip(lon, lat)]
+
+    def _position(self, km: float, seg: int) -> Position:
+        cum, n = self.cum_km, len(self.cum_km)
+        end = cum[n - 1]
+        if n == 1:
+            return Position(km, self.lon[0], self.lat[0], 0, 0.0, 0.0)
+        seg = max(0, min(seg, n - 2))
+        c0, c1 = cum[seg], cum[seg + 1]
+        t = (km - c0) / (c1 - c0) if c1 > c0 else 0.0
+        lon0, lat0 = self.lon[seg], self.lat[seg]
+        lon = lon0 + (self.lon[seg + 1] - lon0) * t
+        lat = lat0 + (self.lat[seg + 1] - lat0) * t
+        return Position(km, lon, lat, seg, t, km / end if end > 0 else 0.0)
+
+    def locate(self, km: float) -> Position:
+        """
+        Interpolated position at cumulative distance km (clamped to the route).
+        """
+        cum = self.cum_km
+        if not len(cum):
+            raise ValueError("route has no points")
+        km = max(0.0, min(float(km), cum[-1]))
+        return self._position(km, bisect.bisect_right(cum, km) - 1)
+
+    def locate_many(self, kms: Iterable[float]) -> List[Position]:
+        """
+        locate() for many distances, in input order. Queries are answered in sorted order so
+        each bisect only searches past the previous hit.
+        """
+        cum = self.cum_km
+        if not len(cum):
+            raise ValueError("route has no points")
+        end = cum[-1]
+        kms = [max(0.0, min(float(k), end)) for k in kms]
+        out: List[Optional[Position]] = [None] * len(kms)
+        lo = 0
+        for i in sorted(range(len(kms)), key=kms.__getitem__):
+            km = kms[i]
+            lo = bisect.bisect_right(cum, km, lo)
+            out[i] = self._position(km, lo - 1)
+        return out  # type: ignore[return-value]
+
+    def locate_batch(self, kms: Iterable[float], use_numpy: Optional[bool] = None) -> PositionBatch:
+        """
+        locate() for an array of distances as columns: one searchsorted + vectorized
+        interpolation with numpy, else the locate_many() walk (same results).
+        """
+        n = len(self.cum_km)
+        if not n:
+            raise ValueError("route has no points")
+        if use_numpy is None:
+            use_numpy = _np is not None
+        if not use_numpy:
+            pos = self.locate_many(kms)
+            return PositionBatch(
+                array("d", [p.km for p in pos]), array("d", [p.lon for p in pos]), array("d", [p.lat for p in pos]),
+                array("q", [p.seg for p in pos]), array("d", [p.t for p in pos]), array("d", [p.progress for p in pos]),
+            )
+        if _np is None:
+            raise RuntimeError("locate_batch(use_numpy=True) needs numpy (pip install numpy)")
+        cum = _np.frombuffer(self.cum_km, dtype=_np.float64)
+        lon = _np.frombuffer(self.lon, dtype=_np.float64)
+        lat = _np.frombuffer(self.lat, dtype=_np.float64)
+        end = cum[-1]
+        km = _np.clip(_np.asarray(kms if hasattr(kms, "__len__") else list(kms), dtype=_np.float64), 0.0, end)
+        progress = km / end if end > 0 else _np.zeros_like(km)
+        if n == 1:
+            zeros = _np.zeros_like(km)
+            return PositionBatch(km, zeros + lon[0], zeros + lat[0], _np.zeros(km.shape, dtype=_np.int64), zeros, zeros)
+        seg = _np.searchsorted(cum, km, side="right") - 1
+        _np.clip(seg, 0, n - 2, out=seg)
+        c0 = cum[seg]
+        span = cum[seg + 1] - c0
+        t = _np.divide(km - c0, span, out=_np.zeros_like(km), where=span > 0)
+        lon0, lat0 = lon[seg], lat[seg]
+        return PositionBatch(km, lon0 + (lon[seg + 1] - lon0) * t, lat0 + (lat[seg + 1] - lat0) * t, seg, t, progress)
+
+    def path_to(self, pos: Position) -> List[List[float]]:
+        """
+        [[lon, lat], ...] from the start up to pos (ends exactly at pos).
+        """
+        out = self.coords(0, pos.seg + 1)
+        if pos.t > 0:
+            out.append([pos.lon, pos.lat])
+        return out
+
+    def path_from(self, pos: Position) -> List[List[float]]:
+        """
+        [[lon, lat], ...] from pos (exactly) to the end.
+        """
+        if pos.t <= 0:
+            return self.coords(pos.seg)
+        if pos.t >= 1:
+            return self.coords(pos.seg + 1)
+        return [[pos.lon, pos.lat]] + self.coords(pos.seg + 1)
+
+    def path_between(self, a: Position, b: Position) -> List[List[float]]:
+        """
+        [[lon, lat], ...] from a to b along the route; [] unless a.km < b.km.
+        """
+        if b.km <= a.km:
+            return []
+        out = [[a.lon, a.lat]] + self.coords(a.seg + 1, b.seg + 1)
+        if b.t > 0:
+            out.append([b.lon, b.lat])
+        return out
+
+
+def open_route_asset(path: str) -> RouteGeometry:
+    """
+    mmap a compiled asset. Raises ValueError on a bad or truncated file.
+    """
+    with open(path, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        if len(mm) < _HEADER.size:
+            raise ValueError(f"route asset truncated: {path}")
+        magic, version, _flags, n, _, total_km, step_km = _HEADER.unpack_from(mm, 0)
+        if magic != ASSET_MAGIC or version != ASSET_VERSION:
+            raise ValueError(f"not a v{ASSET_VERSION} route asset: {path}")
+        if len(mm) < _HEADER.size + 24 * n:
+            raise ValueError(f"route asset truncated: {path}")
+    except ValueError:
+        mm.close()
+        raise
+    size = 8 * n
+    if _NATIVE_LE:
+        body = memoryview(mm)[_HEADER.size : _HEADER.size + 3 * size]
+        lon, lat, cum = body[:size].cast("d"), body[size : 2 * size].cast("d"), body[2 * size :].cast("d")
+        return RouteGeometry(lon, lat, cum, total_km, step_km, path=path, mm=mm)
+    cols = []
+    for k in range(3):
+        a = array("d", mm[_HEADER.size + k * size : _HEADER.size + (k + 1) * size])
+        a.byteswap()
+        cols.append(a)
+    mm.close()
+    return RouteGeometry(*cols, total_km, step_km, path=path)
+
+
+def load_route_geometry(json_path: str, compile_missing: bool = True) -> RouteGeometry:
+    """
+    Geometry for a route JSON: the compiled asset when it is present and not older than
+    the JSON, else (re)compile it, else parse the JSON in memory (read-only checkout).
+    """
+    bin_path = asset_path(json_path)
+    try:
+        src_mtime = os.path.getmtime(json_path)
+    except OSError:
+        src_mtime = None  # only the compiled asset shipped
+    try:
+        if src_mtime is None or os.path.getmtime(bin_path) >= src_mtime:
+            return open_route_asset(bin_path)
+    except (OSError, ValueError):
+        pass
+    if compile_missing:
+        try:
+            return open_route_asset(compile_route_asset(json_path, bin_path))
+        except OSError:
+            pass
+    lon, lat, cum, total_km, step_km = _read_json_points(json_path)
+    return RouteGeometry(lon, lat, cum, total_km, step_km, path=json_path)
+
+
+# --- route catalog (routes/index.json) ---
+# Everything the picker / dashboard needs per route (name, tier, total_km, node count,
+# key-city km offsets, bbox, geometry hash), written by the build tooling so listing routes
+# is one small file read. An entry is trusted only while the route's meta.json hash and
+# nodes file size still match what was indexed (checkout mtimes are meaningless).
+
+CATALOG_NAME = "index.json"
+CATALOG_VERSION = 1
+
+
+def nodes_filename(meta: Mapping[str, Any]) -> str:
+    # 生成器输出的命名风格是 nodes_0p5km.json（meta 里没有 spacing 就默认 0.5）
+    spacing = meta.get("node_spacing_km", 0.5)
+    return f"nodes_{str(spacing).replace('.', 'p')}km.json"
+
+
+def _file_size(path: str) -> Optional[int]:
+    try:
+        return os.stat(path).st_size
+    except OSError:
+        return None
+
+
+def geometry_hash(g: RouteGeometry) -> str:
+    """
+    sha256 over the lon / lat / cum_km float64 arrays (independent of the JSON formatting).
+    """
+    h = hashlib.sha256()
+    for col in (g.lon, g.lat, g.cum_km):
+        h.update(col)
+    return h.hexdigest()
+
+
+def snap_key_cities(meta: Mapping[str, Any], g: RouteGeometry) -> List[Dict[str, Any]]:
+    """
+    [{"name", "km"}] for meta["key_cities"]: an explicit "km" wins, else the cum_km of the
+    nearest route point to the city's lat/lon, searching forward from the previous city so a
+    loop that ends where it started gets the end, not km 0. km is None without coordinates.
+    """
+    out: List[Dict[str, Any]] = []
+    start = 0
+    n = len(g)
+    for c in meta.get("key_cities") or []:
+        if isinstance(c, str):
+            out.append({"name": c, "km": None})
+            continue
+        name = str(c.get("name") or c.get("city") or "")
+        if isinstance(c.get("km"), (int, float)):
+            out.append({"name": name, "km": float(c["km"])})
+            continue
+        try:
+            lat, lon = float(c["lat"]), float(c["lon"])
+        except (KeyError, TypeError, ValueError):
+            out.append({"name": name, "km": None})
+            continue
+        kx = math.cos(math.radians(lat)) ** 2  # equirectangular: enough to pick the nearest point
+        lons, lats = g.lon, g.lat
+        best, best_d = start, float("inf")
+        for i in range(start, n):
+            dx, dy = lons[i] - lon, lats[i] - lat
+            d = kx * dx * dx + dy * dy
+            if d < best_d:
+                best, best_d = i, d
+        start = best
+        out.append({"name": name, "km": round(float(g.cum_km[best]), 3)})
+    return out
+
+
+def build_catalog_entry(route_dir: str, meta: Mapping[str, Any], meta_raw: bytes) -> Dict[str, Any]:
+    """
+    Catalog record for one route: totals and counts from the nodes geometry, bbox and
+    key-city offsets from the full-resolution route_with_dist when present.
+    """
+    nodes_path = os.path.join(route_dir, nodes_filename(meta))
+    nodes = load_route_geometry(nodes_path)
+    full_path = os.path.join(route_dir, "route_with_dist.json")
+    full = load_route_geometry(full_path) if os.path.exists(full_path) or os.path.exists(asset_path(full_path)) else nodes
+    rid = str(meta.get("id") or os.path.basename(route_dir))
+    return {
+        "id": rid,
+        "name": meta.get("name", rid),
+        "tier": meta.get("tier"),
+        "region": meta.get("region"),
+        "end_name": (meta.get("waypoints") or [{"name": "终点"}])[-1].get("name", "终点"),
+        "total_km": nodes.total_km,  # unrounded: completion checks compare against it
+        "nodes": len(nodes),
+        "node_spacing_km": meta.get("node_spacing_km", 0.5),
+        "key_cities": snap_key_cities(meta, full),
+        "bbox": [round(min(full.lon), 6), round(min(full.lat), 6), round(max(full.lon), 6), round(max(full.lat), 6)],
+        "geometry_sha256": geometry_hash(nodes),
+        "meta_sha256": hashlib.sha256(meta_raw).hexdigest(),
+        "nodes_bytes": _file_size(nodes_path),
+    }
+
+
+def build_route_catalog(routes_dir: str) -> Dict[str, Any]:
+    routes: Dict[str, Any] = {}
+    for rid in sorted(os.listdir(routes_dir)):
+        route_dir = os.path.join(routes_dir, rid)
+        meta_path = os.path.join(route_dir, "meta.json")
+        if not os.path.isfile(meta_path):
+            continue
+        with open(meta_path, "rb") as f:
+            raw = f.read()
+        routes[rid] = build_catalog_entry(route_dir, json.loads(raw), raw)
+    return {"version": CATALOG_VERSION, "routes": routes}
+
+
+def write_route_catalog(routes_dir: str) -> str:
+    """
+    (Re)generate <routes_dir>/index.json (atomic replace); returns its path.
+    """
+    catalog = build_route_catalog(routes_dir)
+    out_path = os.path.join(routes_dir, CATALOG_NAME)
+    fd, tmp_path = tempfile.mkstemp(prefix="rw_", suffix=".tmp", dir=routes_dir)
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(catalog, f, ensure_ascii=False, indent=2)
+            f.write("\n")
+        os.replace(tmp_path, out_path)
+    finally:
+        if os.path.exists(tmp_path):
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+    return out_path
+
+
+def load_route_catalog(routes_dir: str) -> Dict[str, Any]:
+    """
+    {route_id: catalog record} from <routes_dir>/index.json; {} when missing, unreadable or
+    from another catalog version.
+    """
+    try:
+        with open(os.path.join(routes_dir, CATALOG_NAME), "r", encoding="utf-8") as f:
+            catalog = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(catalog, dict) or catalog.get("version") != CATALOG_VERSION:
+        return {}
+    routes = catalog.get("routes")
+    return routes if isinstance(routes, dict) else {}
+
+
+# --- process-wide route registry ---
+# Route metas, catalog records, node geometry, totals and derived tables (e.g. city stops)
+# loaded once per process and shared by every session. Revalidation is a handful of stat()
+# calls (index.json, each meta.json and nodes file), at most every revalidate_s seconds;
+# only routes whose files changed are reloaded. Everything handed out is shared: treat it
+# as read-only (metas are MappingProxyType, derived values are cached as returned).
+
+
+def _mtime(path: str) -> Optional[int]:
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+class RouteEntry:
+    """
+    One route: read-only meta, its catalog record (None when index.json has no current
+    one), nodes geometry (mapped lazily), and memoized derived values.
+    """
+
+    __slots__ = ("id", "dir", "meta", "catalog", "nodes_path", "version", "_geometry", "_derived", "_lock")
+
+    def __init__(self, rid: str, route_dir: str, meta: Dict[str, Any], version: Tuple,
+                 catalog: Optional[Dict[str, Any]] = None):
+        self.id = rid
+        self.dir = route_dir
+        self.meta = MappingProxyType(meta)
+        self.catalog = MappingProxyType(catalog) if catalog is not None else None
+        self.nodes_path = os.path.join(route_dir, nodes_filename(meta))
+        self.version = version
+        self._geometry: Optional[RouteGeometry] = None
+        self._derived: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def geometry(self) -> RouteGeometry:
+        g = self._geometry
+        if g is None:
+            with self._lock:
+                if self._geometry is None:
+                    self._geometry = load_route_geometry(self.nodes_path)
+                g = self._geometry
+        return g
+
+    @property
+    def total_km(self) -> float:
+        # catalog first: no geometry read just to list routes
+        if self.catalog is not None:
+            return float(self.catalog["total_km"])
+        try:
+            return self.geometry.total_km
+        except (OSError, ValueError):
+            return 0.0
+
+    def derived(self, name: str, fn: Callable[["RouteEntry"], Any]) -> Any:
+        """
+        fn(entry) computed once per route version and shared.
+        """
+        try:
+            return self._derived[name]
+        except KeyError:
+            pass
+        value = fn(self)
+        with self._lock:
+            return self._derived.setdefault(name, value)
+
+
+class RouteRegistry:
+    def __init__(self, routes_dir: str, revalidate_s: float = 2.0):
+        self.routes_dir = routes_dir
+        self.revalidate_s = revalidate_s
+        self._entries: Dict[str, RouteEntry] = {}
+        self._metas: Mapping[str, Mapping[str, Any]] = MappingProxyType({})
+        self._catalog_mtime: Optional[int] = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+        self.refresh(force=True)
+
+    def _route_version(self, route_dir: str, meta_path: str, meta: Mapping[str, Any]) -> Tuple:
+        nodes = os.path.join(route_dir, nodes_filename(meta))
+        return (_mtime(meta_path), _mtime(nodes), _file_size(nodes))
+
+    def refresh(self, force: bool = False) -> None:
+        """
+        Re-stat the routes directory (throttled unless force) and reload changed routes.
+        """
+        now = time.monotonic()
+        if not force and now - self._checked_at < self.revalidate_s:
+            return
+        with self._lock:
+            if not force and now - self._checked_at < self.revalidate_s:
+                return
+            self._checked_at = now
+            try:
+                rids = sorted(os.listdir(self.routes_dir))
+            except OSError:
+                rids = []
+            catalog_mtime = _mtime(os.path.join(self.routes_dir, CATALOG_NAME))
+            reindexed = catalog_mtime != self._catalog_mtime  # new index -> rebuild every entry
+            catalog = load_route_catalog(self.routes_dir) if reindexed else None
+            entries: Dict[str, RouteEntry] = {}
+            for rid in rids:
+                route_dir = os.path.join(self.routes_dir, rid)
+                meta_path = os.path.join(route_dir, "meta.json")
+                if not os.path.isfile(meta_path):
+                    continue
+                old = self._entries.get(rid)
+                if not reindexed and old is not None and self._route_version(route_dir, meta_path, old.meta) == old.version:
+                    entries[rid] = old
+                    continue
+                try:
+                    with open(meta_path, "rb") as f:
+                        raw = f.read()
+                    meta = json.loads(raw)
+                except (OSError, ValueError):
+                    continue
+                if catalog is None:
+                    catalog = load_route_catalog(self.routes_dir)
+                version = self._route_version(route_dir, meta_path, meta)
+                rec = catalog.get(rid)
+                if not (isinstance(rec, dict) and rec.get("meta_sha256") == hashlib.sha256(raw).hexdigest()
+                        and rec.get("nodes_bytes") == version[2]):
+                    rec = None  # stale / missing index entry -> totals from the geometry
+                entries[rid] = RouteEntry(rid, route_dir, meta, version, catalog=rec)
+            self._entries = entries
+            self._catalog_mtime = catalog_mtime
+            self._metas = MappingProxyType({rid: e.meta for rid, e in entries.items()})
+
+    def metas(self) -> Mapping[str, Mapping[str, Any]]:
+        """
+        {route_id: meta} for every route with a meta.json (read-only).
+        """
+        self.refresh()
+        return self._metas
+
+    def entry(self, rid: str) -> Optional[RouteEntry]:
+        self.refresh()
+        return self._entries.get(rid)
+
+    def __contains__(self, rid: str) -> bool:
+        return self.entry(rid) is not None
+
+    def geometry(self, rid: str) -> RouteGeometry:
+        e = self.entry(rid)
+        if e is None:
+            raise KeyError(rid)
+        return e.geometry
+
+    def total_km(self, rid: str) -> float:
+        e = self.entry(rid)
+        return e.total_km if e is not None else 0.0
+
+    def catalog(self, rid: str) -> Optional[Mapping[str, Any]]:
+        e = self.entry(rid)
+        return e.catalog if e is not None else None
+
+    def derived(self, rid: str, name: str, fn: Callable[[RouteEntry], Any]) -> Any:
+        e = self.entry(rid)
+        if e is None:
+            raise KeyError(rid)
+        return e.derived(name, fn)
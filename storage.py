@@ -1,11 +1,72 @@
 from __future__ import annotations
+import atexit
+import bisect
+import copy
+import gzip
+import hashlib
 import json
+import logging
+import math
 import os
+import socket
+import sqlite3
 import tempfile
+import threading
+import time
 import uuid
+from abc import ABC, abstractmethod
+from array import array
+from collections.abc import MutableMapping
 from dataclasses import dataclass
 from datetime import datetime, date, timedelta
-from typing import Any, Dict, List, Optional
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+_log = logging.getLogger(__name__)
+
+
+# --- JSON codec ---
+# Documents are encoded/decoded through json_dumps/json_loads: orjson when it is
+# importable (several times faster), the stdlib otherwise. Output is compact by default;
+# RW_JSON_PRETTY=1 (or pretty=True) writes indented JSON for debugging. Readers accept
+# either layout, so both kinds of files coexist.
+try:
+    import orjson as _orjson
+except ImportError:
+    _orjson = None
+
+JSON_PRETTY = os.getenv("RW_JSON_PRETTY", "0").strip().lower() in ("1", "true", "yes", "on")
+
+
+def json_dumps(obj: Any, pretty: Optional[bool] = None, sort_keys: bool = False) -> bytes:
+    """
+    UTF-8 JSON bytes (non-ASCII kept as-is).
+    """
+    if pretty is None:
+        pretty = JSON_PRETTY
+    if _orjson is not None:
+        opt = _orjson.OPT_NON_STR_KEYS
+        if pretty:
+            opt |= _orjson.OPT_INDENT_2
+        if sort_keys:
+            opt |= _orjson.OPT_SORT_KEYS
+        try:
+            return _orjson.dumps(obj, option=opt)
+        except TypeError:
+            pass  # e.g. an int beyond 64 bits: the stdlib encoder copes
+    if pretty:
+        return json.dumps(obj, ensure_ascii=False, indent=2, sort_keys=sort_keys).encode("utf-8")
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"), sort_keys=sort_keys).encode("utf-8")
+
+
+def json_loads(raw: Any) -> Any:
+    """
+    Parse JSON from bytes or str (compact or indented).
+    """
+    if _orjson is not None:
+        return _orjson.loads(raw)
+    if isinstance(raw, (bytes, bytearray, memoryview)):
+        raw = bytes(raw).decode("utf-8")
+    return json.loads(raw)
 
 
 # --- R2 backend (S3-compatible) ---
@@ -14,14 +75,27 @@ _BACKEND = os.getenv("RW_STORAGE_BACKEND", "local").strip().lower()
 def _is_r2() -> bool:
     return _BACKEND == "r2"
 
-def _r2_client():
+def _is_sqlite() -> bool:
+    return _BACKEND == "sqlite"
+
+def _r2_new_client():
     import boto3
+    from botocore.config import Config
     endpoint = os.getenv("R2_ENDPOINT", "").strip()
     access = os.getenv("R2_ACCESS_KEY_ID", "").strip()
     secret = os.getenv("R2_SECRET_ACCESS_KEY", "").strip()
     if not endpoint or not access or not secret:
         raise RuntimeError("R2 env missing: R2_ENDPOINT / R2_ACCESS_KEY_ID / R2_SECRET_ACCESS_KEY")
 
+    # one pool shared by every Streamlit session thread; keep-alive reuses TLS connections
+    config = Config(
+        max_pool_connections=int(os.getenv("R2_MAX_POOL_CONNECTIONS", "32")),
+        tcp_keepalive=True,
+        connect_timeout=float(os.getenv("R2_CONNECT_TIMEOUT_S", "3")),
+        read_timeout=float(os.getenv("R2_READ_TIMEOUT_S", "10")),
+        retries={"max_attempts": int(os.getenv("R2_MAX_ATTEMPTS", "3")), "mode": "standard"},
+    )
+
     # region_name can be anything for R2; "auto" is commonly used
     return boto3.client(
         "s3",
@@ -29,8 +103,30 @@ def _r2_client():
         aws_access_key_id=access,
         aws_secret_access_key=secret,
         region_name="auto",
+        config=config,
     )
 
+_r2_client_lock = threading.Lock()
+_r2_client_cached = None
+_r2_client_env: Optional[tuple] = None
+
+def _r2_client():
+    """
+    Process-wide S3 client. boto3 clients are thread-safe once built, but building one
+    (credential resolution, endpoint/model loading) is slow and not thread-safe, so it
+    happens once under a lock. Rebuilt only if the R2 env changes.
+    """
+    global _r2_client_cached, _r2_client_env
+    env = (os.getenv("R2_ENDPOINT", ""), os.getenv("R2_ACCESS_KEY_ID", ""), os.getenv("R2_SECRET_ACCESS_KEY", ""))
+    client = _r2_client_cached
+    if client is not None and _r2_client_env == env:
+        return client
+    with _r2_client_lock:
+        if _r2_client_cached is None or _r2_client_env != env:
+            _r2_client_cached = _r2_new_client()
+            _r2_client_env = env
+        return _r2_client_cached
+
 def _r2_bucket() -> str:
     b = os.getenv("R2_BUCKET", "").strip()
     if not b:
@@ -52,27 +148,244 @@ def _r2_key_for_path(path: str) -> str:
     # fallback: put under misc/
     return f"misc/{base}"
 
-def _r2_get_json(key: str):
-    import json
+class StorageConflictError(RuntimeError):
+    """
+    A conditional write lost the race: the stored document changed since it was loaded
+    (e.g. the same user submitted from another browser tab). Reload and retry.
+    """
+
+
+# per-document R2 state (etag + content hash at load/last write); never serialized
+_R2_STATE_KEY = "_r2"
+
+def _content_hash(data: Dict[str, Any]) -> str:
+    """
+    Hash of the persisted content, ignoring volatile meta.updated_at and private keys.
+    """
+    doc = dict(_persistable(data))
+    meta = doc.get("meta")
+    if isinstance(meta, dict) and "updated_at" in meta:
+        doc["meta"] = {k: v for k, v in meta.items() if k != "updated_at"}
+    return hashlib.sha256(json_dumps(doc, pretty=False, sort_keys=True)).hexdigest()
+
+def _r2_is_conflict(e: Exception) -> bool:
+    resp = getattr(e, "response", None) or {}
+    code = str((resp.get("Error") or {}).get("Code", ""))
+    status = (resp.get("ResponseMetadata") or {}).get("HTTPStatusCode")
+    return code in ("PreconditionFailed", "ConditionalRequestConflict") or status in (409, 412)
+
+# --- compressed R2 bodies ---
+# RW_R2_COMPRESSION=gzip (default) | zstd | none. zstd needs the optional zstandard
+# package and falls back to gzip without it. The encoding is declared in the object's
+# rw-encoding metadata and Content-Encoding; readers sniff the magic bytes, so legacy
+# plain-JSON objects, and bodies an HTTP layer already decompressed, read unchanged.
+try:
+    import zstandard as _zstd
+except ImportError:
+    _zstd = None
+
+R2_COMPRESSION = os.getenv("RW_R2_COMPRESSION", "gzip").strip().lower()
+R2_COMPRESS_MIN_BYTES = int(os.getenv("R2_COMPRESS_MIN_BYTES", "1024"))
+_GZIP_MAGIC = b"\x1f\x8b"
+_ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+def _r2_encode_body(body: bytes) -> Tuple[bytes, Optional[str]]:
+    """
+    Returns (stored body, encoding); encoding None means plain JSON.
+    """
+    enc = R2_COMPRESSION
+    if enc == "zstd" and _zstd is None:
+        enc = "gzip"
+    if enc not in ("gzip", "zstd") or len(body) < R2_COMPRESS_MIN_BYTES:
+        return body, None
+    if enc == "zstd":
+        return _zstd.ZstdCompressor(level=6).compress(body), "zstd"
+    # mtime=0: identical documents give identical bytes
+    return gzip.compress(body, compresslevel=6, mtime=0), "gzip"
+
+def _r2_decode_body(body: bytes) -> bytes:
+    if body[:2] == _GZIP_MAGIC:
+        return gzip.decompress(body)
+    if body[:4] == _ZSTD_MAGIC:
+        if _zstd is None:
+            raise RuntimeError("R2 object is zstd-compressed but the zstandard package is not installed")
+        return _zstd.ZstdDecompressor().decompress(body)
+    return body
+
+def _r2_parse_body(body: bytes) -> Any:
+    try:
+        raw = _r2_decode_body(body)
+    except (OSError, EOFError) as e:
+        # truncated/corrupt gzip: same treatment as unparsable JSON
+        raise ValueError(str(e)) from e
+    return json_loads(raw)
+
+# --- local read-through cache in front of R2 ---
+# One file per object key under RW_STORAGE_DIR/r2_cache: a JSON header line
+# {"etag", "hash"} followed by the object body as stored (possibly compressed), replaced atomically. The file mtime
+# is the last time the entry was known fresh. Within R2_CACHE_TTL_S reads are served
+# from disk; after that a conditional GET (If-None-Match) revalidates. Our own PUTs
+# write through, so a user's next read after submit never hits the network.
+_R2_CACHE = os.getenv("RW_R2_CACHE", "1").strip().lower() not in ("0", "false", "no", "off")
+R2_CACHE_TTL_S = float(os.getenv("R2_CACHE_TTL_S", "5"))
+
+def _r2_cache_path(key: str) -> str:
+    root = os.path.join(os.getenv("RW_STORAGE_DIR", "/tmp/runningworld"), "r2_cache")
+    return os.path.join(root, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".cache")
+
+def _r2_cache_read(key: str) -> Optional[Tuple[Dict[str, Any], bytes, float]]:
+    """
+    Returns (header, body, age_s) or None.
+    """
+    if not _R2_CACHE:
+        return None
+    path = _r2_cache_path(key)
+    try:
+        with open(path, "rb") as f:
+            header = json_loads(f.readline())
+            body = f.read()
+        age = time.time() - os.path.getmtime(path)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(header, dict):
+        return None
+    return header, body, age
+
+def _r2_cache_write(key: str, body: bytes, etag: Optional[str], content_hash: Optional[str]) -> None:
+    if not _R2_CACHE or not etag:
+        return
+    path = _r2_cache_path(key)
+    try:
+        _ensure_dir(path)
+        fd, tmp_path = tempfile.mkstemp(prefix="rw_", suffix=".tmp", dir=os.path.dirname(path))
+        with os.fdopen(fd, "wb") as f:
+            f.write(json_dumps({"key": key, "etag": etag, "hash": content_hash}, pretty=False) + b"\n")
+            f.write(body)
+        os.replace(tmp_path, path)
+    except OSError:
+        pass
+
+def _r2_cache_touch(key: str) -> None:
+    try:
+        os.utime(_r2_cache_path(key))
+    except OSError:
+        pass
+
+def _r2_cache_drop(key: str) -> None:
+    try:
+        os.remove(_r2_cache_path(key))
+    except OSError:
+        pass
+
+def _r2_get_object(key: str, revalidate: bool = False) -> Tuple[Any, Optional[str], Optional[str]]:
+    """
+    Returns (data, etag, content_hash from object metadata); data is None if missing/unreadable.
+    revalidate=True skips the freshness window (always asks R2, conditionally).
+    """
+    cached = _r2_cache_read(key)
+    if cached is not None:
+        header, body, age = cached
+        if not revalidate and age < R2_CACHE_TTL_S:
+            try:
+                return _r2_parse_body(body), header.get("etag"), header.get("hash")
+            except ValueError:
+                cached = None
+
     s3 = _r2_client()
+    kwargs: Dict[str, Any] = {}
+    if cached is not None and cached[0].get("etag"):
+        kwargs["IfNoneMatch"] = cached[0]["etag"]
     try:
-        obj = s3.get_object(Bucket=_r2_bucket(), Key=key)
-        raw = obj["Body"].read().decode("utf-8")
-        return json.loads(raw)
+        obj = s3.get_object(Bucket=_r2_bucket(), Key=key, **kwargs)
+        body = obj["Body"].read()
     except Exception as e:
+        resp = getattr(e, "response", None) or {}
+        status = (resp.get("ResponseMetadata") or {}).get("HTTPStatusCode")
+        code = str((resp.get("Error") or {}).get("Code", ""))
+        if cached is not None and (status == 304 or code in ("304", "NotModified")):
+            header, body, _ = cached
+            _r2_cache_touch(key)
+            return _r2_parse_body(body), header.get("etag"), header.get("hash")
+        if status == 404 or code in ("NoSuchKey", "404"):
+            _r2_cache_drop(key)
+            return None, None, None
+        if cached is not None:
+            # network trouble: serve the last known body; conditional PUTs still guard writes
+            header, body, _ = cached
+            return _r2_parse_body(body), header.get("etag"), header.get("hash")
         # NoSuchKey / 404 and other errors -> treat as missing
         # boto3 exceptions vary; simplest is to just return None on failure here
-        return None
+        return None, None, None
 
-def _r2_put_json(key: str, data):
-    import json
+    meta = obj.get("Metadata") or {}
+    etag, content_hash = obj.get("ETag"), meta.get("rw-hash")
+    # decoded outside the network try: a zstd object on a host without zstandard must
+    # fail loudly, not read as "missing" and get recreated
+    try:
+        data = _r2_parse_body(body)
+    except ValueError:
+        return None, None, None
+    _r2_cache_write(key, body, etag, content_hash)
+    return data, etag, content_hash
+
+def _r2_get_json(key: str):
+    return _r2_get_object(key)[0]
+
+def _r2_put_json(
+    key: str,
+    data,
+    if_match: Optional[str] = None,
+    if_none_match: bool = False,
+    content_hash: Optional[str] = None,
+) -> Optional[str]:
+    """
+    PUT a JSON object; returns the new ETag.
+    if_match / if_none_match make it a conditional write (optimistic concurrency);
+    a lost race raises StorageConflictError.
+    """
     s3 = _r2_client()
-    body = json.dumps(data, ensure_ascii=False, indent=2).encode("utf-8")
-    s3.put_object(Bucket=_r2_bucket(), Key=key, Body=body, ContentType="application/json; charset=utf-8")
+    if isinstance(data, dict):
+        data = _persistable(data)
+    body, encoding = _r2_encode_body(json_dumps(data))
+    kwargs: Dict[str, Any] = {}
+    if if_match:
+        kwargs["IfMatch"] = if_match
+    elif if_none_match:
+        kwargs["IfNoneMatch"] = "*"
+    metadata: Dict[str, str] = {}
+    if content_hash:
+        metadata["rw-hash"] = content_hash
+    if encoding:
+        metadata["rw-encoding"] = encoding
+        kwargs["ContentEncoding"] = encoding
+    if metadata:
+        kwargs["Metadata"] = metadata
+    try:
+        resp = s3.put_object(
+            Bucket=_r2_bucket(), Key=key, Body=body, ContentType="application/json; charset=utf-8", **kwargs
+        )
+    except Exception as e:
+        if (if_match or if_none_match) and _r2_is_conflict(e):
+            _r2_cache_drop(key)
+            raise StorageConflictError(f"R2 object changed concurrently: {key}") from e
+        raise
+    etag = resp.get("ETag")
+    _r2_cache_write(key, body, etag, content_hash)
+    return etag
+
+def _r2_put_user_doc(key: str, data: Dict[str, Any], etag: Optional[str], create: bool = False) -> None:
+    """
+    Conditional write of a user document; records the new etag/hash on the document.
+    """
+    h = _content_hash(data)
+    new_etag = _r2_put_json(key, data, if_match=etag, if_none_match=create and not etag, content_hash=h)
+    data[_R2_STATE_KEY] = {"etag": new_etag, "hash": h}
+
+CURRENT_SCHEMA_VERSION = 4
 
 DEFAULT_DATA: Dict[str, Any] = {
     "meta": {
-        "schema_version": 3,
+        "schema_version": CURRENT_SCHEMA_VERSION,
         "created_at": "",
         "updated_at": ""
     },
@@ -148,7 +461,7 @@ def _ensure_dir(path: str) -> None:
         os.makedirs(folder, exist_ok=True)
 
 
-def atomic_write_json(path: str, data: Dict[str, Any]) -> None:
+def atomic_write_json(path: str, data: Dict[str, Any], pretty: Optional[bool] = None) -> None:
     """
     Atomic write to avoid file corruption:
     write to temp file -> fsync -> replace.
@@ -157,8 +470,8 @@ def atomic_write_json(path: str, data: Dict[str, Any]) -> None:
     directory = os.path.dirname(path) or "."
     fd, tmp_path = tempfile.mkstemp(prefix="rw_", suffix=".tmp", dir=directory)
     try:
-        with os.fdopen(fd, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        with os.fdopen(fd, "wb") as f:
+            f.write(json_dumps(data, pretty=pretty))
             f.flush()
             os.fsync(f.fileno())
         os.replace(tmp_path, path)
@@ -170,172 +483,1539 @@ def atomic_write_json(path: str, data: Dict[str, Any]) -> None:
             except OSError:
                 pass
 
-import time
+try:
+    import fcntl
+except ImportError:  # non-POSIX: FileLock falls back to an O_EXCL lock file
+    fcntl = None
+
+# lock wait-time metrics per mode, for the whole process (see lock_wait_stats)
+_lock_stats_mu = threading.Lock()
+_LOCK_STATS: Dict[str, Dict[str, float]] = {}
+
+def _lock_record(mode: str, waited_s: float, acquired: bool) -> None:
+    with _lock_stats_mu:
+        st = _LOCK_STATS.setdefault(mode, {"acquired": 0, "timeouts": 0, "contended": 0, "wait_s": 0.0, "max_wait_s": 0.0})
+        st["acquired" if acquired else "timeouts"] += 1
+        if waited_s > 0.001:
+            st["contended"] += 1
+        st["wait_s"] += waited_s
+        st["max_wait_s"] = max(st["max_wait_s"], waited_s)
+
+def lock_wait_stats() -> Dict[str, Dict[str, float]]:
+    """
+    Snapshot of FileLock waits since process start, per mode ("shared"/"exclusive"):
+    acquired, timeouts, contended (had to wait), wait_s (total), max_wait_s.
+    """
+    with _lock_stats_mu:
+        return {mode: dict(st) for mode, st in _LOCK_STATS.items()}
 
 class FileLock:
-    def __init__(self, lock_path: str, timeout_s: float = 8.0, poll_s: float = 0.08):
+    """
+    Inter-process lock on lock_path.
+
+    With fcntl (Linux/macOS) this is flock(2): shared=True takes a reader lock (many
+    holders), the default is exclusive. The kernel releases it when the holder's fd closes,
+    including on crash, so a dead process can never wedge the lock; the lock file itself
+    stays in place (unlinking it would let a waiter lock an orphaned inode). A leftover
+    file from the old O_EXCL scheme is simply reused.
+
+    timeout_s=None blocks in flock until granted; otherwise non-blocking attempts back off
+    from 1 ms up to poll_s, raising TimeoutError after timeout_s.
+
+    Without fcntl: O_EXCL lock file holding "<pid> <hostname> <nonce>", removed on exit;
+    shared is treated as exclusive. The holder refreshes the file's mtime every
+    stale_after_s / 4 from a heartbeat thread, so a long holder (big import, compaction)
+    keeps its lock. A waiter breaks the lock only when its holder is provably gone: same
+    host and the pid no longer exists (POSIX), or no heartbeat for stale_after_s.
+    """
+
+    def __init__(
+        self,
+        lock_path: str,
+        timeout_s: Optional[float] = 8.0,
+        poll_s: float = 0.08,
+        shared: bool = False,
+        stale_after_s: float = 60.0,
+    ):
         self.lock_path = lock_path
         self.timeout_s = timeout_s
         self.poll_s = poll_s
+        self.shared = shared
+        self.stale_after_s = stale_after_s
+        self.waited_s = 0.0
         self._fd = None
+        self._token: Optional[bytes] = None
+        self._heartbeat: Optional[threading.Event] = None
+
+    @property
+    def mode(self) -> str:
+        return "shared" if self.shared else "exclusive"
 
     def __enter__(self):
-        start = time.time()
+        start = time.perf_counter()
+        try:
+            if fcntl is not None:
+                self._acquire_flock(start)
+            else:
+                self._acquire_excl(start)
+        except TimeoutError:
+            self.waited_s = time.perf_counter() - start
+            _lock_record(self.mode, self.waited_s, acquired=False)
+            raise
+        self.waited_s = time.perf_counter() - start
+        _lock_record(self.mode, self.waited_s, acquired=True)
+        return self
+
+    def _acquire_flock(self, start: float) -> None:
+        _ensure_dir(self.lock_path)
+        fd = os.open(self.lock_path, os.O_CREAT | os.O_RDWR, 0o644)
+        op = fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX
+        try:
+            if self.timeout_s is None:
+                fcntl.flock(fd, op)
+            else:
+                delay = 0.001
+                while True:
+                    try:
+                        fcntl.flock(fd, op | fcntl.LOCK_NB)
+                        break
+                    except BlockingIOError:
+                        left = self.timeout_s - (time.perf_counter() - start)
+                        if left <= 0:
+                            raise TimeoutError(f"Could not acquire lock: {self.lock_path}")
+                        time.sleep(min(delay, left))
+                        delay = min(delay * 2, self.poll_s)
+        except BaseException:
+            os.close(fd)
+            raise
+        self._fd = fd
+
+    def _acquire_excl(self, start: float) -> None:
+        _ensure_dir(self.lock_path)
+        token = f"{os.getpid()} {socket.gethostname()} {uuid.uuid4().hex}".encode("utf-8")
         while True:
             try:
                 # O_EXCL: atomic create -> only one winner
-                self._fd = os.open(self.lock_path, os.O_CREAT | os.O_EXCL | os.O_RDWR)
-                os.write(self._fd, str(os.getpid()).encode("utf-8"))
-                return self
+                fd = os.open(self.lock_path, os.O_CREAT | os.O_EXCL | os.O_RDWR)
             except FileExistsError:
-                if time.time() - start > self.timeout_s:
+                if self._break_if_abandoned():
+                    continue
+                if self.timeout_s is not None and time.perf_counter() - start > self.timeout_s:
                     raise TimeoutError(f"Could not acquire lock: {self.lock_path}")
                 time.sleep(self.poll_s)
+                continue
+            os.write(fd, token)
+            self._fd, self._token = fd, token
+            self._start_heartbeat()
+            return
+
+    def _read_token(self, path: str) -> Optional[bytes]:
+        try:
+            with open(path, "rb") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    @staticmethod
+    def _holder_gone(token: bytes) -> bool:
+        # only decidable for a holder on this host, and only where kill(pid, 0) is a probe
+        parts = token.decode("utf-8", "replace").split()
+        if os.name != "posix" or len(parts) < 2 or parts[1] != socket.gethostname():
+            return False
+        try:
+            os.kill(int(parts[0]), 0)
+        except ProcessLookupError:
+            return True
+        except (PermissionError, ValueError):
+            return False
+        return False
+
+    def _break_if_abandoned(self) -> bool:
+        """
+        Remove the lock file if its holder is gone. True if the caller should retry now.
+        """
+        token = self._read_token(self.lock_path)
+        if token is None:
+            return True  # released in between
+        try:
+            idle_s = time.time() - os.path.getmtime(self.lock_path)
+        except OSError:
+            return True
+        if not token:
+            # created but not written yet: give the holder a moment before calling it dead
+            abandoned = idle_s > self.stale_after_s
+        else:
+            abandoned = self._holder_gone(token) or idle_s > self.stale_after_s
+        if not abandoned:
+            return False
+        # move it aside first, then check we moved the file we judged (not a new holder's)
+        aside = f"{self.lock_path}.stale.{uuid.uuid4().hex}"
+        try:
+            os.rename(self.lock_path, aside)
+        except OSError:
+            return True
+        if self._read_token(aside) != token:
+            try:
+                os.link(aside, self.lock_path)  # fails if someone re-created it meanwhile
+            except OSError:
+                pass
+        try:
+            os.remove(aside)
+        except OSError:
+            pass
+        return True
+
+    def _start_heartbeat(self) -> None:
+        stop = threading.Event()
+        interval = max(self.stale_after_s / 4.0, 0.05)
+        path, token = self.lock_path, self._token
+
+        def beat():
+            while not stop.wait(interval):
+                if self._read_token(path) != token:
+                    return  # no longer ours
+                try:
+                    os.utime(path)
+                except OSError:
+                    return
+
+        threading.Thread(target=beat, name="rw-lock-heartbeat", daemon=True).start()
+        self._heartbeat = stop
 
     def __exit__(self, exc_type, exc, tb):
+        fd, self._fd = self._fd, None
+        if self._heartbeat is not None:
+            self._heartbeat.set()
+            self._heartbeat = None
         try:
-            if self._fd is not None:
-                os.close(self._fd)
-            if os.path.exists(self.lock_path):
-                os.remove(self.lock_path)
+            if fd is not None:
+                os.close(fd)  # closing the fd drops the flock
+                if fcntl is None and self._read_token(self.lock_path) == self._token:
+                    os.remove(self.lock_path)
         except Exception:
             # Avoid masking original errors
             pass
         return False
 
+# --- Columnar in-memory history ---
+# While a document is loaded, data["history"] is a History: parallel arrays instead of a
+# list of dicts, turned back into the usual list of dicts only when written (_persistable).
+#   date  -> day ordinal, array('i')   (0 = missing / not YYYY-MM-DD; raw value kept aside)
+#   km    -> array('d')
+#   route -> array('i')                (>= 0: interned route id, < 0: interned broadcast set)
+#   note and any other keys -> sparse side tables keyed by row id (most runs have neither)
+# Every row has a stable, increasing row id (array('q')); the history index refers to rows
+# by id and a row's position is one bisect away. Legacy callers iterating data["history"]
+# get dict-like _RunView objects.
+try:
+    import numpy as _np  # optional: vectorised per-route sums for long histories
+except ImportError:
+    _np = None
+
+_HISTORY_KEYS = frozenset(("date", "km", "route_id", "route_ids", "note"))
+_MISSING = object()
+_ISO_BY_ORDINAL: Dict[int, str] = {}
+_ORDINAL_BY_ISO: Dict[str, int] = {}
+
+
+def _day_ordinal(value: Any) -> int:
+    o = _ORDINAL_BY_ISO.get(value) if isinstance(value, str) else None
+    if o is not None:
+        return o
+    if isinstance(value, str) and len(value) == 10 and value[4] == "-":
+        try:
+            o = date.fromisoformat(value).toordinal()
+        except ValueError:
+            return 0
+        _ORDINAL_BY_ISO[value] = o
+        return o
+    return 0
+
+
+def _ordinal_iso(o: int) -> str:
+    s = _ISO_BY_ORDINAL.get(o)
+    if s is None:
+        s = _ISO_BY_ORDINAL[o] = date.fromordinal(o).isoformat()
+    return s
+
+
+def _record_km(rec: Any) -> float:
+    """
+    km of a stored history record. A null, non-numeric or non-finite km is read as 0 and
+    logged, so one bad record cannot make the document unloadable.
+    """
+    v = rec.get("km", 0.0)
+    if v is None:
+        return 0.0
+    try:
+        km = float(v)
+    except (TypeError, ValueError):
+        km = math.nan
+    if not math.isfinite(km):
+        _log.warning("history record %s has an unusable km %r; reading it as 0", rec.get("date"), v)
+        return 0.0
+    return km
+
+
+class History:
+    """
+    Columnar run history (see the section comment above). Rows are addressed by row id.
+    """
+
+    def __init__(self, records: Any = ()):
+        self._ids = array("q")
+        self._date = array("i")
+        self._km = array("d")
+        self._route = array("i")
+        self._notes: Dict[int, str] = {}
+        self._odd_dates: Dict[int, Any] = {}
+        self._extra: Dict[int, Dict[str, Any]] = {}
+        self._routes: List[Any] = []
+        self._route_code: Dict[Any, int] = {}
+        self._sets: List[Tuple[Any, ...]] = []
+        self._set_code: Dict[Tuple[Any, ...], int] = {}
+        self._next_id = 1
+        self._extend(records)
+
+    def _extend(self, records: Any) -> None:
+        """
+        Bulk append (the load path): same as append() per record, with the common
+        plain {date, km, route_id, note} shape handled inline.
+        """
+        ids, dates, kms, routes = self._ids, self._date, self._km, self._route
+        code_of = self._route_code
+        row = self._next_id
+        for rec in records:
+            if not isinstance(rec, dict) or not rec.keys() <= _HISTORY_KEYS or "route_ids" in rec:
+                if isinstance(rec, (dict, _RunView)):
+                    self._next_id = row
+                    self.append(rec)
+                    row = self._next_id
+                continue
+            d = rec.get("date")
+            o = _day_ordinal(d)
+            if not o:
+                self._odd_dates[row] = d
+            c = code_of.get(rec.get("route_id"))
+            if c is None:
+                c = self._code(rec.get("route_id"))
+            ids.append(row)
+            dates.append(o)
+            kms.append(_record_km(rec))
+            routes.append(c)
+            note = rec.get("note")
+            if note:
+                self._notes[row] = note
+            row += 1
+        self._next_id = row
+
+    # -- encoding --
+    def _code(self, route_id: Any = None, route_ids: Optional[List[Any]] = None) -> int:
+        if route_ids is not None:
+            key = tuple(route_ids)
+            c = self._set_code.get(key)
+            if c is None:
+                self._sets.append(key)
+                c = self._set_code[key] = -len(self._sets)
+            return c
+        c = self._route_code.get(route_id)
+        if c is None:
+            self._routes.append(route_id)
+            c = self._route_code[route_id] = len(self._routes) - 1
+        return c
+
+    def _pos(self, row: int) -> int:
+        i = bisect.bisect_left(self._ids, row)
+        if i == len(self._ids) or self._ids[i] != row:
+            raise KeyError(row)
+        return i
+
+    # -- rows --
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def __iter__(self):
+        for row in list(self._ids):
+            yield _RunView(self, row)
+
+    def __getitem__(self, i: Any) -> Any:
+        if isinstance(i, slice):
+            return [_RunView(self, row) for row in self._ids[i]]
+        return _RunView(self, self._ids[i])
+
+    def row_ids(self) -> List[int]:
+        return list(self._ids)
+
+    def append(self, rec: Any) -> int:
+        """
+        Append one record (dict with date/km/route_id|route_ids/note/...). Returns its row id.
+        """
+        row = self._next_id
+        self._next_id += 1
+        d = rec.get("date")
+        o = _day_ordinal(d)
+        if not o:
+            self._odd_dates[row] = d
+        rids = rec.get("route_ids")
+        self._ids.append(row)
+        self._date.append(o)
+        self._km.append(_record_km(rec))
+        if isinstance(rids, (list, tuple)):
+            self._route.append(self._code(route_ids=list(rids)))
+        else:
+            self._route.append(self._code(rec.get("route_id")))
+        note = rec.get("note")
+        if note:
+            self._notes[row] = note
+        extra = {k: v for k, v in rec.items() if k not in _HISTORY_KEYS}
+        if extra:
+            self._extra[row] = extra
+        return row
+
+    def remove_rows(self, rows: List[int]) -> None:
+        for i in sorted((self._pos(r) for r in set(rows)), reverse=True):
+            row = self._ids[i]
+            for col in (self._ids, self._date, self._km, self._route):
+                del col[i]
+            self._notes.pop(row, None)
+            self._odd_dates.pop(row, None)
+            self._extra.pop(row, None)
+
+    # -- fields --
+    def date_of(self, row: int, i: Optional[int] = None) -> Any:
+        o = self._date[self._pos(row) if i is None else i]
+        return _ordinal_iso(o) if o else self._odd_dates.get(row)
+
+    def km_of(self, row: int) -> float:
+        return self._km[self._pos(row)]
+
+    def routes(self, row: int) -> List[Any]:
+        """
+        Routes the row credits (see history_routes()).
+        """
+        c = self._route[self._pos(row)]
+        return list(self._sets[-c - 1]) if c < 0 else [self._routes[c]]
+
+    def route_set(self, row: int) -> Optional[Tuple[Any, ...]]:
+        """
+        The broadcast route set of a row, or None for a plain single-route row.
+        """
+        c = self._route[self._pos(row)]
+        return self._sets[-c - 1] if c < 0 else None
+
+    def get(self, row: int, key: str, default: Any = None) -> Any:
+        i = self._pos(row)
+        if key == "date":
+            return self.date_of(row, i)
+        if key == "km":
+            return self._km[i]
+        if key == "route_id":
+            c = self._route[i]
+            return self._routes[c] if c >= 0 else default
+        if key == "route_ids":
+            c = self._route[i]
+            return list(self._sets[-c - 1]) if c < 0 else default
+        if key == "note":
+            return self._notes.get(row, "")
+        return self._extra.get(row, {}).get(key, default)
+
+    def set(self, row: int, key: str, value: Any) -> None:
+        i = self._pos(row)
+        if key == "date":
+            o = _day_ordinal(value)
+            self._date[i] = o
+            if o:
+                self._odd_dates.pop(row, None)
+            else:
+                self._odd_dates[row] = value
+        elif key == "km":
+            self._km[i] = float(value)
+        elif key == "route_id":
+            self._route[i] = self._code(value)
+        elif key == "route_ids":
+            self._route[i] = self._code(route_ids=list(value))
+        elif key == "note":
+            if value:
+                self._notes[row] = value
+            else:
+                self._notes.pop(row, None)
+        else:
+            self._extra.setdefault(row, {})[key] = value
+
+    def keys_of(self, row: int) -> List[str]:
+        c = self._route[self._pos(row)]
+        return ["date", "km", "route_ids" if c < 0 else "route_id", "note"] + list(self._extra.get(row, {}))
+
+    def record(self, row: int, i: Optional[int] = None) -> Dict[str, Any]:
+        """
+        The row as a plain history dict (the persisted form).
+        """
+        if i is None:
+            i = self._pos(row)
+        o = self._date[i]
+        rec: Dict[str, Any] = {"date": _ordinal_iso(o) if o else self._odd_dates.get(row), "km": self._km[i]}
+        c = self._route[i]
+        if c < 0:
+            rec["route_ids"] = list(self._sets[-c - 1])
+        else:
+            rec["route_id"] = self._routes[c]
+        rec["note"] = self._notes.get(row, "")
+        extra = self._extra.get(row)
+        if extra:
+            rec.update(extra)
+        return rec
+
+    def to_list(self) -> List[Dict[str, Any]]:
+        return [self.record(row, i) for i, row in enumerate(self._ids)]
+
+    def index_rows(self):
+        """
+        (row id, date, credited routes) for every row: one tight pass for index builds.
+        """
+        odd = self._odd_dates
+        for row, o, c in zip(self._ids, self._date, self._route):
+            d = _ordinal_iso(o) if o else odd.get(row)
+            yield row, d, (self._sets[-c - 1] if c < 0 else (self._routes[c],))
+
+    # -- aggregates --
+    def route_totals(self, start: Optional[str] = None, end: Optional[str] = None) -> Dict[Any, float]:
+        """
+        km per route (broadcast rows credit every listed route), optionally limited to
+        start <= date <= end (YYYY-MM-DD). Uses NumPy when it is installed.
+        """
+        lo = _day_ordinal(start) if start else None
+        hi = _day_ordinal(end) if end else None
+        by_code: Dict[int, float] = {}
+        if _np is not None and len(self._ids):
+            codes = _np.frombuffer(self._route, dtype="i")
+            kms = _np.frombuffer(self._km, dtype="d")
+            if lo is not None or hi is not None:
+                days = _np.frombuffer(self._date, dtype="i")
+                mask = days > 0
+                if lo is not None:
+                    mask &= days >= lo
+                if hi is not None:
+                    mask &= days <= hi
+                codes, kms = codes[mask], kms[mask]
+            off = len(self._sets)
+            sums = _np.bincount(codes + off, weights=kms, minlength=off + len(self._routes))
+            for j in _np.flatnonzero(_np.bincount(codes + off, minlength=off + len(self._routes))):
+                by_code[int(j) - off] = float(sums[j])
+        elif lo is None and hi is None:
+            for c, km in zip(self._route, self._km):
+                by_code[c] = by_code.get(c, 0.0) + km
+        else:
+            for o, c, km in zip(self._date, self._route, self._km):
+                if o and (lo is None or o >= lo) and (hi is None or o <= hi):
+                    by_code[c] = by_code.get(c, 0.0) + km
+        out: Dict[Any, float] = {}
+        for c, km in by_code.items():
+            for rid in (self._sets[-c - 1] if c < 0 else (self._routes[c],)):
+                out[rid] = out.get(rid, 0.0) + km
+        return out
+
+
+class _RunView(MutableMapping):
+    """
+    Dict-compatible view of one History row, for code written against list-of-dicts history.
+    """
+
+    __slots__ = ("_h", "_row")
+
+    def __init__(self, history: History, row: int):
+        self._h, self._row = history, row
+
+    @property
+    def row_id(self) -> int:
+        return self._row
+
+    def __getitem__(self, key: str) -> Any:
+        v = self._h.get(self._row, key, _MISSING)
+        if v is _MISSING:
+            raise KeyError(key)
+        return v
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        self._h.set(self._row, key, value)
+
+    def __delitem__(self, key: str) -> None:
+        if key == "note":
+            self._h.set(self._row, "note", "")
+        elif key in self._h._extra.get(self._row, {}):
+            del self._h._extra[self._row][key]
+        else:
+            raise KeyError(key)
+
+    def __iter__(self):
+        return iter(self._h.keys_of(self._row))
+
+    def __len__(self) -> int:
+        return len(self._h.keys_of(self._row))
+
+    def __repr__(self) -> str:
+        return repr(self._h.record(self._row))
+
+
+def _as_history(data: Dict[str, Any]) -> History:
+    """
+    data["history"] as a History, converting a plain list (fresh from JSON/SQL) in place.
+    """
+    h = data.get("history")
+    if not isinstance(h, History):
+        h = History(h or [])
+        data["history"] = h
+    return h
+
+
+# --- History ops + append-only journal (local backend) ---
+# Every history mutation is expressed as a small op dict and applied through
+# _apply_history_op, both live (add_run_km / undo_run_km / delete_runs_by_date ...)
+# and when replaying the journal. With RW_STORAGE_JOURNAL=1, save_data appends
+# {"seq", "ops", <non-history top-level keys>} to run_data_<id>.journal.jsonl instead
+# of rewriting the whole document; compaction folds the journal back into the snapshot.
+_JOURNAL = os.getenv("RW_STORAGE_JOURNAL", "0").strip().lower() in ("1", "true", "yes", "on")
+JOURNAL_MAX_ENTRIES = int(os.getenv("RW_JOURNAL_MAX_ENTRIES", "200"))
+JOURNAL_MAX_BYTES = int(os.getenv("RW_JOURNAL_MAX_BYTES", str(256 * 1024)))
+
+# pending ops live on the in-memory document until save_data consumes them
+_PENDING_OPS_KEY = "_journal"
+
+
+def _journal_enabled() -> bool:
+    return _JOURNAL and not _is_r2() and not _is_sqlite()
+
+
+def _journal_path(path: str) -> str:
+    return os.path.splitext(path)[0] + ".journal.jsonl"
+
+
+def _record_op(data: Dict[str, Any], op: Dict[str, Any]) -> None:
+    data.setdefault(_PENDING_OPS_KEY, []).append(op)
+
+
+def mark_history_rewritten(data: Dict[str, Any]) -> None:
+    """
+    Callers that replace data["history"] wholesale must call this so the next save
+    writes a full snapshot instead of a journal append.
+    """
+    _record_op(data, {"op": "reset"})
+    rebuild_aggregates(data)
+
+
+def _unlink_broadcast(history: History, row: int, rid: Any, idx: "_HistoryIndex") -> List[Tuple[Any, Any, float, int, int]]:
+    """
+    Take one route out of a broadcast row (in place). Down to one route, the row
+    becomes a plain record again.
+    """
+    rest = [r for r in history.routes(row) if r != rid]
+    change = (history.date_of(row), rid, -history.km_of(row)) + idx.unlink(row, rid)
+    if len(rest) == 1:
+        history.set(row, "route_id", rest[0])
+    else:
+        history.set(row, "route_ids", rest)
+    return [change]
+
+
+def _apply_history_op(history: History, op: Dict[str, Any], idx: "_HistoryIndex") -> List[Tuple[Any, Any, float, int, int]]:
+    """
+    Apply one op to the history in place, keeping `idx` in sync.
+    Record lookups go through the (date, route_id) index instead of scanning history.
+    Returns the per-route changes as (date, route_id, km_delta, date_transition,
+    route_date_transition), which is all the incremental aggregates need.
+
+    An "add" op carries either "route_id" or "route_ids" (one broadcast record for all
+    of them). undo/delete/clear_route address single routes; when they hit a broadcast
+    record only that route is taken out of it.
+    """
+    kind = op.get("op")
+    if kind == "add":
+        run_date, km, note = op["date"], float(op["km"]), op.get("note", "")
+        rids = op.get("route_ids")
+        want = tuple(sorted(set(rids))) if rids is not None else None
+        if op.get("mode", "merge") == "merge":
+            # merge into the first same-date record for the same route(s)
+            for row in idx.records(run_date, want[0] if want else op["route_id"]):
+                if history.route_set(row) == want:
+                    old = history.km_of(row)
+                    new = round(old + km, 3)
+                    history.set(row, "km", new)
+                    if note:
+                        history.set(row, "note", note)
+                    return [(run_date, rid, new - old, 0, 0) for rid in history.routes(row)]
+        rec: Dict[str, Any] = {"date": run_date, "km": round(km, 3)}
+        if want is not None:
+            rec["route_ids"] = list(want)
+        else:
+            rec["route_id"] = op["route_id"]
+        rec["note"] = note
+        row = history.append(rec)
+        return [(run_date, rid, rec["km"], dt, rt) for rid, dt, rt in idx.add(row)]
+    if kind == "undo":
+        # subtract from the latest record of that date+route; drop it when it reaches 0
+        route_id = op["route_id"]
+        rows = idx.records(op["date"], route_id)
+        if not rows:
+            return []
+        row = rows[-1]
+        d, old = history.date_of(row), history.km_of(row)
+        new_km = old - float(op["km"])
+        if history.route_set(row) is not None:
+            # split this route off the broadcast record, keep the remainder as its own run
+            changes = _unlink_broadcast(history, row, route_id, idx)
+            if new_km > 1e-9:
+                rest = history.append({"date": d, "km": round(new_km, 3), "route_id": route_id, "note": history.get(row, "note")})
+                changes += [(d, route_id, round(new_km, 3), dt, rt) for _, dt, rt in idx.add(rest)]
+            return changes
+        if new_km > 1e-9:
+            history.set(row, "km", round(new_km, 3))
+            return [(d, route_id, round(new_km, 3) - old, 0, 0)]
+        changes = [(d, rid, -old, dt, rt) for rid, dt, rt in idx.remove(row)]
+        history.remove_rows([row])
+        return changes
+    if kind == "delete":
+        day = idx.by_date.get(op["date"], {})
+        route_id = op.get("route_id")
+        if route_id is None:
+            # every record of the day, broadcast ones once
+            hits, only = list(dict.fromkeys(r for rows in day.values() for r in rows)), None
+        else:
+            hits, only = list(day.get(route_id, [])), route_id
+    elif kind == "clear_route":
+        only = op["route_id"]
+        hits = [r for d in list(idx.route_dates.get(only, [])) for r in idx.records(d, only)]
+    else:
+        raise ValueError(f"unknown history op: {kind!r}")
+    changes: List[Tuple[Any, Any, float, int, int]] = []
+    removed = []
+    for row in hits:
+        if only is not None and history.route_set(row) is not None:
+            changes += _unlink_broadcast(history, row, only, idx)
+        else:
+            removed.append(row)
+    for row in removed:
+        d, km = history.date_of(row), -history.km_of(row)
+        changes += [(d, rid, km, dt, rt) for rid, dt, rt in idx.remove(row)]
+    history.remove_rows(removed)
+    return changes
+
+
+def _read_journal(jpath: str) -> List[Dict[str, Any]]:
+    """
+    Read journal records. A torn last line (crash mid-append) is ignored, so replay
+    always lands on the last fully written state.
+    """
+    records: List[Dict[str, Any]] = []
+    try:
+        with open(jpath, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    rec = json_loads(line)
+                except ValueError:
+                    break
+                if isinstance(rec, dict) and isinstance(rec.get("seq"), int):
+                    records.append(rec)
+    except FileNotFoundError:
+        pass
+    return records
+
+
+def _replay_journal(path: str, data: Dict[str, Any]) -> bool:
+    """
+    Apply journal records newer than the snapshot onto `data` in place.
+    Returns True if anything was replayed.
+    """
+    records = _read_journal(_journal_path(path))
+    if not records:
+        return False
+    meta = data.setdefault("meta", {})
+    seq = int(meta.get("journal_seq") or 0)
+    history = _as_history(data)
+    idx: Optional[_HistoryIndex] = None
+    replayed = False
+    for rec in records:
+        if rec["seq"] <= seq:
+            continue  # already folded into the snapshot
+        for op in rec.get("ops") or []:
+            if op.get("op") != "reset":
+                if idx is None:
+                    idx = _HistoryIndex(history)
+                _apply_history_op(history, op, idx)
+        for k, v in rec.items():
+            if k not in ("seq", "ops", "history"):
+                data[k] = v
+        seq = rec["seq"]
+        replayed = True
+    data.setdefault("meta", {})["journal_seq"] = seq
+    return replayed
+
+
+def _write_local_snapshot(path: str, data: Dict[str, Any]) -> None:
+    """
+    Full snapshot write; folds (and removes) any journal. The snapshot records the last
+    folded seq first, so a crash between replace and unlink never double-applies ops.
+    """
+    meta = data.setdefault("meta", {})
+    if "journal_seq" in meta:
+        meta["snapshot_seq"] = int(meta.get("journal_seq") or 0)
+    atomic_write_json(path, _persistable(data))
+    jpath = _journal_path(path)
+    if os.path.exists(jpath):
+        # keep a seq marker (instead of deleting) so later appends from a stale
+        # in-memory document still pick a seq above the snapshot
+        seq = max(int(meta.get("journal_seq") or 0), _journal_last_seq(jpath))
+        fd, tmp_path = tempfile.mkstemp(prefix="rw_", suffix=".tmp", dir=os.path.dirname(jpath) or ".")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(json_dumps({"seq": seq, "ops": []}, pretty=False) + b"\n")
+            os.replace(tmp_path, jpath)
+        finally:
+            if os.path.exists(tmp_path):
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+
+
+def _journal_last_seq(jpath: str) -> int:
+    """
+    Highest seq in the journal, read from the file tail (no full scan).
+    """
+    try:
+        with open(jpath, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            f.seek(max(0, size - 16384))
+            tail = f.read().decode("utf-8", errors="ignore")
+    except OSError:
+        return 0
+    for line in reversed(tail.splitlines()):
+        try:
+            rec = json_loads(line)
+        except ValueError:
+            continue
+        if isinstance(rec, dict) and isinstance(rec.get("seq"), int):
+            return rec["seq"]
+    recs = _read_journal(jpath) if size > 16384 else []
+    return recs[-1]["seq"] if recs else 0
+
+
+def _append_journal(path: str, data: Dict[str, Any], ops: List[Dict[str, Any]]) -> None:
+    meta = data.setdefault("meta", {})
+    jpath = _journal_path(path)
+    # the file is the authority: another tab (or a write-behind copy) may have appended already
+    seq = max(int(meta.get("journal_seq") or 0), _journal_last_seq(jpath)) + 1
+    meta["journal_seq"] = seq
+    rec: Dict[str, Any] = {"seq": seq, "ops": ops}
+    rec.update(_persistable(data, history=False))
+    line = json_dumps(rec, pretty=False) + b"\n"
+    _ensure_dir(jpath)
+    with open(jpath, "ab") as f:
+        f.write(line)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _journal_needs_compaction(path: str, data: Dict[str, Any]) -> bool:
+    meta = data.get("meta") or {}
+    pending = int(meta.get("journal_seq") or 0) - int(meta.get("snapshot_seq") or 0)
+    if pending >= JOURNAL_MAX_ENTRIES:
+        return True
+    try:
+        return os.path.getsize(_journal_path(path)) >= JOURNAL_MAX_BYTES
+    except OSError:
+        return False
+
+
+def compact_journal(path: str) -> bool:
+    """
+    Fold a user's journal into the snapshot (local backend). Returns True if there was
+    anything to fold.
+    """
+    # real records carry the document state; a bare {"seq", "ops": []} is the compaction marker
+    if not any("meta" in rec for rec in _read_journal(_journal_path(path))):
+        return False
+    data = load_data(path)
+    data.pop(_PENDING_OPS_KEY, None)
+    _write_local_snapshot(path, data)
+    return True
+
+# --- SQLite backend (RW_STORAGE_BACKEND=sqlite) ---
+# One database (WAL) per storage dir, next to where the JSON files would live, or
+# RW_SQLITE_PATH. Tables:
+#   profile(user_id PK, doc)                      -> the user document minus history
+#   history(seq PK, user_id, route_id, date, ...)  -> one row per history record, seq keeps list order
+#   invites(code PK, status, rec)                 -> one row per invite code
+#   invite_counts(status PK, n)                   -> per-status totals, kept by triggers
+# save_data mirrors the pending history ops as targeted statements, so a submit is an
+# indexed UPDATE/INSERT instead of a whole-document rewrite.
+_SQLITE_FILENAME = "runningworld.sqlite3"
+_sqlite_local = threading.local()
+
+_SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS profile (
+    user_id    TEXT PRIMARY KEY,
+    doc        TEXT NOT NULL,
+    updated_at TEXT
+);
+CREATE TABLE IF NOT EXISTS history (
+    seq      INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id  TEXT NOT NULL,
+    route_id TEXT,
+    date     TEXT,
+    km       REAL NOT NULL DEFAULT 0,
+    note     TEXT NOT NULL DEFAULT '',
+    extra    TEXT
+);
+CREATE INDEX IF NOT EXISTS ix_history_user_route_date ON history(user_id, route_id, date);
+CREATE INDEX IF NOT EXISTS ix_history_user_date ON history(user_id, date);
+CREATE TABLE IF NOT EXISTS invites (
+    code   TEXT PRIMARY KEY,
+    status TEXT,
+    rec    TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_invites_status ON invites(status);
+CREATE TABLE IF NOT EXISTS invite_counts (
+    status TEXT PRIMARY KEY,
+    n      INTEGER NOT NULL DEFAULT 0
+);
+CREATE TRIGGER IF NOT EXISTS tr_invites_ins AFTER INSERT ON invites BEGIN
+    INSERT OR IGNORE INTO invite_counts(status, n) VALUES (COALESCE(NEW.status, ''), 0);
+    UPDATE invite_counts SET n = n + 1 WHERE status = COALESCE(NEW.status, '');
+END;
+CREATE TRIGGER IF NOT EXISTS tr_invites_del AFTER DELETE ON invites BEGIN
+    UPDATE invite_counts SET n = n - 1 WHERE status = COALESCE(OLD.status, '');
+END;
+CREATE TRIGGER IF NOT EXISTS tr_invites_upd AFTER UPDATE OF status ON invites
+WHEN COALESCE(OLD.status, '') <> COALESCE(NEW.status, '') BEGIN
+    UPDATE invite_counts SET n = n - 1 WHERE status = COALESCE(OLD.status, '');
+    INSERT OR IGNORE INTO invite_counts(status, n) VALUES (COALESCE(NEW.status, ''), 0);
+    UPDATE invite_counts SET n = n + 1 WHERE status = COALESCE(NEW.status, '');
+END;
+"""
+
+
+def _sqlite_path_for(path: str) -> str:
+    p = os.getenv("RW_SQLITE_PATH", "").strip()
+    if p:
+        return p
+    return os.path.join(os.path.dirname(path) or ".", _SQLITE_FILENAME)
+
+
+def _sqlite_conn(path: str) -> sqlite3.Connection:
+    """
+    Per-thread connection cache (Streamlit runs each session in its own thread).
+    """
+    db_path = _sqlite_path_for(path)
+    conns = getattr(_sqlite_local, "conns", None)
+    if conns is None:
+        conns = _sqlite_local.conns = {}
+    conn = conns.get(db_path)
+    if conn is None:
+        _ensure_dir(db_path)
+        conn = sqlite3.connect(db_path, timeout=10.0, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(_SQLITE_SCHEMA)
+        if conn.execute("SELECT 1 FROM invite_counts LIMIT 1").fetchone() is None:
+            # invites written before the counters existed
+            conn.execute(
+                "INSERT OR IGNORE INTO invite_counts(status, n) "
+                "SELECT COALESCE(status, ''), COUNT(*) FROM invites GROUP BY COALESCE(status, '')"
+            )
+        conns[db_path] = conn
+    return conn
+
+
+def _user_id_for_path(path: str) -> str:
+    base = os.path.basename(path)
+    if base.startswith("run_data_") and base.endswith(".json"):
+        return base[len("run_data_") : -len(".json")]
+    return os.path.splitext(base)[0]
+
+
+_HISTORY_COLUMNS = ("date", "km", "route_id", "note")
+
+
+def _sqlite_history_row(user_id: str, h: Dict[str, Any]) -> tuple:
+    extra = {k: v for k, v in h.items() if k not in _HISTORY_COLUMNS}
+    return (
+        user_id,
+        h.get("route_id"),
+        h.get("date"),
+        float(h.get("km", 0.0)),
+        h.get("note", "") or "",
+        json.dumps(extra, ensure_ascii=False) if extra else None,
+    )
+
+
+def _sqlite_load_doc(path: str) -> Optional[Dict[str, Any]]:
+    conn = _sqlite_conn(path)
+    user_id = _user_id_for_path(path)
+    row = conn.execute("SELECT doc FROM profile WHERE user_id = ?", (user_id,)).fetchone()
+    if row is None:
+        return None
+    try:
+        data = json_loads(row[0])
+    except ValueError:
+        return None
+    if not isinstance(data, dict):
+        return None
+    history = []
+    for route_id, d, km, note, extra in conn.execute(
+        "SELECT route_id, date, km, note, extra FROM history WHERE user_id = ? ORDER BY seq",
+        (user_id,),
+    ):
+        h = {"date": d, "km": km, "route_id": route_id, "note": note}
+        if extra:
+            h.update(json.loads(extra))
+            if route_id is None and "route_ids" in h:
+                del h["route_id"]  # broadcast record
+        history.append(h)
+    data["history"] = history
+    return data
+
+
+def _sqlite_broadcast_rows(conn: sqlite3.Connection, user_id: str, run_date: Optional[str] = None) -> List[tuple]:
+    """
+    Broadcast history rows (route_id NULL, route_ids in extra) as (seq, km, note, extra).
+    """
+    sql = "SELECT seq, km, note, extra FROM history WHERE user_id = ? AND route_id IS NULL"
+    args: tuple = (user_id,)
+    if run_date is not None:
+        sql += " AND date = ?"
+        args += (run_date,)
+    out = []
+    for seq, km, note, extra in conn.execute(sql + " ORDER BY seq", args):
+        extra = json.loads(extra) if extra else {}
+        if isinstance(extra.get("route_ids"), list):
+            out.append((seq, km, note, extra))
+    return out
+
+
+def _sqlite_unlink_broadcast(conn: sqlite3.Connection, seq: int, extra: Dict[str, Any], route_id: str) -> None:
+    rest = [r for r in extra["route_ids"] if r != route_id]
+    if len(rest) == 1:
+        extra = {k: v for k, v in extra.items() if k != "route_ids"}
+        conn.execute(
+            "UPDATE history SET route_id = ?, extra = ? WHERE seq = ?",
+            (rest[0], json.dumps(extra, ensure_ascii=False) if extra else None, seq),
+        )
+    else:
+        extra = dict(extra, route_ids=rest)
+        conn.execute("UPDATE history SET extra = ? WHERE seq = ?", (json.dumps(extra, ensure_ascii=False), seq))
+
+
+def _sqlite_apply_op(conn: sqlite3.Connection, user_id: str, op: Dict[str, Any]) -> None:
+    """
+    SQL mirror of _apply_history_op (same semantics, seq order == list order).
+    """
+    kind = op.get("op")
+    if kind == "add" and op.get("route_ids") is not None:
+        km, note = float(op["km"]), op.get("note", "")
+        rids = sorted(set(op["route_ids"]))
+        if op.get("mode", "merge") == "merge":
+            for seq, old_km, old_note, extra in _sqlite_broadcast_rows(conn, user_id, op["date"]):
+                if extra["route_ids"] == rids:
+                    conn.execute(
+                        "UPDATE history SET km = ?, note = ? WHERE seq = ?",
+                        (round(float(old_km) + km, 3), old_note if not note else note, seq),
+                    )
+                    return
+        conn.execute(
+            "INSERT INTO history(user_id, route_id, date, km, note, extra) VALUES (?, NULL, ?, ?, ?, ?)",
+            (user_id, op["date"], round(km, 3), note, json.dumps({"route_ids": rids}, ensure_ascii=False)),
+        )
+    elif kind == "add":
+        km, note = float(op["km"]), op.get("note", "")
+        if op.get("mode", "merge") == "merge":
+            row = conn.execute(
+                "SELECT seq, km, note FROM history WHERE user_id = ? AND route_id = ? AND date = ? "
+                "ORDER BY seq LIMIT 1",
+                (user_id, op["route_id"], op["date"]),
+            ).fetchone()
+            if row is not None:
+                seq, old_km, old_note = row
+                conn.execute(
+                    "UPDATE history SET km = ?, note = ? WHERE seq = ?",
+                    (round(float(old_km) + km, 3), old_note if not note else note, seq),
+                )
+                return
+        conn.execute(
+            "INSERT INTO history(user_id, route_id, date, km, note) VALUES (?, ?, ?, ?, ?)",
+            (user_id, op["route_id"], op["date"], round(km, 3), note),
+        )
+    elif kind == "undo":
+        route_id = op["route_id"]
+        row = conn.execute(
+            "SELECT seq, km FROM history WHERE user_id = ? AND route_id = ? AND date = ? "
+            "ORDER BY seq DESC LIMIT 1",
+            (user_id, route_id, op["date"]),
+        ).fetchone()
+        bcast = [b for b in _sqlite_broadcast_rows(conn, user_id, op["date"]) if route_id in b[3]["route_ids"]]
+        if bcast and (row is None or bcast[-1][0] > row[0]):
+            seq, km, note, extra = bcast[-1]
+            _sqlite_unlink_broadcast(conn, seq, extra, route_id)
+            new_km = float(km) - float(op["km"])
+            if new_km > 1e-9:
+                conn.execute(
+                    "INSERT INTO history(user_id, route_id, date, km, note) VALUES (?, ?, ?, ?, ?)",
+                    (user_id, route_id, op["date"], round(new_km, 3), note),
+                )
+        elif row is not None:
+            new_km = float(row[1]) - float(op["km"])
+            if new_km > 1e-9:
+                conn.execute("UPDATE history SET km = ? WHERE seq = ?", (round(new_km, 3), row[0]))
+            else:
+                conn.execute("DELETE FROM history WHERE seq = ?", (row[0],))
+    elif kind == "delete":
+        if op.get("route_id") is None:
+            conn.execute("DELETE FROM history WHERE user_id = ? AND date = ?", (user_id, op["date"]))
+        else:
+            conn.execute(
+                "DELETE FROM history WHERE user_id = ? AND route_id = ? AND date = ?",
+                (user_id, op["route_id"], op["date"]),
+            )
+            for seq, _, _, extra in _sqlite_broadcast_rows(conn, user_id, op["date"]):
+                if op["route_id"] in extra["route_ids"]:
+                    _sqlite_unlink_broadcast(conn, seq, extra, op["route_id"])
+    elif kind == "clear_route":
+        conn.execute("DELETE FROM history WHERE user_id = ? AND route_id = ?", (user_id, op["route_id"]))
+        for seq, _, _, extra in _sqlite_broadcast_rows(conn, user_id):
+            if op["route_id"] in extra["route_ids"]:
+                _sqlite_unlink_broadcast(conn, seq, extra, op["route_id"])
+    else:
+        raise ValueError(f"unknown history op: {kind!r}")
+
+
+def _sqlite_save_doc(path: str, data: Dict[str, Any], ops: Optional[List[Dict[str, Any]]] = None) -> None:
+    """
+    Upsert the profile row; history is patched with `ops`, or fully replaced when
+    ops is None or contains a reset (first write, heal write-back, wholesale rewrite).
+    """
+    conn = _sqlite_conn(path)
+    user_id = _user_id_for_path(path)
+    doc = _persistable(data, history=False)
+    full = ops is None or any(op.get("op") == "reset" for op in ops)
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        exists = conn.execute("SELECT 1 FROM profile WHERE user_id = ?", (user_id,)).fetchone()
+        conn.execute(
+            "INSERT INTO profile(user_id, doc, updated_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(user_id) DO UPDATE SET doc = excluded.doc, updated_at = excluded.updated_at",
+            (user_id, json_dumps(doc, pretty=False).decode("utf-8"), (data.get("meta") or {}).get("updated_at")),
+        )
+        if full or not exists:
+            conn.execute("DELETE FROM history WHERE user_id = ?", (user_id,))
+            conn.executemany(
+                "INSERT INTO history(user_id, route_id, date, km, note, extra) VALUES (?, ?, ?, ?, ?, ?)",
+                [_sqlite_history_row(user_id, h) for h in _persistable(data).get("history", []) if isinstance(h, dict)],
+            )
+        else:
+            for op in ops:
+                _sqlite_apply_op(conn, user_id, op)
+
+
+def route_km_totals(path: str) -> Dict[str, float]:
+    """
+    Per-route km sums for one user. Indexed GROUP BY on sqlite; otherwise read from
+    the document's incremental aggregates.
+    """
+    if _is_sqlite():
+        conn = _sqlite_conn(path)
+        user_id = _user_id_for_path(path)
+        rows = conn.execute(
+            "SELECT route_id, SUM(km) FROM history WHERE user_id = ? AND route_id IS NOT NULL GROUP BY route_id",
+            (user_id,),
+        )
+        sums = {rid: float(s or 0.0) for rid, s in rows}
+        for _, km, _, extra in _sqlite_broadcast_rows(conn, user_id):
+            for rid in extra["route_ids"]:
+                sums[rid] = sums.get(rid, 0.0) + float(km)
+        return {rid: round(v, 3) for rid, v in sums.items()}
+    data = load_data(path)
+    agg = data["profile"].get("agg")
+    if not _agg_valid(agg):
+        agg = rebuild_aggregates(data)
+    return dict(agg["route_km"])
+
+
+def _sqlite_load_invites(path: str) -> Dict[str, Any]:
+    conn = _sqlite_conn(path)
+    out: Dict[str, Any] = {}
+    for code, rec in conn.execute("SELECT code, rec FROM invites ORDER BY code"):
+        try:
+            out[code] = json_loads(rec)
+        except ValueError:
+            continue
+    return out
+
+
 def _deepcopy_default() -> Dict[str, Any]:
     """
     Safe deep copy of DEFAULT_DATA to avoid shared references.
     """
-    return json.loads(json.dumps(DEFAULT_DATA))
+    return copy.deepcopy(DEFAULT_DATA)
+
+def _new_document() -> Dict[str, Any]:
+    """
+    Fresh, already-healed document for a first visit, so the next load is a pure read.
+    """
+    data = _deepcopy_default()
+    data["meta"]["created_at"] = _now_iso()
+    data, _ = _heal_document(data)
+    data["meta"]["updated_at"] = data["meta"]["created_at"]
+    return data
+
+
+def _persistable(data: Dict[str, Any], history: bool = True) -> Dict[str, Any]:
+    """
+    The document as written: without in-memory-only keys ("_"-prefixed: pending ops,
+    R2 state, indexes) and with a columnar History turned back into a list of dicts.
+    history=False leaves history out entirely (journal records, SQLite profile row).
+    """
+    out = data
+    if any(isinstance(k, str) and k.startswith("_") for k in data) or not history:
+        out = {k: v for k, v in data.items() if not (isinstance(k, str) and k.startswith("_"))}
+        if not history:
+            out.pop("history", None)
+    h = out.get("history")
+    if isinstance(h, History):
+        out = dict(out)
+        out["history"] = h.to_list()
+    return out
+
+
+def _doc_fingerprint(data: Any) -> bytes:
+    """
+    Canonical serialization used to detect whether heal/migration touched a document.
+    """
+    if isinstance(data, dict):
+        data = _persistable(data)
+    return json_dumps(data, pretty=False, sort_keys=True)
+
+
+def _fold_broadcast_history(data: Dict[str, Any]) -> int:
+    """
+    v3 -> v4 migration: fold the per-route copies written by Pro mode (same date, km and
+    note on two or more Pro routes) into one broadcast record at the first copy's position.
+    Per-route km, total_km and run days are unchanged. Returns the number of records removed.
+    """
+    pro_routes = (((data.get("profile") or {}).get("v3") or {}).get("pro") or {}).get("routes")
+    pro_ids = set(pro_routes) if isinstance(pro_routes, dict) else set()
+    history = data.get("history") or []
+    if isinstance(history, History):
+        history = history.to_list()
+    if len(pro_ids) < 2 or not history:
+        return 0
+
+    groups: Dict[Tuple[Any, float, str], List[int]] = {}
+    for i, h in enumerate(history):
+        if "route_ids" in h or h.get("route_id") not in pro_ids:
+            continue
+        key = (h.get("date"), round(_record_km(h), 3), h.get("note", "") or "")
+        groups.setdefault(key, []).append(i)
+
+    drop = set()
+    for positions in groups.values():
+        # at most one copy per route goes into a broadcast record; repeats stay plain
+        firsts: Dict[Any, int] = {}
+        for i in positions:
+            firsts.setdefault(history[i].get("route_id"), i)
+        if len(firsts) < 2:
+            continue
+        keep = min(firsts.values())
+        rec = dict(history[keep])
+        rec.pop("route_id", None)
+        rec["route_ids"] = sorted(firsts)
+        history[keep] = rec
+        drop.update(i for i in firsts.values() if i != keep)
+
+    if drop:
+        # heal writes the whole document, so no journal reset is needed here
+        data["history"] = [h for i, h in enumerate(history) if i not in drop]
+        rebuild_aggregates(data)
+    return len(drop)
+
+
+# --- schema migrations ---
+# _MIGRATIONS[n] upgrades a document from schema_version n to n + 1 in place. Only the
+# steps a stored document is behind on run; documents already at CURRENT_SCHEMA_VERSION
+# take the fast path in _heal_document.
+_MIGRATIONS: Dict[int, Callable[[Dict[str, Any]], None]] = {}
+
+
+def _migration(from_version: int):
+    def register(fn: Callable[[Dict[str, Any]], None]) -> Callable[[Dict[str, Any]], None]:
+        _MIGRATIONS[from_version] = fn
+        return fn
+    return register
+
+
+@_migration(1)
+def _migrate_v1_to_v2(data: Dict[str, Any]) -> None:
+    # Phase 3.3: auth + pass + entitlements
+    prof = data.setdefault("profile", {})
+    prof.setdefault("auth", {"mode": "local", "invite_code": None, "user_key": None})
+    prof.setdefault("pass", {"tier": "free", "status": "none", "starts_at": None, "ends_at": None, "source": "local", "notes": ""})
+    prof.setdefault("entitlements", {"all_routes": False, "ai_basic": True, "ai_plus": False, "street_view": False})
+    prof.setdefault("route_progress", {})
+
+
+@_migration(2)
+def _migrate_v2_to_v3(data: Dict[str, Any]) -> None:
+    # Phase 4.x: profile.v3 multi-route state
+    ensure_profile_v3(data)
+
+
+@_migration(3)
+def _migrate_v3_to_v4(data: Dict[str, Any]) -> None:
+    # Pro runs are stored as one broadcast record instead of one copy per route
+    _fold_broadcast_history(data)
+
+
+def _run_migrations(data: Dict[str, Any]) -> int:
+    """
+    Run the registered steps from the document's schema_version up to
+    CURRENT_SCHEMA_VERSION. Returns the resulting version.
+    """
+    meta = data.setdefault("meta", {})
+    ver = int(meta.get("schema_version") or 1)
+    while ver < CURRENT_SCHEMA_VERSION:
+        step = _MIGRATIONS.get(ver)
+        if step is None:
+            raise RuntimeError(f"no migration registered for schema v{ver}")
+        step(data)
+        ver += 1
+        meta["schema_version"] = ver
+    return ver
+
+
+def _is_current_document(data: Dict[str, Any]) -> bool:
+    """
+    True when a stored document is at CURRENT_SCHEMA_VERSION and structurally complete,
+    i.e. it was written by this version after a heal: no merge onto DEFAULT_DATA, no
+    migrations and no whole-document fingerprinting needed.
+    """
+    meta, profile = data.get("meta"), data.get("profile")
+    if not isinstance(meta, dict) or not isinstance(profile, dict):
+        return False
+    if meta.get("schema_version") != CURRENT_SCHEMA_VERSION or not meta.get("created_at"):
+        return False
+    if "routes" not in data or "history" not in data:
+        return False
+    auth = profile.get("auth")
+    if not isinstance(auth, dict):
+        return False
+    uk = auth.get("user_key")
+    if not isinstance(uk, str) or not uk.strip():
+        return False
+    for k in ("pass", "entitlements", "v3"):
+        if not isinstance(profile.get(k), dict):
+            return False
+    return _agg_valid(profile.get("agg"))
+
+
+def _heal_document(data: Dict[str, Any]) -> Tuple[Dict[str, Any], bool]:
+    """
+    Bring a stored document up to date: schema migrations for outdated documents, then
+    the heal/normalization pass.
+
+    Returns (healed, changed). `changed` is False when the stored document was already
+    in its healed form, so callers can skip the write-back entirely.
+    """
+    if _is_current_document(data):
+        # fast path: only the derived profile state (pass expiry is date-dependent, v3
+        # mirrors follow route_progress) is re-checked; it is small, so fingerprinting it
+        # is cheap compared to the whole document with its history
+        profile = data["profile"]
+        before = _doc_fingerprint(profile)
+        ensure_access_state(data)
+        ensure_profile_v3(data)
+        _as_history(data)
+        changed = _doc_fingerprint(profile) != before
+        if changed:
+            data["meta"]["updated_at"] = _now_iso()
+        return data, changed
+
+    # heal mutates nested dicts shared with `data`, so fingerprint before touching anything
+    before = _doc_fingerprint(data)
+
+    merged = _deepcopy_default()
+
+    # Shallow merge top-level keys
+    for k in merged.keys():
+        if k in data:
+            merged[k] = data[k]
+
+    # Ensure meta/profile exist
+    merged.setdefault("meta", {})
+    merged.setdefault("profile", {})
+    merged.setdefault("routes", {})
+    merged.setdefault("history", [])
+
+    _run_migrations(merged)
+
+    # Ensure user_key exists (legacy field; keep for compatibility if your app expects it)
+    prof = merged.setdefault("profile", {})
+    auth = prof.setdefault("auth", {"mode": "local", "invite_code": None, "user_key": None})
+    uk = auth.get("user_key")
+    if not isinstance(uk, str) or not uk.strip():
+        auth["user_key"] = "u_" + uuid.uuid4().hex
+
+    ensure_access_state(merged)
+    ensure_profile_v3(merged)
+
+    merged["meta"].setdefault("created_at", _now_iso())
+
+    _as_history(merged)
+
+    # aggregates predating AGG_VERSION (or never written) are rebuilt once here
+    if not _agg_valid(prof.get("agg")):
+        rebuild_aggregates(merged)
+
+    changed = _doc_fingerprint(merged) != before
+    if changed:
+        merged["meta"]["updated_at"] = _now_iso()
+    return merged, changed
+
+
+def list_user_data_paths(storage_dir: str) -> Iterator[str]:
+    """
+    run_data_<USER_ID>.json paths of every stored user on the active backend, for load_data
+    (R2: users/<id>/run_data.json objects, listed page by page; SQLite: profile rows;
+    local: files in storage_dir). Lazy, in key order.
+    """
+    if _is_r2():
+        s3 = _r2_client()
+        kwargs: Dict[str, Any] = {"Bucket": _r2_bucket(), "Prefix": "users/"}
+        while True:
+            resp = s3.list_objects_v2(**kwargs)
+            for item in resp.get("Contents") or []:
+                parts = (item.get("Key") or "").split("/")
+                if len(parts) == 3 and parts[2] == "run_data.json" and parts[1]:
+                    yield os.path.join(storage_dir, f"run_data_{parts[1]}.json")
+            if not resp.get("IsTruncated") or not resp.get("NextContinuationToken"):
+                return
+            kwargs["ContinuationToken"] = resp["NextContinuationToken"]
+    if _is_sqlite():
+        probe = os.path.join(storage_dir, "run_data_.json")
+        for (user_id,) in _sqlite_conn(probe).execute("SELECT user_id FROM profile ORDER BY user_id").fetchall():
+            yield os.path.join(storage_dir, f"run_data_{user_id}.json")
+        return
+    try:
+        names = sorted(os.listdir(storage_dir))
+    except OSError:
+        return
+    for name in names:
+        if name.startswith("run_data_") and name.endswith(".json") and len(name) > len("run_data_.json"):
+            yield os.path.join(storage_dir, name)
+
 
 def load_data(path: str) -> Dict[str, Any]:
     """
-    Load per-user data from local filesystem OR R2 (depending on RW_STORAGE_BACKEND).
+    Load per-user data from local filesystem, R2 or SQLite (depending on RW_STORAGE_BACKEND).
     Keeps your existing schema heal/migration behaviour (v2/v3) to avoid breaking old users.
+
+    Read-only in steady state: the healed document is only written back when
+    heal/migration actually changed something (new user, schema upgrade, pass expiry,
+    user_key minting). A plain page view costs no fsync and no R2 PUT.
     """
+    if _write_behind_enabled():
+        pending = _wb_peek(path)
+        if pending is not None:
+            return pending
+
     if _is_r2():
         key = _r2_key_for_path(path)
-        data = _r2_get_json(key)
+        data, etag, stored_hash = _r2_get_object(key)
+
+        if not isinstance(data, dict):
+            data = _new_document()
+            try:
+                # only create if still absent: a failed GET must never clobber a real document
+                _r2_put_user_doc(key, data, None, create=True)
+            except StorageConflictError:
+                data, etag, stored_hash = _r2_get_object(key, revalidate=True)
+                if not isinstance(data, dict):
+                    raise
+            else:
+                return data
+
+        merged, changed = _heal_document(data)
+        if changed:
+            # Write back healed version (important for keeping future reads stable)
+            _r2_put_user_doc(key, merged, etag)
+        else:
+            merged[_R2_STATE_KEY] = {"etag": etag, "hash": stored_hash or _content_hash(merged)}
+        return merged
 
-        if not isinstance(data, dict):
-            data = _deepcopy_default()
-            data.setdefault("meta", {})
-            data["meta"].setdefault("schema_version", 3)
-            data["meta"].setdefault("created_at", _now_iso())
-            data["meta"]["updated_at"] = data["meta"]["created_at"]
-            _r2_put_json(key, data)
+    if _is_sqlite():
+        data = _sqlite_load_doc(path)
+        if data is None:
+            data = _new_document()
+            _sqlite_save_doc(path, data)
             return data
 
-        merged = _deepcopy_default()
-
-        # Shallow merge top-level keys
-        for k in merged.keys():
-            if k in data:
-                merged[k] = data[k]
-
-        # Ensure meta/profile exist
-        merged.setdefault("meta", {})
-        merged.setdefault("profile", {})
-        merged.setdefault("routes", {})
-        merged.setdefault("history", [])
-
-        # --- schema migrations/heal (keep consistent with your project) ---
-        ver = int((merged.get("meta") or {}).get("schema_version") or 1)
-
-        if ver < 2:
-            prof = merged.setdefault("profile", {})
-            prof.setdefault("auth", {"mode": "local", "invite_code": None, "user_key": None})
-            prof.setdefault("pass", {"tier": "free", "status": "none", "starts_at": None, "ends_at": None, "source": "local", "notes": ""})
-            prof.setdefault("entitlements", {"all_routes": False, "ai_basic": True, "ai_plus": False, "street_view": False})
-            prof.setdefault("route_progress", {})
-            merged.setdefault("meta", {})["schema_version"] = 2
-            ver = 2
-
-        if ver < 3:
-            ensure_profile_v3(merged)
-            merged.setdefault("meta", {})["schema_version"] = 3
-
-        # Ensure user_key exists (legacy field; keep for compatibility if your app expects it)
-        prof = merged.setdefault("profile", {})
-        auth = prof.setdefault("auth", {"mode": "local", "invite_code": None, "user_key": None})
-        uk = auth.get("user_key")
-        if not isinstance(uk, str) or not uk.strip():
-            auth["user_key"] = "u_" + uuid.uuid4().hex
-
-        ensure_access_state(merged)
-        ensure_profile_v3(merged)
-
-        merged["meta"].setdefault("created_at", _now_iso())
-        merged["meta"]["updated_at"] = _now_iso()
-
-        # Write back healed version (important for keeping future reads stable)
-        _r2_put_json(key, merged)
+        merged, changed = _heal_document(data)
+        if changed:
+            _sqlite_save_doc(path, merged)
         return merged
 
     # -------- local filesystem mode --------
     if not os.path.exists(path):
-        data = _deepcopy_default()
-        data.setdefault("meta", {})
-        data["meta"].setdefault("schema_version", 3)
-        data["meta"].setdefault("created_at", _now_iso())
-        data["meta"]["updated_at"] = data["meta"]["created_at"]
-        atomic_write_json(path, data)
+        data = _new_document()
+        atomic_write_json(path, _persistable(data))
         return data
 
     try:
-        with open(path, "r", encoding="utf-8") as f:
-            data = json.load(f)
+        with open(path, "rb") as f:
+            data = json_loads(f.read())
     except Exception:
         data = None
 
     if not isinstance(data, dict):
-        data = _deepcopy_default()
-        data.setdefault("meta", {})
-        data["meta"].setdefault("schema_version", 3)
-        data["meta"].setdefault("created_at", _now_iso())
-        data["meta"]["updated_at"] = data["meta"]["created_at"]
-        atomic_write_json(path, data)
+        data = _new_document()
+        atomic_write_json(path, _persistable(data))
         return data
 
-    merged = _deepcopy_default()
-    for k in merged.keys():
-        if k in data:
-            merged[k] = data[k]
-
-    merged.setdefault("meta", {})
-    merged.setdefault("profile", {})
-    merged.setdefault("routes", {})
-    merged.setdefault("history", [])
-
-    ver = int((merged.get("meta") or {}).get("schema_version") or 1)
+    _replay_journal(path, data)
 
-    if ver < 2:
-        prof = merged.setdefault("profile", {})
-        prof.setdefault("auth", {"mode": "local", "invite_code": None, "user_key": None})
-        prof.setdefault("pass", {"tier": "free", "status": "none", "starts_at": None, "ends_at": None, "source": "local", "notes": ""})
-        prof.setdefault("entitlements", {"all_routes": False, "ai_basic": True, "ai_plus": False, "street_view": False})
-        prof.setdefault("route_progress", {})
-        merged.setdefault("meta", {})["schema_version"] = 2
-        ver = 2
-
-    if ver < 3:
-        ensure_profile_v3(merged)
-        merged.setdefault("meta", {})["schema_version"] = 3
+    merged, changed = _heal_document(data)
+    if changed:
+        _write_local_snapshot(path, merged)
+    return merged
 
-    prof = merged.setdefault("profile", {})
-    auth = prof.setdefault("auth", {"mode": "local", "invite_code": None, "user_key": None})
-    uk = auth.get("user_key")
-    if not isinstance(uk, str) or not uk.strip():
-        auth["user_key"] = "u_" + uuid.uuid4().hex
 
-    ensure_access_state(merged)
-    ensure_profile_v3(merged)
+def read_data(path: str) -> Optional[Dict[str, Any]]:
+    """
+    Read-only load for exports / reports: the stored document parsed, journal replayed and
+    healed in memory only. Never writes back, never creates a document. None when there is
+    no readable document at `path`.
+    """
+    if _write_behind_enabled():
+        pending = _wb_peek(path)
+        if pending is not None:
+            return pending
 
-    merged["meta"].setdefault("created_at", _now_iso())
-    merged["meta"]["updated_at"] = _now_iso()
+    if _is_r2():
+        data, _, _ = _r2_get_object(_r2_key_for_path(path))
+    elif _is_sqlite():
+        data = _sqlite_load_doc(path)
+    else:
+        try:
+            with open(path, "rb") as f:
+                data = json_loads(f.read())
+        except (OSError, ValueError):
+            data = None
+        if isinstance(data, dict):
+            _replay_journal(path, data)
 
-    atomic_write_json(path, merged)
+    if not isinstance(data, dict):
+        return None
+    merged, _ = _heal_document(data)
     return merged
 
 def ensure_profile_v3(data: Dict[str, Any]) -> Dict[str, Any]:
@@ -508,40 +2188,329 @@ def _today_str() -> str:
     return date.today().isoformat()
 
 
-def _recompute_profile_from_history(data: Dict[str, Any]) -> None:
+# --- Incremental aggregates ---
+# profile.agg is kept up to date by every history mutation in O(1) (amortized; O(log n)
+# list maintenance for new/removed run days) instead of re-summing history:
+#   route_km / route_last_date per route, total_km, run_days (distinct dates),
+#   last_run_date, streak_days + streak_start (consecutive days ending at last_run_date).
+# The legacy profile.total_km / last_run_date / streak_days mirror it.
+# The per-date bookkeeping it needs lives in an in-memory _HistoryIndex (never persisted),
+# built from history once per loaded document; the same index resolves the records that
+# merge/undo/delete touch. verify_aggregates() rebuilds and compares.
+AGG_VERSION = 1
+_HIDX_KEY = "_hidx"
+
+
+def history_routes(rec: Dict[str, Any]) -> List[Any]:
     """
-    Recompute total_km, last_run_date, streak_days from history for safety.
+    Routes a history record credits: a broadcast record ("route_ids", Pro mode) credits
+    its km to every listed route; a plain record to its single "route_id".
     """
-    history: List[Dict[str, Any]] = data.get("history", [])
-    if not history:
-        data["profile"]["total_km"] = 0.0
-        data["profile"]["last_run_date"] = None
-        data["profile"]["streak_days"] = 0
-        return
+    rids = rec.get("route_ids")
+    if isinstance(rids, list):
+        return rids
+    return [rec.get("route_id")]
+
 
-    # sum
-    total = 0.0
-    dates = set()
-    for item in history:
-        total += float(item.get("km", 0.0))
-        d = item.get("date")
-        if d:
-            dates.add(d)
-
-    data["profile"]["total_km"] = round(total, 3)
-
-    # last date
-    last_date = max(dates)
-    data["profile"]["last_run_date"] = last_date
-
-    # streak: count consecutive days ending at last_date
-    streak = 0
-    cur = _parse_yyyy_mm_dd(last_date)
-    while cur.isoformat() in dates:
-        streak += 1
+class _HistoryIndex:
+    """
+    In-memory index over data["history"] (a History), by row id:
+      by_date[date][route_id] -> rows crediting the route that day, in history order
+      dates / route_dates[route_id] -> sorted distinct run dates
+    A broadcast row is listed under each of its routes.
+    Mutators go through add()/remove()/unlink() so the index never has to be rebuilt.
+    """
+
+    def __init__(self, history: History):
+        self.history = history
+        self.size = len(history)
+        self.by_date: Dict[str, Dict[Any, List[int]]] = {}
+        for row, d, rids in history.index_rows():
+            if d:
+                day = self.by_date.setdefault(d, {})
+                for rid in rids:
+                    day.setdefault(rid, []).append(row)
+        self.dates: List[str] = sorted(self.by_date)
+        self.route_dates: Dict[Any, List[str]] = {}
+        for d in self.dates:
+            for rid in self.by_date[d]:
+                self.route_dates.setdefault(rid, []).append(d)
+
+    def records(self, d: str, route_id: Any) -> List[int]:
+        return self.by_date.get(d, {}).get(route_id, [])
+
+    def add(self, row: int) -> List[Tuple[Any, int, int]]:
+        """
+        Index a row appended to history. Returns (route_id, date transition,
+        route-date transition) per credited route: 1 when the date (or the route's date)
+        just became present, else 0.
+        """
+        self.size += 1
+        d = self.history.date_of(row)
+        if not d:
+            return []
+        out = []
+        for rid in self.history.routes(row):
+            day = self.by_date.get(d)
+            dt = 0
+            if day is None:
+                day = self.by_date[d] = {}
+                bisect.insort(self.dates, d)
+                dt = 1
+            rows = day.get(rid)
+            rt = 0
+            if rows is None:
+                rows = day[rid] = []
+                bisect.insort(self.route_dates.setdefault(rid, []), d)
+                rt = 1
+            rows.append(row)
+            out.append((rid, dt, rt))
+        return out
+
+    @staticmethod
+    def _drop(sorted_list: List[str], d: str) -> None:
+        i = bisect.bisect_left(sorted_list, d)
+        if i < len(sorted_list) and sorted_list[i] == d:
+            sorted_list.pop(i)
+
+    def unlink(self, row: int, rid: Any) -> Tuple[int, int]:
+        """
+        Drop one route's listing of a row. Returns (-1 or 0, -1 or 0) like add().
+        """
+        d = self.history.date_of(row)
+        day = self.by_date.get(d)
+        rows = day.get(rid) if day else None
+        if not rows:
+            return 0, 0
+        for i in range(len(rows) - 1, -1, -1):
+            if rows[i] == row:
+                rows.pop(i)
+                break
+        rt = dt = 0
+        if not rows:
+            del day[rid]
+            self._drop(self.route_dates.get(rid, []), d)
+            rt = -1
+        if not day:
+            del self.by_date[d]
+            self._drop(self.dates, d)
+            dt = -1
+        return dt, rt
+
+    def remove(self, row: int) -> List[Tuple[Any, int, int]]:
+        """
+        Unindex a row that is about to be removed from history (all of its routes).
+        """
+        self.size -= 1
+        return [(rid,) + self.unlink(row, rid) for rid in self.history.routes(row)]
+
+
+def _history_index(data: Dict[str, Any]) -> _HistoryIndex:
+    history = _as_history(data)
+    idx = data.get(_HIDX_KEY)
+    # rebuilt if history was replaced or edited behind the mutators' back
+    if not isinstance(idx, _HistoryIndex) or idx.history is not history or idx.size != len(history):
+        idx = _HistoryIndex(history)
+        data[_HIDX_KEY] = idx
+    return idx
+
+
+def _agg_valid(agg: Any) -> bool:
+    return isinstance(agg, dict) and agg.get("version") == AGG_VERSION and isinstance(agg.get("route_km"), dict)
+
+
+def _walk_streak_back(idx: _HistoryIndex, end: date) -> Tuple[date, int]:
+    """
+    Consecutive run days ending at `end` (inclusive): returns (first_day, length).
+    """
+    n = 0
+    cur = end
+    while cur.isoformat() in idx.by_date:
+        n += 1
         cur = cur - timedelta(days=1)
+    return cur + timedelta(days=1), n
+
+
+def _mirror_agg(data: Dict[str, Any]) -> None:
+    profile = data.setdefault("profile", {})
+    agg = profile["agg"]
+    profile["total_km"] = agg["total_km"]
+    profile["last_run_date"] = agg["last_run_date"]
+    profile["streak_days"] = agg["streak_days"]
+
+
+def rebuild_aggregates(data: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Rebuild profile.agg (and the in-memory index) from history in one pass.
+    """
+    history = _as_history(data)
+    idx = _HistoryIndex(history)
+    data[_HIDX_KEY] = idx
+
+    # a broadcast record credits (and counts towards total_km) once per route,
+    # exactly like the per-route copies it replaces
+    route_km = history.route_totals()
+    total = sum(route_km.values())
+
+    agg: Dict[str, Any] = {
+        "version": AGG_VERSION,
+        "route_km": {rid: round(v, 3) for rid, v in route_km.items()},
+        "route_last_date": {rid: ds[-1] for rid, ds in idx.route_dates.items() if ds},
+        "total_km": round(total, 3),
+        "run_days": len(idx.dates),
+        "last_run_date": idx.dates[-1] if idx.dates else None,
+        "streak_days": 0,
+        "streak_start": None,
+    }
+    if agg["last_run_date"]:
+        start, n = _walk_streak_back(idx, _parse_yyyy_mm_dd(agg["last_run_date"]))
+        agg["streak_days"], agg["streak_start"] = n, start.isoformat()
+
+    data.setdefault("profile", {})["agg"] = agg
+    _mirror_agg(data)
+    return agg
+
+
+def _agg_apply(data: Dict[str, Any], idx: _HistoryIndex, changes: List[Tuple[Any, Any, float, int, int]]) -> None:
+    """
+    Fold op changes into profile.agg. `idx` already reflects the op.
+    """
+    agg = data["profile"]["agg"]
+    route_km = agg["route_km"]
+    route_last = agg["route_last_date"]
+    gone: List[Any] = []
+    for d, rid, km_delta, dt, rt in changes:
+        if km_delta:
+            route_km[rid] = round(route_km.get(rid, 0.0) + km_delta, 3)
+            agg["total_km"] = round(agg["total_km"] + km_delta, 3)
+
+        # per-route last run date
+        if rt > 0 and (route_last.get(rid) is None or d > route_last[rid]):
+            route_last[rid] = d
+        elif rt < 0 and route_last.get(rid) == d:
+            ds = idx.route_dates.get(rid) or []
+            if ds:
+                route_last[rid] = ds[-1]
+            else:
+                route_last.pop(rid, None)
+                gone.append(rid)
+
+        # distinct run days + streak
+        if dt > 0:
+            agg["run_days"] += 1
+            last = agg["last_run_date"]
+            day = _parse_yyyy_mm_dd(d)
+            if last is None or d > last:
+                if last is not None and day - timedelta(days=1) == _parse_yyyy_mm_dd(last):
+                    agg["streak_days"] += 1
+                else:
+                    agg["streak_days"], agg["streak_start"] = 1, d
+                agg["last_run_date"] = d
+            elif agg["streak_start"] and day + timedelta(days=1) == _parse_yyyy_mm_dd(agg["streak_start"]):
+                # back-filled the day before the streak: it may bridge to an older run of days
+                start, n_days = _walk_streak_back(idx, day)
+                agg["streak_days"] += n_days
+                agg["streak_start"] = start.isoformat()
+        elif dt < 0:
+            agg["run_days"] -= 1
+            last = agg["last_run_date"]
+            if d == last:
+                if idx.dates:
+                    agg["last_run_date"] = idx.dates[-1]
+                    start, n_days = _walk_streak_back(idx, _parse_yyyy_mm_dd(idx.dates[-1]))
+                    agg["streak_days"], agg["streak_start"] = n_days, start.isoformat()
+                else:
+                    agg["last_run_date"], agg["streak_days"], agg["streak_start"] = None, 0, None
+            elif agg["streak_start"] and agg["streak_start"] <= d < last:
+                # a hole inside the current streak: it now starts the day after
+                agg["streak_start"] = (_parse_yyyy_mm_dd(d) + timedelta(days=1)).isoformat()
+                agg["streak_days"] = (_parse_yyyy_mm_dd(last) - _parse_yyyy_mm_dd(d)).days
+    for rid in gone:
+        # routes without any run left drop out, as in a rebuild
+        if not idx.route_dates.get(rid):
+            route_km.pop(rid, None)
+    _mirror_agg(data)
+
+
+def _apply_op(data: Dict[str, Any], op: Dict[str, Any]) -> None:
+    """
+    Apply a history op to the document: history + journal/SQL op log + aggregates.
+    """
+    idx = _history_index(data)
+    changes = _apply_history_op(data["history"], op, idx)
+    _record_op(data, op)
+    if _agg_valid(data.get("profile", {}).get("agg")):
+        _agg_apply(data, idx, changes)
+    else:
+        rebuild_aggregates(data)
+
+
+def verify_aggregates(data: Dict[str, Any]) -> List[str]:
+    """
+    Consistency check: rebuild aggregates from history and list the fields that differ
+    from profile.agg (empty list == consistent). Does not modify `data`.
+    """
+    stored = (data.get("profile") or {}).get("agg")
+    if not _agg_valid(stored):
+        return ["agg missing or outdated"]
+    probe = {"history": data.get("history", []), "profile": {}}
+    fresh = rebuild_aggregates(probe)
+    problems = []
+    for rid in set(fresh["route_km"]) | set(stored["route_km"]):
+        a, b = float(stored["route_km"].get(rid, 0.0)), float(fresh["route_km"].get(rid, 0.0))
+        if abs(a - b) > 1e-6:
+            problems.append(f"route_km[{rid}]: {a} != {b}")
+    if abs(float(stored["total_km"]) - float(fresh["total_km"])) > 1e-6:
+        problems.append(f"total_km: {stored['total_km']} != {fresh['total_km']}")
+    for k in ("route_last_date", "run_days", "last_run_date", "streak_days", "streak_start"):
+        if stored.get(k) != fresh.get(k):
+            problems.append(f"{k}: {stored.get(k)!r} != {fresh.get(k)!r}")
+    return problems
+
+
+def route_km(data: Dict[str, Any], route_id: str) -> float:
+    """
+    Accumulated km of one route (from profile.agg; no history scan).
+    """
+    agg = (data.get("profile") or {}).get("agg")
+    if not _agg_valid(agg):
+        agg = rebuild_aggregates(data)
+    return float(agg["route_km"].get(route_id, 0.0))
+
+
+def route_history(data: Dict[str, Any], route_id: str) -> List[Dict[str, Any]]:
+    """
+    The runs credited to one route, oldest date first, as plain per-route records
+    (broadcast records are expanded to this route). Uses the history index.
+    """
+    idx = _history_index(data)
+    history = idx.history
+    out = []
+    for d in idx.route_dates.get(route_id, []):
+        for row in idx.records(d, route_id):
+            out.append({"date": d, "km": history.km_of(row), "route_id": route_id, "note": history.get(row, "note")})
+    return out
+
+
+def route_has_run(data: Dict[str, Any], route_id: str, run_date: str) -> bool:
+    """
+    Whether the route has any run on run_date (index lookup).
+    """
+    return bool(_history_index(data).records(run_date, route_id))
+
+
+def route_last_date(data: Dict[str, Any], route_id: str) -> Optional[str]:
+    agg = (data.get("profile") or {}).get("agg")
+    if not _agg_valid(agg):
+        agg = rebuild_aggregates(data)
+    return agg["route_last_date"].get(route_id)
+
 
-    data["profile"]["streak_days"] = streak
+def _recompute_profile_from_history(data: Dict[str, Any]) -> None:
+    """
+    Recompute total_km, last_run_date, streak_days (and profile.agg) from history for safety.
+    """
+    rebuild_aggregates(data)
 
 
 def add_run_km(
@@ -566,29 +2535,50 @@ def add_run_km(
     if run_date is None:
         run_date = _today_str()
 
-    route_id = data["profile"].get("current_route_id", "nj_bj")
-    history: List[Dict[str, Any]] = data.get("history", [])
-
-    if mode == "merge":
-        # find existing same-date record for same route
-        for item in history:
-            if item.get("date") == run_date and item.get("route_id") == route_id:
-                item["km"] = round(float(item.get("km", 0.0)) + km, 3)
-                item["note"] = item.get("note", "") if not note else note
-                break
-        else:
-            history.append({"date": run_date, "km": round(km, 3), "route_id": route_id, "note": note})
-    elif mode == "append":
-        history.append({"date": run_date, "km": round(km, 3), "route_id": route_id, "note": note})
-    else:
+    if mode not in ("merge", "append"):
         raise ValueError("mode must be 'merge' or 'append'")
 
-    data["history"] = history
-    _recompute_profile_from_history(data)
+    route_id = data["profile"].get("current_route_id", "nj_bj")
+
+    _apply_op(data, {"op": "add", "date": run_date, "route_id": route_id, "km": km, "note": note, "mode": mode})
 
     data["meta"]["updated_at"] = _now_iso()
     return data
-    
+
+
+def _add_broadcast_km(
+    data: Dict[str, Any],
+    km: float,
+    route_ids: List[str],
+    run_date: Optional[str],
+    mode: str,
+    note: str
+) -> None:
+    """
+    One run credited to several routes: a single broadcast history record
+    ({"date", "km", "route_ids", "note"}) instead of one copy per route.
+    """
+    if mode not in ("merge", "append"):
+        raise ValueError("mode must be 'merge' or 'append'")
+    if run_date is None:
+        run_date = _today_str()
+    rids = sorted(set(route_ids))
+    if len(rids) == 1:
+        op = {"op": "add", "date": run_date, "route_id": rids[0], "km": km, "note": note, "mode": mode}
+    else:
+        op = {"op": "add", "date": run_date, "route_ids": rids, "km": km, "note": note, "mode": mode}
+    _apply_op(data, op)
+
+def pro_route_ids(data: Dict[str, Any]) -> List[str]:
+    """
+    The routes a Pro run is credited to: the keys of profile.v3.pro.routes, sorted
+    ([] when there are none).
+    """
+    pro = (((data.get("profile") or {}).get("v3") or {}).get("pro") or {})
+    routes = pro.get("routes") if isinstance(pro, dict) else None
+    return sorted(routes) if isinstance(routes, dict) else []
+
+
 def add_run_km_pro(
     data: Dict[str, Any],
     km: float,
@@ -600,7 +2590,7 @@ def add_run_km_pro(
     Phase 4.5.1
     Pro 模式：一次输入 km，同步推进所有 Pro 路线（profile.v3.pro.routes 里的所有 rid）
 
-    - 会为每条 Pro 路线写入一条 history 记录（按 mode merge/append）
+    - 写入一条 broadcast history 记录（route_ids = 全部 Pro 路线，按 mode merge/append）
     - 会同步更新：
         * profile.route_progress[rid]
         * profile.v3.pro.routes[rid].km
@@ -617,7 +2607,8 @@ def add_run_km_pro(
     pro = v3.setdefault("pro", {})
     routes = pro.setdefault("routes", {})
 
-    if not isinstance(routes, dict) or len(routes) == 0:
+    target_ids = pro_route_ids(data)
+    if not target_ids:
         # 没有 Pro 路线就直接返回（Dashboard 会提示）
         return data
 
@@ -625,24 +2616,14 @@ def add_run_km_pro(
     if run_date is None:
         run_date = _today_str()
 
-    # 逐条 Pro 路线写入跑量
-    for rid in list(routes.keys()):
-        # 1) 切换当前路线（复用 add_run_km 的写入逻辑）
-        profile["current_route_id"] = rid
-
-        # 2) 写入 history（同日同路线 merge）
-        add_run_km(data, km=float(km), run_date=run_date, mode=mode, note=note)
+    # 一条 broadcast 记录同时推进所有 Pro 路线（同日同路线组 merge）
+    _add_broadcast_km(data, float(km), target_ids, run_date, mode, note)
 
-        # 3) 立刻重算该路线的累计（以 history 为准）
-        route_sum = 0.0
-        for h in data.get("history", []):
-            if h.get("route_id") == rid:
-                try:
-                    route_sum += float(h.get("km", 0.0))
-                except Exception:
-                    pass
+    for rid in target_ids:
+        # 该路线的累计（profile.agg 已随写入增量更新）
+        route_sum = route_km(data, rid)
 
-        # 4) 同步到两个缓存位（给 app.py / Dashboard 用）
+        # 同步到两个缓存位（给 app.py / Dashboard 用）
         profile.setdefault("route_progress", {})
         profile["route_progress"][rid] = round(route_sum, 3)
 
@@ -674,38 +2655,29 @@ def add_daily_km(
     Phase 4.2: One input -> apply to multiple routes (broadcast).
 
     Implementation strategy:
-      - Reuse add_run_km() by temporarily setting profile.current_route_id
-      - After writing history, recompute per-route progress_km (route_progress + v3 mirrors)
+      - Write one broadcast history record carrying all route_ids
+      - Then mirror per-route progress_km (route_progress + v3 mirrors)
     """
     if not route_ids:
         raise ValueError("route_ids must be non-empty")
     if km <= 0:
         raise ValueError("km must be > 0")
 
-    profile = data.setdefault("profile", {})
-    legacy_cur = profile.get("current_route_id")
-
-    # write into history for each route
-    for rid in route_ids:
-        profile["current_route_id"] = rid
-        add_run_km(data, km=float(km), run_date=run_date, mode=mode, note=note)
+    _add_broadcast_km(data, float(km), route_ids, run_date, mode, note)
+    _mirror_route_progress(data, route_ids)
 
-    # restore legacy current route id (best effort)
-    if isinstance(legacy_cur, str) and legacy_cur.strip():
-        profile["current_route_id"] = legacy_cur
+    data["meta"]["updated_at"] = _now_iso()
+    return data
 
-    # recompute per-route progress from history
+def _mirror_route_progress(data: Dict[str, Any], route_ids: List[str], add_pro_routes: bool = True) -> None:
+    """
+    Copy per-route km from the incremental aggregates into route_progress and the v3 caches.
+    add_pro_routes=False only refreshes routes already listed under v3.pro.routes.
+    """
+    profile = data.setdefault("profile", {})
     rp = profile.setdefault("route_progress", {})
-    hist: List[Dict[str, Any]] = data.get("history", [])
     for rid in route_ids:
-        s = 0.0
-        for h in hist:
-            if h.get("route_id") == rid:
-                try:
-                    s += float(h.get("km", 0.0))
-                except Exception:
-                    pass
-        rp[rid] = round(s, 3)
+        rp[rid] = round(route_km(data, rid), 3)
 
     # mirror into v3 caches if present
     v3 = profile.get("v3")
@@ -722,6 +2694,8 @@ def add_daily_km(
             if isinstance(proutes, dict):
                 for rid in route_ids:
                     rec = proutes.get(rid)
+                    if rid not in proutes and not add_pro_routes:
+                        continue
                     if not isinstance(rec, dict):
                         rec = {"km": 0.0, "status": "running", "finished_at": None}
                     rec.setdefault("status", "running")
@@ -729,8 +2703,30 @@ def add_daily_km(
                     rec["km"] = float(rp.get(rid, 0.0))
                     proutes[rid] = rec
 
-    data["meta"]["updated_at"] = _now_iso()
-    return data
+def add_runs_batch(
+    data: Dict[str, Any],
+    runs: List[Tuple[str, float]],
+    route_ids: List[str],
+    note: str = ""
+) -> int:
+    """
+    Bulk add (date, km) runs credited to route_ids (one route -> plain records, several ->
+    broadcast records), e.g. from an activity import. One pass of ops on the in-memory
+    document; the caller saves once. Runs are applied oldest first so the streak
+    aggregates only ever extend. Returns the number of runs added.
+    """
+    if not route_ids:
+        raise ValueError("route_ids must be non-empty")
+    n = 0
+    for run_date, km in sorted(runs):
+        if km <= 0:
+            continue
+        _add_broadcast_km(data, float(km), route_ids, run_date, "merge", note)
+        n += 1
+    if n:
+        _mirror_route_progress(data, route_ids, add_pro_routes=False)
+        data["meta"]["updated_at"] = _now_iso()
+    return n
 
 from datetime import datetime
 
@@ -824,15 +2820,261 @@ def generate_reward_narrative(route_meta: dict) -> dict:
     }
 
 def save_data(path: str, data: Dict[str, Any]) -> None:
+    ops = data.pop(_PENDING_OPS_KEY, None) or []
     data.setdefault("meta", {})
     data["meta"]["updated_at"] = _now_iso()
 
+    if _write_behind_enabled():
+        _wb_enqueue(path, data, ops)
+        return
+
+    _save_data_now(path, data, ops)
+
+
+def _save_data_now(path: str, data: Dict[str, Any], ops: List[Dict[str, Any]]) -> None:
     if _is_r2():
         key = _r2_key_for_path(path)
-        _r2_put_json(key, data)
+        state = data.get(_R2_STATE_KEY) or {}
+        if state.get("hash") and state["hash"] == _content_hash(data):
+            return  # byte-identical apart from updated_at: no PUT
+        # If-Match the etag we loaded: a concurrent write from another tab -> StorageConflictError
+        _r2_put_user_doc(key, data, state.get("etag"))
+        return
+
+    if _is_sqlite():
+        _sqlite_save_doc(path, data, ops)
+        return
+
+    # journal mode: O(1) append of the pending ops + small non-history state
+    if _journal_enabled() and os.path.exists(path) and not any(op.get("op") == "reset" for op in ops):
+        _append_journal(path, data, ops)
+        if _journal_needs_compaction(path, data):
+            _write_local_snapshot(path, data)
+        return
+
+    _write_local_snapshot(path, data)
+
+
+# --- Write-behind (RW_WRITE_BEHIND=1) ---
+# save_data snapshots the document and hands it to one background writer thread:
+#   - successive saves of the same path coalesce (latest document wins, history ops concatenate)
+#   - a path is written at most RW_WRITE_BEHIND_DELAY_S after its first pending save
+#   - one writer => writes hit storage in submit order
+#   - load_data serves the queued/in-flight document, so a rerun right after submit reads its own write
+#   - flush_pending_writes() is the durability barrier for critical paths; it also runs at exit
+_WRITE_BEHIND = os.getenv("RW_WRITE_BEHIND", "0").strip().lower() in ("1", "true", "yes", "on")
+WRITE_BEHIND_DELAY_S = float(os.getenv("RW_WRITE_BEHIND_DELAY_S", "0.5"))
+_WB_MAX_ATTEMPTS = 3
+
+_wb_cond = threading.Condition()
+_wb_pending: Dict[str, Dict[str, Any]] = {}   # path -> {"doc", "ops", "due", "attempts"}
+_wb_inflight: Dict[str, Dict[str, Any]] = {}
+_wb_errors: Dict[str, BaseException] = {}
+_wb_etag_chain: Dict[str, Dict[Optional[str], Dict[str, Any]]] = {}  # path -> loaded etag -> state we wrote
+_wb_thread: Optional[threading.Thread] = None
+
+
+def _write_behind_enabled() -> bool:
+    return _WRITE_BEHIND
+
+
+def _wb_start() -> None:
+    global _wb_thread
+    if _wb_thread is not None and _wb_thread.is_alive():
+        return
+    _wb_thread = threading.Thread(target=_wb_worker, name="rw-write-behind", daemon=True)
+    _wb_thread.start()
+    atexit.register(_wb_drain_at_exit)
+
+
+def _wb_drain_at_exit() -> None:
+    try:
+        flush_pending_writes(None, 10.0)
+    except Exception:
+        pass
+
+
+def _wb_enqueue(path: str, data: Dict[str, Any], ops: List[Dict[str, Any]]) -> None:
+    doc = copy.deepcopy({k: v for k, v in data.items() if k != _HIDX_KEY})
+    with _wb_cond:
+        _wb_start()
+        entry = _wb_pending.get(path)
+        if entry is None:
+            _wb_pending[path] = {"doc": doc, "ops": list(ops), "due": time.time() + WRITE_BEHIND_DELAY_S, "attempts": 0}
+        else:
+            entry["doc"] = doc
+            entry["ops"].extend(ops)
+        _wb_cond.notify_all()
+
+
+def _wb_peek(path: str) -> Optional[Dict[str, Any]]:
+    """
+    Latest not-yet-durable document for path (copy), or None.
+    """
+    with _wb_cond:
+        entry = _wb_pending.get(path) or _wb_inflight.get(path)
+        return copy.deepcopy(entry["doc"]) if entry is not None else None
+
+
+def _wb_resolve_r2_state(path: str, doc: Dict[str, Any]) -> None:
+    """
+    The document was loaded before our own earlier (background) writes landed; point its
+    R2 state at what we wrote, so If-Match chains through our writes instead of
+    conflicting with ourselves.
+    """
+    state = doc.get(_R2_STATE_KEY)
+    chain = _wb_etag_chain.get(path)
+    if not isinstance(state, dict) or not chain:
+        return
+    seen = set()
+    while state.get("etag") in chain and state.get("etag") not in seen:
+        seen.add(state.get("etag"))
+        state = chain[state.get("etag")]
+    doc[_R2_STATE_KEY] = dict(state)
+
+
+def _wb_write(path: str, entry: Dict[str, Any]) -> None:
+    doc = entry["doc"]
+    if _is_r2():
+        _wb_resolve_r2_state(path, doc)
+        before = (doc.get(_R2_STATE_KEY) or {}).get("etag")
+        _save_data_now(path, doc, entry["ops"])
+        after = doc.get(_R2_STATE_KEY)
+        if isinstance(after, dict) and after.get("etag") != before:
+            chain = _wb_etag_chain.setdefault(path, {})
+            chain[before] = dict(after)
+            while len(chain) > 16:
+                chain.pop(next(iter(chain)))
         return
+    _save_data_now(path, doc, entry["ops"])
+
+
+def _wb_worker() -> None:
+    while True:
+        with _wb_cond:
+            while True:
+                now = time.time()
+                due = [p for p, e in _wb_pending.items() if e["due"] <= now]
+                if due:
+                    break
+                timeout = min((e["due"] for e in _wb_pending.values()), default=now + 60.0) - now
+                _wb_cond.wait(timeout=max(timeout, 0.01))
+            batch = []
+            for p in due:
+                entry = _wb_pending.pop(p)
+                _wb_inflight[p] = entry
+                batch.append((p, entry))
+
+        for p, entry in batch:
+            err: Optional[BaseException] = None
+            try:
+                _wb_write(p, entry)
+            except StorageConflictError as e:
+                err = e
+            except Exception as e:
+                entry["attempts"] += 1
+                if entry["attempts"] < _WB_MAX_ATTEMPTS:
+                    with _wb_cond:
+                        _wb_inflight.pop(p, None)
+                        newer = _wb_pending.get(p)
+                        if newer is None:
+                            entry["due"] = time.time() + WRITE_BEHIND_DELAY_S * (2 ** entry["attempts"])
+                            _wb_pending[p] = entry
+                        else:
+                            # a newer save arrived meanwhile: it supersedes the document, keep the ops order
+                            newer["ops"] = entry["ops"] + newer["ops"]
+                        _wb_cond.notify_all()
+                    continue
+                err = e
+            with _wb_cond:
+                _wb_inflight.pop(p, None)
+                if err is not None:
+                    _wb_errors[p] = err
+                _wb_cond.notify_all()
+
+
+def flush_pending_writes(path: Optional[str] = None, timeout_s: Optional[float] = None) -> None:
+    """
+    Durability barrier: block until queued writes for `path` (or all paths) are on storage.
+    Re-raises the error of a failed background write (e.g. StorageConflictError).
+    """
+    deadline = None if timeout_s is None else time.time() + timeout_s
+    with _wb_cond:
+        for p, e in _wb_pending.items():
+            if path is None or p == path:
+                e["due"] = 0.0
+        _wb_cond.notify_all()
+        while any(path is None or p == path for p in list(_wb_pending) + list(_wb_inflight)):
+            remaining = None if deadline is None else deadline - time.time()
+            if remaining is not None and remaining <= 0:
+                raise TimeoutError(f"write-behind flush timed out: {path or 'all'}")
+            _wb_cond.wait(timeout=remaining)
+        errs = [p for p in _wb_errors if path is None or p == path]
+        if errs:
+            err = _wb_errors.pop(errs[0])
+            for p in errs[1:]:
+                _wb_errors.pop(p, None)
+            raise err
+
+
+class UserDataSession:
+    """
+    Unit of work for one user document during a single Streamlit rerun.
+
+    - Loads the document lazily, once, and hands the same in-memory dict to every section.
+    - Mutations are tracked without re-encoding history: history changes always go through
+      the storage mutators, which leave pending ops on the document; everything else is
+      flagged explicitly (mark_dirty) or caught by a fingerprint of the non-history part
+      (profile / meta / routes, a few KB), so re-deriving caches to identical values does
+      not cost a write. A rerun costs nothing proportional to history.
+    - flush() persists at most once per change set; call it before st.rerun()/st.stop()
+      and at the end of the script.
+    """
 
-    atomic_write_json(path, data)
+    def __init__(self, path: str):
+        self.path = path
+        self._data: Optional[Dict[str, Any]] = None
+        self._loaded_fp: Optional[bytes] = None
+        self._dirty = False
+
+    @staticmethod
+    def _state_fingerprint(data: Dict[str, Any]) -> bytes:
+        # history is left out: its changes show up as pending ops
+        return _doc_fingerprint(_persistable(data, history=False))
+
+    @property
+    def data(self) -> Dict[str, Any]:
+        if self._data is None:
+            self._data = load_data(self.path)
+            self._loaded_fp = self._state_fingerprint(self._data)
+            self._dirty = False
+        return self._data
+
+    def mark_dirty(self) -> None:
+        self._dirty = True
+
+    @property
+    def is_dirty(self) -> bool:
+        if self._data is None:
+            return False
+        if self._dirty or self._data.get(_PENDING_OPS_KEY):
+            return True
+        return self._state_fingerprint(self._data) != self._loaded_fp
+
+    def flush(self, durable: bool = False) -> bool:
+        """
+        Persist the document if it changed since load (or last flush). Returns True if written.
+        durable=True also waits for write-behind to reach storage (invites, rewards).
+        """
+        written = False
+        if self.is_dirty:
+            save_data(self.path, self._data)
+            self._loaded_fp = self._state_fingerprint(self._data)
+            self._dirty = False
+            written = True
+        if durable and _write_behind_enabled():
+            flush_pending_writes(self.path)
+        return written
 
 def recompute_profile(data: Dict[str, Any]) -> Dict[str, Any]:
     """
@@ -853,63 +3095,644 @@ def delete_runs_by_date(
     - If route_id is None: delete all routes on that date
     - Else: delete only that route on that date
     """
-    history: List[Dict[str, Any]] = data.get("history", [])
-    new_history: List[Dict[str, Any]] = []
+    _apply_op(data, {"op": "delete", "date": target_date, "route_id": route_id})
+    data["meta"]["updated_at"] = _now_iso()
+    return data
 
-    for item in history:
-        if item.get("date") != target_date:
-            new_history.append(item)
-            continue
-        # same date
-        if route_id is None:
-            # delete it
-            continue
-        if item.get("route_id") == route_id:
-            continue
-        new_history.append(item)
+def undo_run_km(
+    data: Dict[str, Any],
+    km: float,
+    route_id: str,
+    run_date: Optional[str] = None
+) -> Dict[str, Any]:
+    """
+    Undo the last `km` added to route_id on run_date (default today):
+    subtract from that day's latest record, dropping it when it reaches 0.
+    """
+    if run_date is None:
+        run_date = _today_str()
 
-    data["history"] = new_history
-    _recompute_profile_from_history(data)
+    _apply_op(data, {"op": "undo", "date": run_date, "route_id": route_id, "km": float(km)})
+    data["meta"]["updated_at"] = _now_iso()
+    return data
+
+
+def clear_route_history(data: Dict[str, Any], route_id: str) -> Dict[str, Any]:
+    """
+    Remove every history record of one route (keeps other routes).
+    """
+    _apply_op(data, {"op": "clear_route", "route_id": route_id})
     data["meta"]["updated_at"] = _now_iso()
     return data
 
-def load_invites(path: str) -> Dict[str, Any]:
+def load_invites(path: str, fresh: bool = False) -> Dict[str, Any]:
     """
     Invites are a shared object -> for R2 we load from invites/invites.json
     Return {} if missing/corrupt.
+
+    fresh=True (R2): always revalidate against R2 instead of trusting the local cache
+    window -- use it for read-modify-write under INVITES_LOCK_PATH.
     """
     if _is_r2():
         key = _r2_key_for_path(path)
-        data = _r2_get_json(key)
+        data = _r2_get_object(key, revalidate=fresh)[0]
         return data if isinstance(data, dict) else {}
 
+    if _is_sqlite():
+        return _sqlite_load_invites(path)
+
     if not os.path.exists(path):
         atomic_write_json(path, {})
         return {}
 
     try:
-        with open(path, "r", encoding="utf-8") as f:
-            data = json.load(f)
+        with open(path, "rb") as f:
+            data = json_loads(f.read())
         return data if isinstance(data, dict) else {}
     except Exception:
         return {}
 
-def save_invites(path: str, invites: Dict[str, Any]) -> None:
+# --- Invite store ---
+# Per-code invite records with maintained status counters, so redemption and the
+# remaining-count display cost the same at 30 codes or 100k:
+#   sqlite -> invites table (one row per code) + invite_counts kept by triggers
+#   r2     -> invites/codes/<code>.json per code + invites/counts.json; conditional PUTs
+#   local  -> <dir>/invites.d/<code>.json per code + invites.d/_counts.json
+# The legacy single document (invites.json) is imported once by import_legacy_invites.
+# Mutators (redeem/set_status/add_missing) are meant to run under INVITES_LOCK_PATH
+# held exclusively; on R2 the per-code ETag check also guards redemption across hosts.
+INVITE_STATUSES = ("new", "used", "revoked")
+_INVITE_CODE_CHARS = frozenset("ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-_")
+
+
+def _invite_code_ok(code: Any) -> bool:
+    # codes become object keys / file names: no separators, no dot-files
+    return isinstance(code, str) and 0 < len(code) <= 128 and _INVITE_CODE_CHARS.issuperset(code)
+
+
+class InviteStore(ABC):
+    """
+    Backend-neutral invite operations; see invite_store(path).
+    """
+
+    @abstractmethod
+    def get(self, code: str) -> Optional[Dict[str, Any]]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def counts(self) -> Dict[str, int]:
+        """
+        {status: number of codes}; maintained on write, never a scan.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def is_initialized(self) -> bool:
+        raise NotImplementedError
+
+    @abstractmethod
+    def page(self, status: Optional[str] = None, after: Optional[str] = None, limit: int = 50) -> List[Tuple[str, Dict[str, Any]]]:
+        """
+        Codes in ascending order starting after `after` (keyset paging), optionally one status.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def add_missing(self, invites: Dict[str, Any]) -> int:
+        """
+        Insert codes that do not exist yet (existing records are left alone); returns count added.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def _transition(self, code: str, update: Callable[[Dict[str, Any]], Optional[str]]) -> Tuple[str, Optional[Dict[str, Any]]]:
+        """
+        Read-modify-write one record; update() mutates it or returns a refusal reason.
+        """
+        raise NotImplementedError
+
+    def set_status(self, code: str, status: str, **fields: Any) -> Optional[Dict[str, Any]]:
+        """
+        Set a code's status (and extra fields); returns the new record, None if unknown.
+        """
+        def update(rec):
+            rec["status"] = status
+            rec.update(fields)
+            return None
+        result, rec = self._transition(code, update)
+        return rec if result == "ok" else None
+
+    def redeem(self, code: str, activated_at: str) -> Tuple[str, Optional[Dict[str, Any]]]:
+        """
+        new -> used. Returns ("ok", rec) or ("missing" | "used" | "revoked", rec).
+        """
+        def update(rec):
+            if rec.get("status") in ("used", "revoked"):
+                return rec["status"]
+            rec["status"] = "used"
+            rec["activated_at"] = activated_at
+            return None
+        return self._transition(code, update)
+
+    def remaining(self) -> int:
+        return int(self.counts().get("new", 0))
+
+
+class _ObjectInviteStore(InviteStore):
+    """
+    One JSON object per code, a counts object, and a per-status index (an empty marker
+    object per (status, code) on R2, a _SortedKeyIndex locally) so page(status=...) lists
+    only matching codes. Subclasses provide _read/_write/_list and _mark/_list_status.
+
+    Markers are written after the record (new marker first, then the old one removed), so
+    a crash leaves at most a stale marker, which page() skips by checking the record.
+    """
+
+    _COUNTS = "_counts"
+    STATUS_INDEX_VERSION = 1
+
+    @abstractmethod
+    def _read(self, name: str, fresh: bool = False) -> Tuple[Any, Optional[str]]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def _write(self, name: str, obj: Any, token: Optional[str], create: bool) -> Optional[str]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def _list(self, after: Optional[str], limit: int) -> List[str]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def _mark(self, status: str, code: str, present: bool) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def _list_status(self, status: str, after: Optional[str], limit: int) -> List[str]:
+        raise NotImplementedError
+
+    def _update_counts(self, update: Callable[[Dict[str, Any]], None]) -> None:
+        for _ in range(8):
+            doc, token = self._read(self._COUNTS, fresh=True)
+            doc = dict(doc) if isinstance(doc, dict) else {}
+            if token is None:
+                # brand-new store: no codes yet, so the (empty) status index is complete
+                doc["status_index"] = self.STATUS_INDEX_VERSION
+            update(doc)
+            doc["updated_at"] = _now_iso()
+            try:
+                self._write(self._COUNTS, doc, token, create=token is None)
+                return
+            except StorageConflictError:
+                continue
+        raise StorageConflictError("invite counters kept changing; retry")
+
+    def _bump(self, deltas: Dict[str, int]) -> None:
+        def update(doc):
+            counts = dict(doc.get("counts") or {})
+            for status, d in deltas.items():
+                counts[status] = max(0, int(counts.get(status, 0)) + d)
+            doc["counts"] = counts
+        self._update_counts(update)
+
+    def _ensure_status_index(self) -> None:
+        """
+        One-time backfill of the status markers for stores created before they existed.
+        """
+        doc = self._read(self._COUNTS)[0]
+        if not isinstance(doc, dict) or doc.get("status_index") == self.STATUS_INDEX_VERSION:
+            return
+        after: Optional[str] = None
+        while True:
+            codes = self._list(after, 1000)
+            if not codes:
+                break
+            for code in codes:
+                rec = self.get(code)
+                if rec is not None and _invite_code_ok(rec.get("status")):
+                    self._mark(rec["status"], code, True)
+            after = codes[-1]
+        self._update_counts(lambda d: d.__setitem__("status_index", self.STATUS_INDEX_VERSION))
+
+    def get(self, code: str) -> Optional[Dict[str, Any]]:
+        if not _invite_code_ok(code):
+            return None
+        rec = self._read(code)[0]
+        return rec if isinstance(rec, dict) else None
+
+    def counts(self) -> Dict[str, int]:
+        doc = self._read(self._COUNTS)[0]
+        counts = doc.get("counts") if isinstance(doc, dict) else None
+        return {k: int(v) for k, v in counts.items()} if isinstance(counts, dict) else {}
+
+    def is_initialized(self) -> bool:
+        return isinstance(self._read(self._COUNTS)[0], dict)
+
+    def page(self, status: Optional[str] = None, after: Optional[str] = None, limit: int = 50) -> List[Tuple[str, Dict[str, Any]]]:
+        out: List[Tuple[str, Dict[str, Any]]] = []
+        if status is not None:
+            self._ensure_status_index()
+        while len(out) < limit:
+            # by status: list that status's markers, so a page costs O(limit) reads
+            codes = self._list(after, limit) if status is None else self._list_status(status, after, limit - len(out))
+            if not codes:
+                break
+            for code in codes:
+                after = code
+                rec = self.get(code)
+                if rec is not None and (status is None or rec.get("status") == status):
+                    out.append((code, rec))
+                    if len(out) >= limit:
+                        break
+        return out
+
+    def add_missing(self, invites: Dict[str, Any]) -> int:
+        deltas: Dict[str, int] = {}
+        for code, rec in invites.items():
+            if not _invite_code_ok(code) or not isinstance(rec, dict):
+                continue
+            try:
+                self._write(code, rec, None, create=True)
+            except StorageConflictError:
+                continue
+            status = str(rec.get("status") or "")
+            if _invite_code_ok(status):
+                self._mark(status, code, True)
+            deltas[status] = deltas.get(status, 0) + 1
+        self._bump(deltas)  # also creates the counts object on first use
+        return sum(deltas.values())
+
+    def _transition(self, code: str, update: Callable[[Dict[str, Any]], Optional[str]]) -> Tuple[str, Optional[Dict[str, Any]]]:
+        if not _invite_code_ok(code):
+            return "missing", None
+        rec, token = self._read(code, fresh=True)
+        if not isinstance(rec, dict):
+            return "missing", None
+        before = str(rec.get("status") or "")
+        refused = update(rec)
+        if refused:
+            return refused, rec
+        try:
+            self._write(code, rec, token, create=False)
+        except StorageConflictError:
+            # someone else changed this code between our read and write (another host)
+            rec = self.get(code) or {}
+            return str(rec.get("status") or "used"), rec
+        after = str(rec.get("status") or "")
+        if after != before:
+            if _invite_code_ok(after):
+                self._mark(after, code, True)
+            if _invite_code_ok(before):
+                self._mark(before, code, False)
+            self._bump({before: -1, after: 1})
+        return "ok", rec
+
+
+class _R2InviteStore(_ObjectInviteStore):
+    PREFIX = "invites/codes/"
+    COUNTS_KEY = "invites/counts.json"
+    STATUS_PREFIX = "invites/by_status/"  # invites/by_status/<status>/<code>, empty body
+
+    def _key(self, name: str) -> str:
+        return self.COUNTS_KEY if name == self._COUNTS else f"{self.PREFIX}{name}.json"
+
+    def _read(self, name: str, fresh: bool = False) -> Tuple[Any, Optional[str]]:
+        data, etag, _ = _r2_get_object(self._key(name), revalidate=fresh)
+        return data, etag
+
+    def _write(self, name: str, obj: Any, token: Optional[str], create: bool) -> Optional[str]:
+        return _r2_put_json(self._key(name), obj, if_match=token, if_none_match=create and not token)
+
+    def _list(self, after: Optional[str], limit: int) -> List[str]:
+        kwargs: Dict[str, Any] = {"Bucket": _r2_bucket(), "Prefix": self.PREFIX, "MaxKeys": max(1, min(limit, 1000))}
+        if after:
+            kwargs["StartAfter"] = self._key(after)
+        resp = _r2_client().list_objects_v2(**kwargs)
+        out = []
+        for item in resp.get("Contents") or []:
+            key = item.get("Key") or ""
+            if key.startswith(self.PREFIX) and key.endswith(".json"):
+                out.append(key[len(self.PREFIX) : -len(".json")])
+        return out
+
+    def _mark(self, status: str, code: str, present: bool) -> None:
+        key = f"{self.STATUS_PREFIX}{status}/{code}"
+        if present:
+            _r2_client().put_object(Bucket=_r2_bucket(), Key=key, Body=b"")
+        else:
+            _r2_client().delete_object(Bucket=_r2_bucket(), Key=key)
+
+    def _list_status(self, status: str, after: Optional[str], limit: int) -> List[str]:
+        prefix = f"{self.STATUS_PREFIX}{status}/"
+        kwargs: Dict[str, Any] = {"Bucket": _r2_bucket(), "Prefix": prefix, "MaxKeys": max(1, min(limit, 1000))}
+        if after:
+            kwargs["StartAfter"] = prefix + after
+        resp = _r2_client().list_objects_v2(**kwargs)
+        return [k[len(prefix):] for k in (item.get("Key") or "" for item in resp.get("Contents") or []) if k.startswith(prefix)]
+
+
+class _SortedKeyIndex:
+    """
+    Sorted set of keys on disk, split into chunk files of at most CHUNK_MAX keys plus a
+    manifest of (first key, chunk file) pairs. after(key, limit) reads the manifest and only
+    the chunks the page touches; add/discard rewrite one chunk. Not safe for concurrent
+    writers -- callers hold INVITES_LOCK_PATH.
+    """
+
+    CHUNK_MAX = 1000
+    _MANIFEST = "manifest.json"
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def exists(self) -> bool:
+        return os.path.exists(os.path.join(self.root, self._MANIFEST))
+
+    def _read(self, name: str) -> Any:
+        try:
+            with open(os.path.join(self.root, name), "rb") as f:
+                return json_loads(f.read())
+        except (OSError, ValueError):
+            return None
+
+    def _manifest(self) -> Dict[str, Any]:
+        doc = self._read(self._MANIFEST)
+        if not isinstance(doc, dict) or not isinstance(doc.get("chunks"), list):
+            return {"chunks": [], "next": 0}
+        return doc
+
+    def _chunk(self, name: str) -> List[str]:
+        doc = self._read(name)
+        return list(doc.get("keys") or []) if isinstance(doc, dict) else []
+
+    def _save_chunk(self, name: str, keys: List[str]) -> None:
+        atomic_write_json(os.path.join(self.root, name), {"keys": keys}, pretty=False)
+
+    def _save_manifest(self, doc: Dict[str, Any]) -> None:
+        atomic_write_json(os.path.join(self.root, self._MANIFEST), doc, pretty=False)
+
+    @staticmethod
+    def _find(chunks: List[List[str]], key: str) -> int:
+        return max(0, bisect.bisect_right([c[0] for c in chunks], key) - 1)
+
+    def build(self, keys: List[str]) -> None:
+        """
+        Replace the index with `keys` (one-time backfill).
+        """
+        keys = sorted(set(keys))
+        chunks = []
+        for n, i in enumerate(range(0, len(keys), self.CHUNK_MAX)):
+            part = keys[i : i + self.CHUNK_MAX]
+            name = f"c{n:06d}.json"
+            self._save_chunk(name, part)
+            chunks.append([part[0], name])
+        self._save_manifest({"chunks": chunks, "next": len(chunks)})
+
+    def add(self, key: str) -> None:
+        doc = self._manifest()
+        chunks = doc["chunks"]
+        if not chunks:
+            name = f"c{int(doc.get('next') or 0):06d}.json"
+            self._save_chunk(name, [key])
+            doc["chunks"], doc["next"] = [[key, name]], int(doc.get("next") or 0) + 1
+            self._save_manifest(doc)
+            return
+        i = self._find(chunks, key)
+        keys = self._chunk(chunks[i][1])
+        j = bisect.bisect_left(keys, key)
+        if j < len(keys) and keys[j] == key:
+            return
+        keys.insert(j, key)
+        if len(keys) > self.CHUNK_MAX:
+            half = len(keys) // 2
+            name = f"c{int(doc.get('next') or 0):06d}.json"
+            self._save_chunk(name, keys[half:])
+            self._save_chunk(chunks[i][1], keys[:half])
+            chunks.insert(i + 1, [keys[half], name])
+            doc["next"] = int(doc.get("next") or 0) + 1
+        else:
+            self._save_chunk(chunks[i][1], keys)
+            if keys[0] == chunks[i][0]:
+                return
+        chunks[i][0] = keys[0]
+        self._save_manifest(doc)
+
+    def discard(self, key: str) -> None:
+        doc = self._manifest()
+        chunks = doc["chunks"]
+        if not chunks:
+            return
+        i = self._find(chunks, key)
+        keys = self._chunk(chunks[i][1])
+        j = bisect.bisect_left(keys, key)
+        if j >= len(keys) or keys[j] != key:
+            return
+        del keys[j]
+        if keys or len(chunks) == 1:
+            self._save_chunk(chunks[i][1], keys)
+            if not keys or keys[0] == chunks[i][0]:
+                return
+            chunks[i][0] = keys[0]
+        else:
+            try:
+                os.remove(os.path.join(self.root, chunks[i][1]))
+            except FileNotFoundError:
+                pass
+            del chunks[i]
+        self._save_manifest(doc)
+
+    def after(self, key: Optional[str], limit: int) -> List[str]:
+        chunks = self._manifest()["chunks"]
+        out: List[str] = []
+        i = self._find(chunks, key) if key else 0
+        while i < len(chunks) and len(out) < limit:
+            keys = self._chunk(chunks[i][1])
+            start = bisect.bisect_right(keys, key) if key else 0
+            out.extend(keys[start : start + limit - len(out)])
+            i += 1
+        return out
+
+
+class _LocalInviteStore(_ObjectInviteStore):
+    """
+    One file per code under invites.d/, with sorted chunked indexes (_SortedKeyIndex) of
+    all codes and of each status, so a page reads O(limit) keys however many codes exist.
+    """
+
+    # v2: status index moved from marker files to invites.d/_index/status/<status>/
+    STATUS_INDEX_VERSION = 2
+
+    def __init__(self, path: str):
+        self.root = os.path.join(os.path.dirname(path) or ".", "invites.d")
+        self._index_root = os.path.join(self.root, "_index")
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.root, name + ".json")
+
+    def _codes(self) -> _SortedKeyIndex:
+        index = _SortedKeyIndex(os.path.join(self._index_root, "all"))
+        if not index.exists():
+            # stores written before the index: one directory scan, then never again
+            try:
+                names = [n[:-5] for n in os.listdir(self.root) if n.endswith(".json") and not n.startswith("_")]
+            except OSError:
+                names = []
+            index.build(names)
+        return index
+
+    def _status_index(self, status: str) -> _SortedKeyIndex:
+        return _SortedKeyIndex(os.path.join(self._index_root, "status", status))
+
+    def _read(self, name: str, fresh: bool = False) -> Tuple[Any, Optional[str]]:
+        try:
+            with open(self._file(name), "rb") as f:
+                return json_loads(f.read()), "local"
+        except (OSError, ValueError):
+            return None, None
+
+    def _write(self, name: str, obj: Any, token: Optional[str], create: bool) -> Optional[str]:
+        # writers hold INVITES_LOCK_PATH; only create-if-absent needs checking here
+        if create and not token and os.path.exists(self._file(name)):
+            raise StorageConflictError(f"invite record exists: {name}")
+        atomic_write_json(self._file(name), obj)
+        if create and name != self._COUNTS:
+            self._codes().add(name)
+        return "local"
+
+    def _list(self, after: Optional[str], limit: int) -> List[str]:
+        if not os.path.isdir(self.root):
+            return []
+        return self._codes().after(after, limit)
+
+    def _mark(self, status: str, code: str, present: bool) -> None:
+        index = self._status_index(status)
+        if present:
+            index.add(code)
+        else:
+            index.discard(code)
+
+    def _list_status(self, status: str, after: Optional[str], limit: int) -> List[str]:
+        return self._status_index(status).after(after, limit)
+
+
+class _SqliteInviteStore(InviteStore):
+    def __init__(self, path: str):
+        self.path = path
+
+    def _conn(self) -> sqlite3.Connection:
+        return _sqlite_conn(self.path)
+
+    def get(self, code: str) -> Optional[Dict[str, Any]]:
+        row = self._conn().execute("SELECT rec FROM invites WHERE code = ?", (code,)).fetchone()
+        if row is None:
+            return None
+        try:
+            rec = json_loads(row[0])
+        except ValueError:
+            return None
+        return rec if isinstance(rec, dict) else None
+
+    def counts(self) -> Dict[str, int]:
+        return {status: int(n) for status, n in self._conn().execute("SELECT status, n FROM invite_counts") if n}
+
+    def is_initialized(self) -> bool:
+        # any row means the store is in use (imported or seeded); an empty table may still
+        # have a legacy invites.json next to it to import
+        return self._conn().execute("SELECT 1 FROM invites LIMIT 1").fetchone() is not None
+
+    def page(self, status: Optional[str] = None, after: Optional[str] = None, limit: int = 50) -> List[Tuple[str, Dict[str, Any]]]:
+        sql, args = "SELECT code, rec FROM invites WHERE code > ?", [after or ""]
+        if status is not None:
+            sql += " AND status = ?"
+            args.append(status)
+        sql += " ORDER BY code LIMIT ?"
+        args.append(int(limit))
+        out = []
+        for code, rec in self._conn().execute(sql, args):
+            try:
+                out.append((code, json_loads(rec)))
+            except ValueError:
+                continue
+        return out
+
+    def add_missing(self, invites: Dict[str, Any]) -> int:
+        rows = [
+            (code, rec.get("status"), json_dumps(rec, pretty=False).decode("utf-8"))
+            for code, rec in invites.items()
+            if isinstance(code, str) and isinstance(rec, dict)
+        ]
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            cur = conn.executemany("INSERT OR IGNORE INTO invites(code, status, rec) VALUES (?, ?, ?)", rows)
+            return max(0, cur.rowcount)
+
+    def _transition(self, code: str, update: Callable[[Dict[str, Any]], Optional[str]]) -> Tuple[str, Optional[Dict[str, Any]]]:
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT rec FROM invites WHERE code = ?", (code,)).fetchone()
+            try:
+                rec = json_loads(row[0]) if row else None
+            except ValueError:
+                rec = None
+            if not isinstance(rec, dict):
+                return "missing", None
+            refused = update(rec)
+            if refused:
+                return refused, rec
+            conn.execute(
+                "UPDATE invites SET status = ?, rec = ? WHERE code = ?",
+                (rec.get("status"), json_dumps(rec, pretty=False).decode("utf-8"), code),
+            )
+        return "ok", rec
+
+
+def invite_store(path: str) -> InviteStore:
+    """
+    Invite store for the active backend; `path` is the (legacy) invites.json path.
+    """
     if _is_r2():
-        key = _r2_key_for_path(path)
-        _r2_put_json(key, invites)
-        return
+        return _R2InviteStore()
+    if _is_sqlite():
+        return _SqliteInviteStore(path)
+    return _LocalInviteStore(path)
+
+
+def import_legacy_invites(path: str, store: Optional[InviteStore] = None) -> int:
+    """
+    One-time import of the single-document invites.json into the per-code store.
+    No-op once the store is initialized. Run under INVITES_LOCK_PATH (exclusive).
+    """
+    store = store or invite_store(path)
+    if store.is_initialized():
+        return 0
+    if isinstance(store, _SqliteInviteStore):
+        # load_invites would read the (empty) table: the legacy document is the local file
+        # left by the local backend
+        try:
+            with open(path, "rb") as f:
+                legacy = json_loads(f.read())
+        except (OSError, ValueError):
+            legacy = None
+        return store.add_missing(legacy) if isinstance(legacy, dict) and legacy else 0
+    return store.add_missing(load_invites(path, fresh=True))
 
-    atomic_write_json(path, invites)
 
-def mark_invite_used(invites: Dict[str, Any], code: str, activated_at_iso: str) -> None:
+def seed_invites(path: str, seed_path: str, lock_path: str, store: Optional[InviteStore] = None) -> int:
     """
-    Mark an invite code as used (in-memory). Caller should save_invites afterwards.
+    First-deploy invite setup: import the legacy invites.json, then add the codes from
+    seed_path if the store is still empty. Runs under lock_path (exclusive); once the store
+    has codes, a repeat is one counts read. Returns the number of codes added.
+    A missing or unreadable seed file raises, so the caller can retry later.
     """
-    rec = invites.get(code)
-    if not isinstance(rec, dict):
-        rec = {}
-        invites[code] = rec
-    rec["status"] = "used"
-    if not rec.get("activated_at"):
-        rec["activated_at"] = activated_at_iso
+    store = store or invite_store(path)
+    with FileLock(lock_path):
+        added = import_legacy_invites(path, store)
+        if sum(store.counts().values()) > 0:
+            return added
+        with open(seed_path, "rb") as f:
+            seed = json_loads(f.read())
+        if isinstance(seed, dict) and seed:
+            added += store.add_missing(seed)
+    return added
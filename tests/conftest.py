@@ -0,0 +1,101 @@
+import hashlib
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import storage  # noqa: E402
+
+
+@pytest.fixture
+def backend(monkeypatch):
+    """
+    Switch storage to one backend for the test: backend("local", journal=True) / backend("sqlite").
+    Write-behind is always off so saves are synchronous.
+    """
+    monkeypatch.delenv("RW_SQLITE_PATH", raising=False)
+    monkeypatch.setattr(storage, "_WRITE_BEHIND", False)
+
+    def use(name: str, journal: bool = False) -> None:
+        monkeypatch.setattr(storage, "_BACKEND", name)
+        monkeypatch.setattr(storage, "_JOURNAL", journal)
+
+    use("local")
+    return use
+
+
+@pytest.fixture
+def user_path(tmp_path):
+    return str(tmp_path / "run_data_u1.json")
+
+
+class _S3Error(Exception):
+    def __init__(self, status: int, code: str):
+        super().__init__(code)
+        self.response = {"ResponseMetadata": {"HTTPStatusCode": status}, "Error": {"Code": code}}
+
+
+class _Body:
+    def __init__(self, data: bytes):
+        self._data = data
+
+    def read(self) -> bytes:
+        return self._data
+
+
+class FakeS3:
+    """
+    In-memory stand-in for the boto3 S3 client calls storage makes, with ETags and
+    If-Match / If-None-Match semantics. `calls` counts requests per operation.
+    """
+
+    def __init__(self):
+        self.objects = {}  # key -> (body, metadata, etag, content_encoding)
+        self.calls = {}
+
+    def _count(self, op):
+        self.calls[op] = self.calls.get(op, 0) + 1
+
+    def get_object(self, Bucket, Key, IfNoneMatch=None):
+        self._count("get_object")
+        if Key not in self.objects:
+            raise _S3Error(404, "NoSuchKey")
+        body, meta, etag, enc = self.objects[Key]
+        if IfNoneMatch is not None and IfNoneMatch == etag:
+            raise _S3Error(304, "NotModified")
+        return {"Body": _Body(body), "Metadata": dict(meta), "ETag": etag, "ContentEncoding": enc}
+
+    def put_object(self, Bucket, Key, Body, ContentType=None, IfMatch=None, IfNoneMatch=None, Metadata=None, ContentEncoding=None):
+        self._count("put_object")
+        cur = self.objects.get(Key)
+        if IfNoneMatch == "*" and cur is not None:
+            raise _S3Error(412, "PreconditionFailed")
+        if IfMatch is not None and (cur is None or cur[2] != IfMatch):
+            raise _S3Error(412, "PreconditionFailed")
+        etag = '"%s"' % hashlib.md5(Body).hexdigest()
+        self.objects[Key] = (Body, dict(Metadata or {}), etag, ContentEncoding)
+        return {"ETag": etag}
+
+    def delete_object(self, Bucket, Key):
+        self._count("delete_object")
+        self.objects.pop(Key, None)
+
+    def list_objects_v2(self, Bucket, Prefix, MaxKeys=1000, StartAfter=""):
+        self._count("list_objects_v2")
+        keys = sorted(k for k in self.objects if k.startswith(Prefix) and k > StartAfter)[:MaxKeys]
+        return {"Contents": [{"Key": k} for k in keys]}
+
+
+@pytest.fixture
+def r2(backend, monkeypatch, tmp_path):
+    """
+    R2 backend against a FakeS3 (returned), with the disk cache under tmp_path.
+    """
+    backend("r2")
+    fake = FakeS3()
+    monkeypatch.setenv("R2_BUCKET", "rw-test")
+    monkeypatch.setenv("RW_STORAGE_DIR", str(tmp_path))
+    monkeypatch.setattr(storage, "_r2_client", lambda: fake)
+    return fake
@@ -0,0 +1,74 @@
+import io
+import json
+import os
+
+import pytest
+
+import exporter
+import storage
+
+
+def _doc_with_broadcast(path):
+    data = storage.load_data(path)
+    data["profile"]["current_route_id"] = "js_free_nj_zj"
+    storage.add_run_km(data, km=5.0, run_date="2024-01-01", note="早跑")
+    storage.add_daily_km(data, 4.0, ["js_free_nj_cz", "js_free_nj_zj"], run_date="2024-01-02")
+    storage.save_data(path, data)
+    return storage.load_data(path)
+
+
+def test_rows_for_plain_and_broadcast_records(backend, user_path):
+    data = _doc_with_broadcast(user_path)
+    rows = list(exporter.iter_rows(data, user_id="u1"))
+    assert rows == [
+        {"user_id": "u1", "date": "2024-01-01", "km": 5.0, "route_id": "js_free_nj_zj", "route_ids": ["js_free_nj_zj"], "note": "早跑"},
+        {"user_id": "u1", "date": "2024-01-02", "km": 4.0, "route_id": "", "route_ids": ["js_free_nj_cz", "js_free_nj_zj"], "note": ""},
+    ]
+
+
+def test_csv_joins_route_ids(backend, user_path):
+    body = exporter.export_bytes(_doc_with_broadcast(user_path), "csv", user_id="u1")
+    assert body.startswith(b"\xef\xbb\xbf")
+    lines = body.decode("utf-8-sig").splitlines()
+    assert lines[0] == ",".join(exporter.EXPORT_COLUMNS)
+    assert lines[1] == "u1,2024-01-01,5.0,js_free_nj_zj,js_free_nj_zj,早跑"
+    assert lines[2] == "u1,2024-01-02,4.0,,js_free_nj_cz;js_free_nj_zj,"
+
+
+def test_jsonl_round_trips(backend, user_path):
+    data = _doc_with_broadcast(user_path)
+    body = exporter.export_bytes(data, "jsonl", user_id="u1")
+    assert [json.loads(line) for line in body.splitlines()] == list(exporter.iter_rows(data, user_id="u1"))
+
+
+def test_unknown_format(backend, user_path):
+    with pytest.raises(ValueError):
+        exporter.export(iter(()), "xlsx", io.BytesIO())
+
+
+def test_iter_all_rows_is_read_only(backend, tmp_path):
+    backend("local", journal=True)
+    _doc_with_broadcast(str(tmp_path / "run_data_u1.json"))
+    # a pending journal entry and an outdated document that load_data would rewrite
+    data = storage.load_data(str(tmp_path / "run_data_u1.json"))
+    storage.add_run_km(data, km=1.0, run_date="2024-01-03")
+    storage.save_data(str(tmp_path / "run_data_u1.json"), data)
+    with open(tmp_path / "run_data_u2.json", "w", encoding="utf-8") as f:
+        json.dump({"profile": {}, "history": [{"date": "2024-01-01", "km": 2.0, "route_id": "js_free_nj_cz"}]}, f)
+
+    before = {n: (tmp_path / n).read_bytes() for n in sorted(os.listdir(tmp_path))}
+    rows = list(exporter.iter_all_rows(str(tmp_path)))
+    after = {n: (tmp_path / n).read_bytes() for n in sorted(os.listdir(tmp_path))}
+
+    assert after == before
+    assert [(r["user_id"], r["date"], r["km"]) for r in rows] == [
+        ("u1", "2024-01-01", 5.0),
+        ("u1", "2024-01-02", 4.0),
+        ("u1", "2024-01-03", 1.0),
+        ("u2", "2024-01-01", 2.0),
+    ]
+
+
+def test_read_data_does_not_create(backend, user_path):
+    assert storage.read_data(user_path) is None
+    assert not os.path.exists(user_path)
@@ -0,0 +1,115 @@
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+import storage
+
+needs_flock = pytest.mark.skipif(storage.fcntl is None, reason="flock needs fcntl")
+
+
+@pytest.fixture
+def lock_path(tmp_path):
+    return str(tmp_path / "locks" / "invites.json.lock")
+
+
+@needs_flock
+def test_shared_holders_coexist(lock_path):
+    with storage.FileLock(lock_path, shared=True):
+        with storage.FileLock(lock_path, shared=True, timeout_s=0.2) as second:
+            assert second.waited_s < 0.2
+
+
+@needs_flock
+@pytest.mark.parametrize("held_shared, want_shared", [(True, False), (False, True), (False, False)])
+def test_exclusive_conflicts_time_out(lock_path, held_shared, want_shared):
+    before = storage.lock_wait_stats().get("shared" if want_shared else "exclusive", {}).get("timeouts", 0)
+    with storage.FileLock(lock_path, shared=held_shared):
+        waiter = storage.FileLock(lock_path, shared=want_shared, timeout_s=0.1)
+        with pytest.raises(TimeoutError):
+            with waiter:
+                pass
+        assert waiter.waited_s >= 0.1
+    after = storage.lock_wait_stats()["shared" if want_shared else "exclusive"]["timeouts"]
+    assert after == before + 1
+    assert os.path.exists(lock_path)  # the flock file is never unlinked
+
+
+@needs_flock
+def test_waiter_gets_the_lock_after_release(lock_path):
+    held = storage.FileLock(lock_path)
+    held.__enter__()
+    threading.Timer(0.15, held.__exit__, (None, None, None)).start()
+    with storage.FileLock(lock_path, timeout_s=2.0) as waiter:
+        assert waiter.waited_s >= 0.1
+
+
+# --- O_EXCL fallback (no fcntl) ---
+
+@pytest.fixture
+def no_fcntl(monkeypatch):
+    monkeypatch.setattr(storage, "fcntl", None)
+
+
+def _plant(path, token, age_s=0.0):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(token.encode("utf-8"))
+    if age_s:
+        t = time.time() - age_s
+        os.utime(path, (t, t))
+
+
+def _dead_pid():
+    proc = subprocess.Popen([sys.executable, "-c", "pass"])
+    proc.wait()
+    return proc.pid
+
+
+def test_fallback_excludes_and_cleans_up(no_fcntl, lock_path):
+    with storage.FileLock(lock_path):
+        with open(lock_path, "rb") as f:
+            pid, host, _nonce = f.read().decode().split()
+        assert (int(pid), host) == (os.getpid(), socket.gethostname())
+        with pytest.raises(TimeoutError):
+            with storage.FileLock(lock_path, timeout_s=0.1, poll_s=0.02):
+                pass
+    assert not os.path.exists(lock_path)
+
+
+@pytest.mark.skipif(os.name != "posix", reason="pid probing is POSIX only")
+def test_fallback_breaks_lock_of_dead_local_process(no_fcntl, lock_path):
+    _plant(lock_path, f"{_dead_pid()} {socket.gethostname()} abc")
+    with storage.FileLock(lock_path, timeout_s=1.0, poll_s=0.02):
+        pass
+
+
+def test_fallback_breaks_stale_foreign_lock_only(no_fcntl, lock_path):
+    _plant(lock_path, "1 some-other-host abc")
+    with pytest.raises(TimeoutError):
+        with storage.FileLock(lock_path, timeout_s=0.1, poll_s=0.02, stale_after_s=30.0):
+            pass
+    _plant(lock_path, "1 some-other-host abc", age_s=60.0)
+    with storage.FileLock(lock_path, timeout_s=1.0, poll_s=0.02, stale_after_s=30.0):
+        pass
+
+
+def test_fallback_heartbeat_keeps_a_long_holder(no_fcntl, lock_path):
+    with storage.FileLock(lock_path, stale_after_s=0.3):
+        time.sleep(0.5)  # longer than stale_after_s: only the heartbeat keeps the mtime fresh
+        with pytest.raises(TimeoutError):
+            with storage.FileLock(lock_path, timeout_s=0.3, poll_s=0.02, stale_after_s=0.3):
+                pass
+
+
+def test_fallback_exit_leaves_a_new_holder_alone(no_fcntl, lock_path):
+    lock = storage.FileLock(lock_path)
+    lock.__enter__()
+    _plant(lock_path, "2 some-other-host new-holder")  # ours was broken and re-taken
+    lock.__exit__(None, None, None)
+    with open(lock_path, "rb") as f:
+        assert f.read() == b"2 some-other-host new-holder"
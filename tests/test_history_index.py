@@ -0,0 +1,104 @@
+import random
+
+import storage
+
+ROUTES = ["js_free_nj_zj", "js_free_nj_cz", "js_pro_nj_lyg"]
+
+
+def _view(idx):
+    # the live index may keep emptied lists around; lookups treat them like missing keys
+    by_date = {d: {rid: rows for rid, rows in day.items() if rows} for d, day in idx.by_date.items()}
+    by_date = {d: day for d, day in by_date.items() if day}
+    return by_date, idx.dates, {rid: ds for rid, ds in idx.route_dates.items() if ds}
+
+
+def _check(data):
+    assert storage.verify_aggregates(data) == []
+    fresh = storage._HistoryIndex(storage._as_history(data))
+    assert _view(storage._history_index(data)) == _view(fresh)
+
+
+def _add(data, km, route_id, run_date, mode="merge"):
+    data["profile"]["current_route_id"] = route_id
+    storage.add_run_km(data, km=km, run_date=run_date, mode=mode)
+
+
+def test_merge_append_undo_delete(backend, user_path):
+    data = storage.load_data(user_path)
+    _add(data, 5.0, ROUTES[0], "2024-01-01")
+    _add(data, 2.0, ROUTES[0], "2024-01-01")  # merge
+    _add(data, 1.0, ROUTES[0], "2024-01-01", mode="append")
+    _add(data, 3.0, ROUTES[1], "2024-01-02")
+    _check(data)
+    assert [r["km"] for r in storage.route_history(data, ROUTES[0])] == [7.0, 1.0]
+    assert data["profile"]["streak_days"] == 2
+
+    storage.undo_run_km(data, 1.0, ROUTES[0], run_date="2024-01-01")  # drops the appended record
+    _check(data)
+    assert [r["km"] for r in storage.route_history(data, ROUTES[0])] == [7.0]
+
+    storage.delete_runs_by_date(data, "2024-01-01")
+    _check(data)
+    assert storage.route_has_run(data, ROUTES[0], "2024-01-01") is False
+    assert storage.route_last_date(data, ROUTES[1]) == "2024-01-02"
+
+
+def test_broadcast_and_clear_route(backend, user_path):
+    data = storage.load_data(user_path)
+    storage.add_daily_km(data, 4.0, ROUTES, run_date="2024-01-01")
+    storage.add_daily_km(data, 1.0, ROUTES, run_date="2024-01-01")  # merges into the same broadcast record
+    _add(data, 2.0, ROUTES[0], "2024-01-02")
+    _check(data)
+    assert len(storage._as_history(data)) == 2
+    assert all(storage.route_km(data, rid) == 5.0 for rid in ROUTES[1:])
+
+    # undo on one route detaches it from the broadcast record only
+    storage.undo_run_km(data, 5.0, ROUTES[1], run_date="2024-01-01")
+    _check(data)
+    assert storage.route_km(data, ROUTES[1]) == 0.0
+    assert storage.route_km(data, ROUTES[2]) == 5.0
+
+    storage.clear_route_history(data, ROUTES[0])
+    _check(data)
+    assert storage.route_history(data, ROUTES[0]) == []
+    assert storage.route_km(data, ROUTES[2]) == 5.0
+
+
+def test_random_op_sequence_keeps_aggregates_consistent(backend, user_path):
+    rng = random.Random(7)
+    data = storage.load_data(user_path)
+    dates = [f"2024-01-{d:02d}" for d in range(1, 15)]
+    for _ in range(300):
+        r = rng.random()
+        d = rng.choice(dates)
+        if r < 0.4:
+            _add(data, round(rng.uniform(0.5, 10), 2), rng.choice(ROUTES), d, mode=rng.choice(["merge", "append"]))
+        elif r < 0.55:
+            storage.add_daily_km(data, round(rng.uniform(0.5, 10), 2), rng.sample(ROUTES, 2), run_date=d)
+        elif r < 0.8:
+            storage.undo_run_km(data, round(rng.uniform(0.5, 5), 2), rng.choice(ROUTES), run_date=d)
+        elif r < 0.95:
+            storage.delete_runs_by_date(data, d, route_id=rng.choice(ROUTES + [None]))
+        else:
+            storage.clear_route_history(data, rng.choice(ROUTES))
+        _check(data)
+
+    # the same ops replayed from the saved document give the same totals
+    storage.save_data(user_path, data)
+    again = storage.load_data(user_path)
+    assert storage.verify_aggregates(again) == []
+    assert again["profile"]["agg"]["route_km"] == data["profile"]["agg"]["route_km"]
+
+
+def test_delete_today_keeps_profile_stats_without_recompute(backend, user_path):
+    data = storage.load_data(user_path)
+    _add(data, 5.0, ROUTES[0], "2024-01-01")
+    _add(data, 3.0, ROUTES[0], "2024-01-02")
+    _add(data, 2.0, ROUTES[1], "2024-01-02")
+
+    storage.delete_runs_by_date(data, "2024-01-02", route_id=ROUTES[0])
+    profile = data["profile"]
+    assert (profile["total_km"], profile["last_run_date"], profile["streak_days"]) == (7.0, "2024-01-02", 2)
+    storage.delete_runs_by_date(data, "2024-01-02", route_id=ROUTES[1])
+    assert (profile["total_km"], profile["last_run_date"], profile["streak_days"]) == (5.0, "2024-01-01", 1)
+    assert storage.verify_aggregates(data) == []
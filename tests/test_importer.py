@@ -0,0 +1,157 @@
+import io
+from datetime import timedelta, timezone
+
+import pytest
+
+import importer
+import storage
+
+ROUTE = "js_free_nj_zj"
+
+CSV = b"""Activity Date,Activity Type,Distance
+2024-03-01 07:00:00,Run,5.0
+2024-03-01 18:00:00,Run,"2,5"
+2024-03-02 07:00:00,Ride,30
+2024-03-03 07:00:00,Run,
+2024-03-04 07:00:00,Run,"1,234"
+"""
+
+GPX = b"""<?xml version="1.0"?>
+<gpx xmlns="http://www.topografix.com/GPX/1/1">
+  <trk><type>running</type><trkseg>
+    <trkpt lat="32.0" lon="118.0"><time>2024-03-05T06:00:00Z</time></trkpt>
+    <trkpt lat="32.01" lon="118.0"><time>2024-03-05T06:05:00Z</time></trkpt>
+  </trkseg></trk>
+  <trk><type>cycling</type><trkseg>
+    <trkpt lat="32.0" lon="118.0"><time>2024-03-06T06:00:00Z</time></trkpt>
+    <trkpt lat="32.1" lon="118.0"><time>2024-03-06T06:30:00Z</time></trkpt>
+  </trkseg></trk>
+</gpx>
+"""
+
+TCX = b"""<?xml version="1.0"?>
+<TrainingCenterDatabase xmlns="http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2">
+  <Activities>
+    <Activity Sport="Running">
+      <Id>2024-03-07T23:30:00Z</Id>
+      <Lap StartTime="2024-03-07T23:30:00Z"><DistanceMeters>4000</DistanceMeters>
+        <Track><Trackpoint><DistanceMeters>10</DistanceMeters></Trackpoint></Track>
+      </Lap>
+      <Lap StartTime="2024-03-07T23:55:00Z"><DistanceMeters>2500.5</DistanceMeters></Lap>
+    </Activity>
+  </Activities>
+</TrainingCenterDatabase>
+"""
+
+
+@pytest.mark.parametrize(
+    "text, expected",
+    [
+        ("5.01", 5.01),
+        ("5,01", 5.01),
+        ("-0,5", -0.5),
+        ("1,234", 1234.0),
+        ("12,345.6", 12345.6),
+        ("1,2345", None),
+        ("1,23,4", None),
+        ("", None),
+        ("nan", None),
+        ("abc", None),
+    ],
+)
+def test_float(text, expected):
+    assert importer._float(text) == expected
+
+
+def test_parse_csv():
+    acts = list(importer.parse_csv(io.BytesIO(CSV)))
+    assert acts == [("2024-03-01", 5.0), ("2024-03-01", 2.5), None, None, ("2024-03-04", 1234.0)]
+
+
+def test_parse_csv_needs_date_and_distance():
+    with pytest.raises(ValueError):
+        list(importer.parse_csv(io.BytesIO(b"name,km\nx,5\n")))
+
+
+def test_parse_gpx_skips_non_runs():
+    acts = list(importer.parse_gpx(io.BytesIO(GPX), tz=timezone.utc))
+    assert acts[1] is None
+    day, km = acts[0]
+    assert day == "2024-03-05" and km == pytest.approx(1.112, abs=1e-3)
+
+
+def test_parse_tcx_sums_laps_in_local_day():
+    utc8 = timezone(timedelta(hours=8))
+    assert list(importer.parse_tcx(io.BytesIO(TCX), tz=utc8)) == [("2024-03-08", 6.5005)]
+
+
+def test_reimport_is_a_no_op(backend, user_path):
+    data = storage.load_data(user_path)
+    files = lambda: [("a.csv", io.BytesIO(CSV)), ("b.tcx", io.BytesIO(TCX))]
+
+    first = importer.import_files(data, files(), [ROUTE], tz=timezone.utc, max_daily_km=100)
+    assert (first.days, first.added, first.rejected, first.skipped_activities) == (3, 2, 1, 2)
+    assert [(r["date"], r["km"]) for r in storage.route_history(data, ROUTE)] == [
+        ("2024-03-01", 7.5),
+        ("2024-03-07", 6.5),
+    ]
+    storage.save_data(user_path, data)
+
+    data = storage.load_data(user_path)
+    again = importer.import_files(data, files(), [ROUTE], tz=timezone.utc, max_daily_km=100)
+    assert (again.added, again.duplicates) == (0, 2)
+    assert len(storage._as_history(data)) == 2
+    assert storage.verify_aggregates(data) == []
+
+
+def test_broken_file_is_reported(backend, user_path):
+    data = storage.load_data(user_path)
+    result = importer.import_files(data, [("bad.gpx", io.BytesIO(b"<gpx><trk>")), ("a.csv", io.BytesIO(CSV))], [ROUTE])
+    assert len(result.errors) == 1 and result.errors[0].startswith("bad.gpx")
+    assert result.added == 2
+
+
+def test_pro_import_credits_the_same_routes_as_add_run_km_pro(backend, user_path):
+    data = storage.load_data(user_path)
+    pro = data["profile"]["v3"]["pro"]
+    pro["routes"] = {"js_pro_nj_sz": {"km": 0.0}, "js_pro_nj_lyg": {"km": 0.0}}
+    assert storage.pro_route_ids(data) == ["js_pro_nj_lyg", "js_pro_nj_sz"]
+
+    storage.add_run_km_pro(data, km=3.0, run_date="2024-03-01")
+    result = importer.import_files(data, [("a.csv", io.BytesIO(CSV))], storage.pro_route_ids(data), tz=timezone.utc)
+    assert (result.added, result.duplicates) == (1, 1)  # 03-01 already run on the Pro routes
+    assert storage.route_km(data, "js_pro_nj_sz") == storage.route_km(data, "js_pro_nj_lyg") == 3.0 + 1234.0
+    assert storage.route_km(data, "js_pro_nj_nt") == 0.0
+
+    pro["routes"] = {}
+    assert storage.pro_route_ids(data) == []
+
+
+def test_naive_strava_times_are_utc():
+    utc8, utc_5 = timezone(timedelta(hours=8)), timezone(timedelta(hours=-5))
+    strava = b'Activity Date,Activity Type,Distance\n"Mar 1, 2024, 7:00:00 PM",Run,5\n"Mar 2, 2024, 3:00:00 AM",Run,4\n'
+    assert list(importer.parse_csv(io.BytesIO(strava), tz=utc8)) == [("2024-03-02", 5.0), ("2024-03-02", 4.0)]
+    assert list(importer.parse_csv(io.BytesIO(strava), tz=utc_5)) == [("2024-03-01", 5.0), ("2024-03-01", 4.0)]
+
+
+def test_naive_local_columns_and_dates_stay_local():
+    utc8 = timezone(timedelta(hours=8))
+    garmin = b"Date,Distance\n2024-03-01 23:30:00,5\n"
+    assert list(importer.parse_csv(io.BytesIO(garmin), tz=utc8)) == [("2024-03-01", 5.0)]
+    date_only = b"Activity Date,Distance\n2024/03/01,5\n"
+    assert list(importer.parse_csv(io.BytesIO(date_only), tz=timezone(timedelta(hours=-5)))) == [("2024-03-01", 5.0)]
+
+
+def test_naive_gpx_times_are_utc():
+    gpx = GPX.replace(b"2024-03-05T06:00:00Z", b"2024-03-05T20:00:00")
+    assert list(importer.parse_gpx(io.BytesIO(gpx), tz=timezone(timedelta(hours=8))))[0][0] == "2024-03-06"
+
+
+def test_late_evening_run_dedupes_in_user_zone(backend, user_path):
+    utc8 = timezone(timedelta(hours=8))
+    data = storage.load_data(user_path)
+    data["profile"]["current_route_id"] = ROUTE
+    storage.add_run_km(data, km=5.0, run_date="2024-03-02")  # entered by hand that morning
+    strava = b'Activity Date,Activity Type,Distance\n"Mar 1, 2024, 11:30:00 PM",Run,5\n'
+    result = importer.import_files(data, [("a.csv", io.BytesIO(strava))], [ROUTE], tz=utc8)
+    assert (result.added, result.duplicates) == (0, 1)
@@ -0,0 +1,180 @@
+import json
+import os
+import shutil
+
+import pytest
+
+import storage
+
+
+def _invites(n=5):
+    return {f"RW{i:03d}": {"status": "new", "created_at": "2024-01-01T00:00:00"} for i in range(n)}
+
+
+@pytest.fixture(params=["local", "sqlite"])
+def store(request, backend, tmp_path):
+    backend(request.param)
+    return storage.invite_store(str(tmp_path / "invites.json"))
+
+
+def test_add_missing_and_counts(store):
+    assert store.is_initialized() is False
+    assert store.add_missing(_invites()) == 5
+    assert store.is_initialized() is True
+    assert store.add_missing(_invites(7)) == 2  # existing codes are left alone
+    assert store.counts() == {"new": 7}
+    assert store.remaining() == 7
+
+
+def test_redeem_transitions(store):
+    store.add_missing(_invites())
+    result, rec = store.redeem("RW001", "2024-02-01T10:00:00")
+    assert result == "ok" and rec["status"] == "used" and rec["activated_at"] == "2024-02-01T10:00:00"
+    assert store.redeem("RW001", "2024-02-02T10:00:00")[0] == "used"
+    assert store.redeem("NOPE", "2024-02-02T10:00:00") == ("missing", None)
+
+    assert store.set_status("RW002", "revoked", notes="spam")["notes"] == "spam"
+    assert store.redeem("RW002", "2024-02-02T10:00:00")[0] == "revoked"
+    assert store.set_status("NOPE", "revoked") is None
+
+    assert store.get("RW001")["status"] == "used"
+    assert store.counts() == {"new": 3, "used": 1, "revoked": 1}
+
+
+def test_page_by_status_with_keyset_paging(store):
+    store.add_missing(_invites(6))
+    for code in ("RW001", "RW003", "RW004"):
+        store.redeem(code, "2024-02-01T10:00:00")
+
+    assert [c for c, _ in store.page()] == [f"RW{i:03d}" for i in range(6)]
+    first = store.page(status="used", limit=2)
+    assert [c for c, _ in first] == ["RW001", "RW003"]
+    assert [c for c, _ in store.page(status="used", after=first[-1][0], limit=2)] == ["RW004"]
+    assert [c for c, _ in store.page(status="new")] == ["RW000", "RW002", "RW005"]
+    assert store.page(status="revoked") == []
+
+
+def test_local_index_backfill(backend, tmp_path):
+    path = str(tmp_path / "invites.json")
+    store = storage.invite_store(path)
+    store.add_missing(_invites(4))
+    store.redeem("RW002", "2024-02-01T10:00:00")
+
+    # a store written before the code / status indexes existed
+    root = os.path.join(str(tmp_path), "invites.d")
+    shutil.rmtree(os.path.join(root, "_index"))
+    with open(os.path.join(root, "_counts.json"), "rb") as f:
+        counts = storage.json_loads(f.read())
+    counts["status_index"] = 1
+    storage.atomic_write_json(os.path.join(root, "_counts.json"), counts)
+
+    assert [c for c, _ in store.page(status="used")] == ["RW002"]
+    assert store._list_status("new", None, 10) == ["RW000", "RW001", "RW003"]
+    assert store._list(None, 10) == ["RW000", "RW001", "RW002", "RW003"]
+    assert store.counts() == {"new": 3, "used": 1}
+
+
+def test_local_index_pages_across_chunks(backend, tmp_path, monkeypatch):
+    monkeypatch.setattr(storage._SortedKeyIndex, "CHUNK_MAX", 4)
+    store = storage.invite_store(str(tmp_path / "invites.json"))
+    codes = [f"RW{i:03d}" for i in range(30)]
+    store.add_missing({c: {"status": "new"} for c in reversed(codes)})
+    for c in codes[::3]:
+        store.redeem(c, "2024-02-01T10:00:00")
+
+    got, after = [], None
+    while True:
+        page = store.page(after=after, limit=7)
+        if not page:
+            break
+        got += [c for c, _ in page]
+        after = page[-1][0]
+    assert got == codes
+    assert [c for c, _ in store.page(status="used", limit=100)] == codes[::3]
+    assert [c for c, _ in store.page(status="new", after="RW020", limit=3)] == ["RW022", "RW023", "RW025"]
+
+    index = store._status_index("new")
+    for c in codes:
+        index.discard(c)
+    assert index.after(None, 10) == []
+    assert len(index._manifest()["chunks"]) == 1
+
+
+def test_stale_marker_is_skipped(backend, tmp_path):
+    store = storage.invite_store(str(tmp_path / "invites.json"))
+    store.add_missing(_invites(2))
+    store.redeem("RW000", "2024-02-01T10:00:00")
+    store._mark("new", "RW000", True)  # as if a crash happened between the marker writes
+    assert [c for c, _ in store.page(status="new")] == ["RW001"]
+
+
+@pytest.mark.parametrize("name", ["local", "sqlite"])
+def test_import_legacy_invites_once(backend, tmp_path, name):
+    backend(name)
+    path = str(tmp_path / "invites.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"RW000": {"status": "new"}, "RW001": {"status": "used"}}, f)
+
+    store = storage.invite_store(path)
+    assert storage.import_legacy_invites(path, store) == 2
+    assert storage.import_legacy_invites(path, store) == 0
+    assert store.counts() == {"new": 1, "used": 1}
+    assert store.get("RW001")["status"] == "used"
+
+
+def test_incomplete_backend_fails_at_construction():
+    class NoStatusIndex(storage._ObjectInviteStore):
+        def _read(self, name, fresh=False):
+            return None, None
+
+        def _write(self, name, obj, token, create):
+            return None
+
+        def _list(self, after, limit):
+            return []
+
+    with pytest.raises(TypeError):
+        NoStatusIndex()
+
+
+def _seed_file(tmp_path, n=3):
+    seed_path = tmp_path / "invites_seed.json"
+    seed_path.write_text(json.dumps(_invites(n)), encoding="utf-8")
+    return str(seed_path)
+
+
+@pytest.mark.parametrize("name", ["local", "sqlite"])
+def test_seed_invites_runs_once(backend, tmp_path, name):
+    backend(name)
+    path = str(tmp_path / "invites.json")
+    seed_path = _seed_file(tmp_path)
+    store = storage.invite_store(path)
+
+    assert storage.seed_invites(path, seed_path, path + ".lock", store) == 3
+    assert storage.seed_invites(path, seed_path, path + ".lock", store) == 0
+
+    # redeeming every code must not bring the seed back
+    for code, _ in store.page(status="new"):
+        store.redeem(code, "2024-02-01T10:00:00")
+    assert storage.seed_invites(path, seed_path, path + ".lock", store) == 0
+    assert store.counts().get("used") == 3
+    assert not store.counts().get("new")
+
+
+def test_seed_invites_prefers_legacy_document(backend, tmp_path):
+    path = str(tmp_path / "invites.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"OLD001": {"status": "used"}}, f)
+
+    store = storage.invite_store(path)
+    assert storage.seed_invites(path, _seed_file(tmp_path), path + ".lock", store) == 1
+    assert store.counts() == {"used": 1}
+    assert store.get("RW000") is None
+
+
+def test_seed_invites_missing_seed_raises(backend, tmp_path):
+    path = str(tmp_path / "invites.json")
+    store = storage.invite_store(path)
+    with pytest.raises(OSError):
+        storage.seed_invites(path, str(tmp_path / "missing.json"), path + ".lock", store)
+    assert sum(store.counts().values()) == 0
@@ -0,0 +1,94 @@
+import json
+import os
+
+import storage
+
+
+def _add(path, run_date, km, route_id="js_free_nj_zj"):
+    data = storage.load_data(path)
+    data["profile"]["current_route_id"] = route_id
+    storage.add_run_km(data, km=km, run_date=run_date)
+    storage.save_data(path, data)
+
+
+def _snapshot_history(path):
+    with open(path, "rb") as f:
+        return storage.json_loads(f.read())["history"]
+
+
+def test_save_appends_ops_instead_of_rewriting_snapshot(backend, user_path):
+    backend("local", journal=True)
+    storage.load_data(user_path)
+    _add(user_path, "2024-01-01", 5.0)
+    _add(user_path, "2024-01-02", 3.0)
+
+    assert _snapshot_history(user_path) == []
+    records = storage._read_journal(storage._journal_path(user_path))
+    assert [r["seq"] for r in records] == [1, 2]
+    assert [op["op"] for r in records for op in r["ops"]] == ["add", "add"]
+
+    data = storage.load_data(user_path)
+    assert [(r["date"], r["km"]) for r in storage.route_history(data, "js_free_nj_zj")] == [
+        ("2024-01-01", 5.0),
+        ("2024-01-02", 3.0),
+    ]
+    assert storage.verify_aggregates(data) == []
+
+
+def test_torn_last_line_is_ignored(backend, user_path):
+    backend("local", journal=True)
+    storage.load_data(user_path)
+    _add(user_path, "2024-01-01", 5.0)
+    with open(storage._journal_path(user_path), "ab") as f:
+        f.write(b'{"seq": 2, "ops": [{"op": "add", "da')
+
+    data = storage.load_data(user_path)
+    assert storage.route_km(data, "js_free_nj_zj") == 5.0
+
+
+def test_compact_folds_journal_into_snapshot(backend, user_path):
+    backend("local", journal=True)
+    storage.load_data(user_path)
+    _add(user_path, "2024-01-01", 5.0)
+    _add(user_path, "2024-01-02", 3.0)
+
+    assert storage.compact_journal(user_path) is True
+    assert [h["date"] for h in _snapshot_history(user_path)] == ["2024-01-01", "2024-01-02"]
+    # only the seq marker is left, and compacting again is a no-op
+    with open(storage._journal_path(user_path), "rb") as f:
+        assert [json.loads(line) for line in f] == [{"seq": 2, "ops": []}]
+    assert storage.compact_journal(user_path) is False
+
+    # appends after compaction continue above the folded seq and are not applied twice
+    _add(user_path, "2024-01-03", 4.0)
+    data = storage.load_data(user_path)
+    assert storage.route_km(data, "js_free_nj_zj") == 12.0
+    assert storage.verify_aggregates(data) == []
+
+
+def test_auto_compaction_after_max_entries(backend, user_path, monkeypatch):
+    backend("local", journal=True)
+    monkeypatch.setattr(storage, "JOURNAL_MAX_ENTRIES", 3)
+    storage.load_data(user_path)
+    for day in range(1, 4):
+        _add(user_path, f"2024-01-0{day}", 1.0)
+
+    assert len(_snapshot_history(user_path)) == 3
+    assert storage.route_km(storage.load_data(user_path), "js_free_nj_zj") == 3.0
+
+
+def test_history_rewrite_writes_full_snapshot(backend, user_path):
+    backend("local", journal=True)
+    storage.load_data(user_path)
+    _add(user_path, "2024-01-01", 5.0)
+
+    data = storage.load_data(user_path)
+    data["history"] = [{"date": "2024-02-01", "km": 7.0, "route_id": "js_free_nj_cz", "note": ""}]
+    storage.mark_history_rewritten(data)
+    storage.save_data(user_path, data)
+
+    assert [h["date"] for h in _snapshot_history(user_path)] == ["2024-02-01"]
+    data = storage.load_data(user_path)
+    assert storage.route_km(data, "js_free_nj_zj") == 0.0
+    assert storage.route_km(data, "js_free_nj_cz") == 7.0
+    assert not os.path.exists(storage._journal_path(user_path)) or storage.compact_journal(user_path) is False
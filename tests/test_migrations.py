@@ -0,0 +1,114 @@
+import json
+
+import storage
+
+
+def _write(path, doc):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(doc, f)
+
+
+def _v3_doc_with_pro_copies():
+    return {
+        "meta": {"schema_version": 3, "created_at": "2024-01-01T00:00:00"},
+        "profile": {
+            "entitlements": {"all_routes": True},
+            "v3": {"pro": {"routes": {"js_pro_nj_lyg": {"km": 8.0}, "js_pro_nj_sz": {"km": 8.0}}}},
+        },
+        "routes": {},
+        "history": [
+            {"date": "2024-01-01", "km": 5.0, "route_id": "js_pro_nj_lyg", "note": ""},
+            {"date": "2024-01-01", "km": 5.0, "route_id": "js_pro_nj_sz", "note": ""},
+            {"date": "2024-01-02", "km": 3.0, "route_id": "js_pro_nj_lyg", "note": "am"},
+            {"date": "2024-01-02", "km": 3.0, "route_id": "js_pro_nj_sz", "note": "am"},
+            {"date": "2024-01-02", "km": 1.0, "route_id": "js_free_nj_zj", "note": ""},
+        ],
+    }
+
+
+def test_v1_document_migrates_to_current(backend, user_path):
+    _write(user_path, {"profile": {}, "history": [{"date": "2024-01-01", "km": 5.0, "route_id": "js_free_nj_zj"}]})
+    data = storage.load_data(user_path)
+
+    assert data["meta"]["schema_version"] == storage.CURRENT_SCHEMA_VERSION == 4
+    prof = data["profile"]
+    assert prof["pass"]["tier"] == "free"
+    assert isinstance(prof["v3"]["pro"]["routes"], dict)
+    assert prof["auth"]["user_key"].startswith("u_")
+    assert storage.route_km(data, "js_free_nj_zj") == 5.0
+
+    with open(user_path, "rb") as f:
+        assert storage.json_loads(f.read())["meta"]["schema_version"] == 4
+
+
+def test_v3_pro_copies_fold_into_broadcast_records(backend, user_path):
+    _write(user_path, _v3_doc_with_pro_copies())
+    data = storage.load_data(user_path)
+
+    history = storage._as_history(data).to_list()
+    assert len(history) == 3
+    assert history[0]["route_ids"] == ["js_pro_nj_lyg", "js_pro_nj_sz"] and "route_id" not in history[0]
+    assert history[1]["route_ids"] == ["js_pro_nj_lyg", "js_pro_nj_sz"] and history[1]["note"] == "am"
+    assert history[2]["route_id"] == "js_free_nj_zj"
+    # per-route totals are unchanged by the fold
+    assert storage.route_km(data, "js_pro_nj_lyg") == 8.0
+    assert storage.route_km(data, "js_pro_nj_sz") == 8.0
+    # total_km keeps counting a Pro run once per route, as the per-route copies did
+    assert data["profile"]["total_km"] == 17.0
+    assert storage.verify_aggregates(data) == []
+
+
+def test_fold_keeps_repeats_on_one_route_plain():
+    data = _v3_doc_with_pro_copies()
+    data["history"].append({"date": "2024-01-01", "km": 5.0, "route_id": "js_pro_nj_lyg", "note": ""})
+    assert storage._fold_broadcast_history(data) == 2
+    assert [h.get("route_id") for h in data["history"]] == [None, None, "js_free_nj_zj", "js_pro_nj_lyg"]
+
+
+def test_current_document_takes_fast_path(backend, user_path, monkeypatch):
+    storage.load_data(user_path)
+    with open(user_path, "rb") as f:
+        stored = storage.json_loads(f.read())
+    assert storage._is_current_document(stored)
+
+    def no_migrations(data):
+        raise AssertionError("migrations must not run for a current document")
+
+    monkeypatch.setattr(storage, "_run_migrations", no_migrations)
+    healed, changed = storage._heal_document(stored)
+    assert changed is False
+
+    saves = []
+    monkeypatch.setattr(storage, "save_data", lambda *a, **k: saves.append(a))
+    storage.load_data(user_path)
+    assert saves == []
+
+
+def test_missing_migration_step_is_an_error(monkeypatch):
+    monkeypatch.delitem(storage._MIGRATIONS, 2)
+    try:
+        storage._run_migrations({"meta": {"schema_version": 2}})
+    except RuntimeError as e:
+        assert "v2" in str(e)
+    else:
+        raise AssertionError("expected RuntimeError")
+
+
+def test_bad_km_records_load_as_zero(backend, user_path, caplog):
+    doc = _v3_doc_with_pro_copies()
+    doc["meta"]["schema_version"] = 4
+    doc["history"] = [
+        {"date": "2024-01-01", "km": None, "route_id": "js_free_nj_zj"},
+        {"date": "2024-01-02", "km": "abc", "route_id": "js_free_nj_zj"},
+        {"date": "2024-01-03", "km": "NaN", "route_ids": ["js_pro_nj_lyg", "js_pro_nj_sz"]},
+        {"date": "2024-01-04", "km": "2.5", "route_id": "js_free_nj_zj"},
+    ]
+    _write(user_path, doc)
+    with caplog.at_level("WARNING", logger="storage"):
+        data = storage.load_data(user_path)
+
+    assert storage._as_history(data).to_list()[1]["km"] == 0.0
+    assert storage.route_km(data, "js_free_nj_zj") == 2.5
+    assert storage.route_km(data, "js_pro_nj_lyg") == 0.0
+    assert len([r for r in caplog.records if "unusable km" in r.getMessage()]) == 2
+    assert storage.verify_aggregates(data) == []
@@ -0,0 +1,234 @@
+import threading
+
+import pytest
+
+import storage
+
+
+def _reset_client(monkeypatch, factory):
+    monkeypatch.setattr(storage, "_r2_client_cached", None)
+    monkeypatch.setattr(storage, "_r2_client_env", None)
+    monkeypatch.setattr(storage, "_r2_new_client", factory)
+    for name, value in (("R2_ENDPOINT", "https://r2.example"), ("R2_ACCESS_KEY_ID", "k"), ("R2_SECRET_ACCESS_KEY", "s")):
+        monkeypatch.setenv(name, value)
+
+
+def test_one_client_is_shared_across_threads(monkeypatch):
+    built = []
+    gate = threading.Barrier(8)
+
+    def factory():
+        built.append(object())
+        return built[-1]
+
+    _reset_client(monkeypatch, factory)
+    got = []
+
+    def worker():
+        gate.wait()
+        got.append(storage._r2_client())
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert len(built) == 1
+    assert all(c is built[0] for c in got)
+
+
+def test_client_is_rebuilt_when_credentials_change(monkeypatch):
+    _reset_client(monkeypatch, object)
+    first = storage._r2_client()
+    assert storage._r2_client() is first
+    monkeypatch.setenv("R2_SECRET_ACCESS_KEY", "rotated")
+    assert storage._r2_client() is not first
+
+
+def test_missing_env_is_reported(monkeypatch):
+    pytest.importorskip("boto3")
+    monkeypatch.delenv("R2_ENDPOINT", raising=False)
+    with pytest.raises(RuntimeError):
+        storage._r2_new_client()
+
+
+# --- conditional writes / unchanged-save skip ---
+
+def _user_key(path):
+    return storage._r2_key_for_path(path)
+
+
+def test_new_user_is_created_once_and_unchanged_saves_skip_put(r2, user_path):
+    storage.load_data(user_path)
+    assert r2.calls["put_object"] == 1
+    assert _user_key(user_path) in r2.objects
+
+    again = storage.load_data(user_path)
+    storage.save_data(user_path, again)  # only meta.updated_at differs
+    assert r2.calls["put_object"] == 1
+
+    again["profile"]["nickname"] = "runner"
+    storage.save_data(user_path, again)
+    assert r2.calls["put_object"] == 2
+    assert again[storage._R2_STATE_KEY]["etag"] == r2.objects[_user_key(user_path)][2]
+
+
+def test_concurrent_tab_write_is_a_conflict(r2, user_path):
+    storage.load_data(user_path)
+    tab_a = storage.load_data(user_path)
+    tab_b = storage.load_data(user_path)
+
+    storage.add_run_km(tab_a, km=5.0, run_date="2024-01-01")
+    storage.save_data(user_path, tab_a)
+    storage.add_run_km(tab_b, km=3.0, run_date="2024-01-01")
+    with pytest.raises(storage.StorageConflictError):
+        storage.save_data(user_path, tab_b)
+
+    # the losing tab reloads and sees the winner's run
+    fresh = storage.load_data(user_path)
+    assert [r["km"] for r in storage.route_history(fresh, fresh["profile"]["current_route_id"])] == [5.0]
+
+
+def test_create_race_keeps_the_other_writer_document(r2, user_path, monkeypatch):
+    real_get = r2.get_object
+    other = {"profile": {"nickname": "first"}, "history": []}
+
+    def get_then_lose_race(**kwargs):
+        try:
+            return real_get(**kwargs)
+        except Exception:
+            # another process creates the document between our GET and our create-PUT
+            if _user_key(user_path) not in r2.objects:
+                r2.put_object(Bucket="rw-test", Key=_user_key(user_path), Body=storage.json_dumps(other))
+            raise
+
+    monkeypatch.setattr(r2, "get_object", get_then_lose_race)
+    data = storage.load_data(user_path)
+    assert data["profile"]["nickname"] == "first"
+    stored = storage._r2_parse_body(r2.objects[_user_key(user_path)][0])
+    assert stored["profile"]["nickname"] == "first"
+
+
+# --- local read-through cache ---
+
+def test_reads_within_ttl_are_served_from_disk(r2, user_path, monkeypatch):
+    monkeypatch.setattr(storage, "R2_CACHE_TTL_S", 60.0)
+    storage.load_data(user_path)  # creates; the PUT writes through to the cache
+    gets = r2.calls.get("get_object", 0)
+    for _ in range(3):
+        storage.load_data(user_path)
+    assert r2.calls.get("get_object", 0) == gets
+
+
+def test_stale_entry_is_revalidated_with_if_none_match(r2, user_path, monkeypatch):
+    monkeypatch.setattr(storage, "R2_CACHE_TTL_S", 0.0)
+    storage.load_data(user_path)
+    seen = []
+    real_get = r2.get_object
+
+    def spy(**kwargs):
+        seen.append(kwargs.get("IfNoneMatch"))
+        return real_get(**kwargs)
+
+    monkeypatch.setattr(r2, "get_object", spy)
+    storage.load_data(user_path)  # 304 -> cached body
+    assert seen == [r2.objects[_user_key(user_path)][2]]
+
+    # another host writes: the next revalidation fetches the new body
+    other = storage.load_data(user_path)
+    other["profile"]["nickname"] = "elsewhere"
+    doc = dict(storage._persistable(other))
+    r2.put_object(Bucket="rw-test", Key=_user_key(user_path), Body=storage.json_dumps(doc))
+    assert storage.load_data(user_path)["profile"]["nickname"] == "elsewhere"
+
+
+def test_own_writes_are_read_back_without_a_get(r2, user_path, monkeypatch):
+    monkeypatch.setattr(storage, "R2_CACHE_TTL_S", 60.0)
+    data = storage.load_data(user_path)
+    data["profile"]["nickname"] = "runner"
+    storage.save_data(user_path, data)
+    gets = r2.calls.get("get_object", 0)
+    assert storage.load_data(user_path)["profile"]["nickname"] == "runner"
+    assert r2.calls.get("get_object", 0) == gets
+
+
+def test_deleted_object_drops_the_cache_entry(r2, user_path, monkeypatch):
+    monkeypatch.setattr(storage, "R2_CACHE_TTL_S", 0.0)
+    key = _user_key(user_path)
+    storage.load_data(user_path)
+    assert storage._r2_cache_read(key) is not None
+    r2.delete_object(Bucket="rw-test", Key=key)
+    assert storage._r2_get_object(key) == (None, None, None)
+    assert storage._r2_cache_read(key) is None
+
+
+def test_cache_can_be_disabled(r2, user_path, monkeypatch):
+    monkeypatch.setattr(storage, "_R2_CACHE", False)
+    storage.load_data(user_path)
+    gets = r2.calls.get("get_object", 0)
+    storage.load_data(user_path)
+    storage.load_data(user_path)
+    assert r2.calls["get_object"] == gets + 2
+
+
+# --- compressed bodies ---
+
+def _big_doc(path):
+    data = storage.load_data(path)
+    for day in range(1, 29):
+        storage.add_run_km(data, km=5.0, run_date=f"2024-02-{day:02d}", note="晨跑" * 20)
+    storage.save_data(path, data)
+    return data
+
+
+def test_user_documents_are_stored_gzip(r2, user_path):
+    _big_doc(user_path)
+    body, meta, _, enc = r2.objects[_user_key(user_path)]
+    assert body[:2] == b"\x1f\x8b"
+    assert enc == "gzip" and meta["rw-encoding"] == "gzip"
+    stored = storage._r2_get_object(_user_key(user_path), revalidate=True)[0]
+    assert len(stored["history"]) == 28
+
+
+def test_identical_documents_give_identical_bytes():
+    raw = storage.json_dumps({"k": "v" * 4096})
+    assert storage._r2_encode_body(raw) == storage._r2_encode_body(raw)
+
+
+def test_small_bodies_and_none_stay_plain(monkeypatch):
+    assert storage._r2_encode_body(b"{}") == (b"{}", None)
+    monkeypatch.setattr(storage, "R2_COMPRESSION", "none")
+    raw = storage.json_dumps({"k": "v" * 4096})
+    assert storage._r2_encode_body(raw) == (raw, None)
+
+
+def test_legacy_plain_objects_still_read(r2, user_path):
+    key = _user_key(user_path)
+    r2.put_object(Bucket="rw-test", Key=key, Body=storage.json_dumps({"profile": {"nickname": "old"}, "history": []}))
+    assert storage.load_data(user_path)["profile"]["nickname"] == "old"
+
+
+def test_zstd_without_zstandard_falls_back_to_gzip(monkeypatch):
+    monkeypatch.setattr(storage, "R2_COMPRESSION", "zstd")
+    monkeypatch.setattr(storage, "_zstd", None)
+    raw = storage.json_dumps({"k": "v" * 4096})
+    body, enc = storage._r2_encode_body(raw)
+    assert enc == "gzip" and storage._r2_decode_body(body) == raw
+    with pytest.raises(RuntimeError):
+        storage._r2_decode_body(b"\x28\xb5\x2f\xfd" + b"\x00" * 8)
+
+
+def test_zstd_round_trip(monkeypatch):
+    zstd = pytest.importorskip("zstandard")
+    monkeypatch.setattr(storage, "R2_COMPRESSION", "zstd")
+    monkeypatch.setattr(storage, "_zstd", zstd)
+    raw = storage.json_dumps({"k": "v" * 4096})
+    body, enc = storage._r2_encode_body(raw)
+    assert enc == "zstd" and body[:4] == b"\x28\xb5\x2f\xfd"
+    assert storage._r2_decode_body(body) == raw
+
+
+def test_corrupt_gzip_reads_as_missing(r2):
+    r2.put_object(Bucket="rw-test", Key="misc/x.json", Body=b"\x1f\x8b\x08\x00broken")
+    assert storage._r2_get_object("misc/x.json") == (None, None, None)
@@ -0,0 +1,202 @@
+import json
+import os
+
+import pytest
+
+import route_assets
+
+
+def _write_route(path, n=40, step=0.5):
+    nodes = [{"lon": 118.7 + 0.01 * i, "lat": 32.0 - 0.003 * i, "dist_km": step * i} for i in range(n)]
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"total_km": step * (n - 1), "spacing_km": step, "nodes": nodes}, f)
+    return nodes
+
+
+def test_asset_round_trip(tmp_path):
+    json_path = str(tmp_path / "nodes_0p5km.json")
+    nodes = _write_route(json_path)
+
+    bin_path = route_assets.compile_route_asset(json_path)
+    assert bin_path == str(tmp_path / "nodes_0p5km.bin")
+    g = route_assets.open_route_asset(bin_path)
+
+    assert len(g) == len(nodes)
+    assert g.total_km == 19.5
+    assert g.step_km == 0.5
+    for i, p in enumerate(nodes):
+        assert (g.lon[i], g.lat[i], g.cum_km[i]) == (p["lon"], p["lat"], p["dist_km"])
+    assert g.locate(1.25) == route_assets.load_route_geometry(json_path, compile_missing=False).locate(1.25)
+
+
+def test_truncated_asset_raises(tmp_path):
+    json_path = str(tmp_path / "route_with_dist.json")
+    _write_route(json_path)
+    bin_path = route_assets.compile_route_asset(json_path)
+    with open(bin_path, "rb") as f:
+        raw = f.read()
+
+    with open(bin_path, "wb") as f:
+        f.write(raw[:-8])
+    with pytest.raises(ValueError):
+        route_assets.open_route_asset(bin_path)
+
+    with open(bin_path, "wb") as f:
+        f.write(b"XXXX" + raw[4:])
+    with pytest.raises(ValueError):
+        route_assets.open_route_asset(bin_path)
+
+
+def test_load_recompiles_stale_or_broken_asset(tmp_path):
+    json_path = str(tmp_path / "nodes_0p5km.json")
+    _write_route(json_path, n=10)
+    bin_path = route_assets.asset_path(json_path)
+    assert len(route_assets.load_route_geometry(json_path)) == 10
+    assert os.path.exists(bin_path)
+
+    # a newer JSON wins over the compiled asset, which is rebuilt from it
+    _write_route(json_path, n=12)
+    st = os.stat(bin_path)
+    os.utime(json_path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    assert len(route_assets.load_route_geometry(json_path)) == 12
+    assert len(route_assets.open_route_asset(bin_path)) == 12
+
+    with open(bin_path, "wb") as f:
+        f.write(b"RWRT")
+    assert len(route_assets.load_route_geometry(json_path, compile_missing=False)) == 12
+
+
+def test_shipped_assets_match_json():
+    root = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "routes")
+    checked = 0
+    for rid in sorted(os.listdir(root)):
+        json_path = os.path.join(root, rid, "nodes_0p5km.json")
+        bin_path = route_assets.asset_path(json_path)
+        if not (os.path.exists(json_path) and os.path.exists(bin_path)):
+            continue
+        lon, lat, cum, total_km, _ = route_assets._read_json_points(json_path)
+        g = route_assets.open_route_asset(bin_path)
+        assert (list(g.lon), list(g.lat), list(g.cum_km), g.total_km) == (list(lon), list(lat), list(cum), total_km)
+        checked += 1
+    assert checked > 0
+
+
+def _route_dir(routes_dir, rid, name, n=10):
+    route_dir = routes_dir / rid
+    route_dir.mkdir(parents=True, exist_ok=True)
+    (route_dir / "meta.json").write_text(json.dumps({"id": rid, "name": name, "node_spacing_km": 0.5}), encoding="utf-8")
+    _write_route(str(route_dir / "nodes_0p5km.json"), n=n)
+    return route_dir
+
+
+def _bump_mtime(path):
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+
+
+@pytest.fixture
+def routes_dir(tmp_path):
+    routes = tmp_path / "routes"
+    _route_dir(routes, "a", "Route A")
+    _route_dir(routes, "b", "Route B", n=6)
+    return routes
+
+
+def test_registry_reloads_only_changed_routes(routes_dir):
+    reg = route_assets.RouteRegistry(str(routes_dir), revalidate_s=0)
+    assert sorted(reg.metas()) == ["a", "b"]
+    a, b = reg.entry("a"), reg.entry("b")
+    assert reg.total_km("a") == 4.5
+
+    (routes_dir / "a" / "meta.json").write_text(json.dumps({"id": "a", "name": "Renamed", "node_spacing_km": 0.5}), encoding="utf-8")
+    _bump_mtime(routes_dir / "a" / "meta.json")
+    assert reg.metas()["a"]["name"] == "Renamed"
+    assert reg.entry("a") is not a
+    assert reg.entry("b") is b
+
+    _write_route(str(routes_dir / "b" / "nodes_0p5km.json"), n=8)
+    _bump_mtime(routes_dir / "b" / "nodes_0p5km.json")
+    assert reg.total_km("b") == 3.5
+    assert reg.entry("b") is not b
+
+
+def test_registry_revalidation_is_throttled(routes_dir):
+    reg = route_assets.RouteRegistry(str(routes_dir), revalidate_s=3600)
+    _route_dir(routes_dir, "c", "Route C")
+    assert "c" not in reg
+    reg.refresh(force=True)
+    assert "c" in reg
+
+    (routes_dir / "c" / "meta.json").unlink()
+    reg.refresh(force=True)
+    assert "c" not in reg.metas()
+
+
+def test_registry_derived_is_memoized_per_version(routes_dir):
+    reg = route_assets.RouteRegistry(str(routes_dir), revalidate_s=0)
+    calls = []
+
+    def stops(entry):
+        calls.append(entry.id)
+        return [entry.meta["name"]]
+
+    first = reg.derived("a", "stops", stops)
+    assert reg.derived("a", "stops", stops) is first
+    assert calls == ["a"]
+    assert reg.metas()["a"] is reg.entry("a").meta
+    with pytest.raises(TypeError):
+        reg.metas()["a"]["name"] = "x"
+
+    _bump_mtime(routes_dir / "a" / "meta.json")
+    assert reg.derived("a", "stops", stops) == first
+    assert calls == ["a", "a"]
+    with pytest.raises(KeyError):
+        reg.derived("missing", "stops", stops)
+
+
+def test_catalog_round_trip(routes_dir):
+    meta = json.loads((routes_dir / "a" / "meta.json").read_text(encoding="utf-8"))
+    meta["key_cities"] = [{"name": "start", "lat": 32.0, "lon": 118.7}, {"name": "end", "lat": 31.973, "lon": 118.79}, "nowhere"]
+    (routes_dir / "a" / "meta.json").write_text(json.dumps(meta), encoding="utf-8")
+
+    assert route_assets.load_route_catalog(str(routes_dir)) == {}
+    route_assets.write_route_catalog(str(routes_dir))
+    catalog = route_assets.load_route_catalog(str(routes_dir))
+
+    assert catalog == route_assets.build_route_catalog(str(routes_dir))["routes"]
+    rec = catalog["a"]
+    assert (rec["name"], rec["total_km"], rec["nodes"]) == ("Route A", 4.5, 10)
+    assert rec["key_cities"] == [{"name": "start", "km": 0.0}, {"name": "end", "km": 4.5}, {"name": "nowhere", "km": None}]
+    assert rec["bbox"] == [118.7, 31.973, 118.79, 32.0]
+    assert rec["nodes_bytes"] == os.path.getsize(routes_dir / "a" / "nodes_0p5km.json")
+
+
+def test_catalog_entry_trusted_only_while_current(routes_dir):
+    route_assets.write_route_catalog(str(routes_dir))
+    reg = route_assets.RouteRegistry(str(routes_dir), revalidate_s=0)
+    assert reg.catalog("a")["total_km"] == 4.5
+
+    # nodes rewritten after indexing: the size no longer matches -> totals from the geometry
+    _write_route(str(routes_dir / "a" / "nodes_0p5km.json"), n=14)
+    _bump_mtime(routes_dir / "a" / "nodes_0p5km.json")
+    assert reg.catalog("a") is None
+    assert reg.total_km("a") == 6.5
+
+    (routes_dir / "b" / "meta.json").write_text(json.dumps({"id": "b", "name": "B2", "node_spacing_km": 0.5}), encoding="utf-8")
+    _bump_mtime(routes_dir / "b" / "meta.json")
+    assert reg.catalog("b") is None
+
+    route_assets.write_route_catalog(str(routes_dir))
+    _bump_mtime(routes_dir / "index.json")
+    assert reg.catalog("a")["total_km"] == 6.5
+    assert reg.catalog("b")["name"] == "B2"
+
+
+def test_catalog_version_mismatch_is_ignored(routes_dir):
+    (routes_dir / "index.json").write_text(json.dumps({"version": 0, "routes": {"a": {}}}), encoding="utf-8")
+    assert route_assets.load_route_catalog(str(routes_dir)) == {}
+
+
+def test_committed_catalog_is_current():
+    root = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "routes")
+    assert route_assets.load_route_catalog(root) == route_assets.build_route_catalog(root)["routes"]
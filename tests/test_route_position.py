@@ -0,0 +1,141 @@
+import bisect
+import json
+import math
+import os
+import random
+from array import array
+
+import pytest
+
+import route_assets
+from route_assets import Position, RouteGeometry
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PRO_ROUTE = os.path.join(ROOT, "routes", "js_pro_nj_lyg", "route_with_dist.json")
+PRO_NODES = os.path.join(ROOT, "routes", "js_pro_nj_lyg", "nodes_0p5km.json")
+
+
+def _geometry(cum, lon=None, lat=None):
+    lon = lon if lon is not None else [100.0 + c for c in cum]
+    lat = lat if lat is not None else [30.0 - 2 * c for c in cum]
+    return RouteGeometry(array("d", lon), array("d", lat), array("d", cum), cum[-1], 0.5)
+
+
+def _scan(g, km):
+    """Reference: linear scan for the segment, then interpolate."""
+    end = g.cum_km[len(g) - 1]
+    km = max(0.0, min(km, end))
+    seg = 0
+    for i in range(len(g) - 1):
+        if g.cum_km[i] <= km:
+            seg = i
+    c0, c1 = g.cum_km[seg], g.cum_km[seg + 1]
+    t = (km - c0) / (c1 - c0) if c1 > c0 else 0.0
+    lon = g.lon[seg] + (g.lon[seg + 1] - g.lon[seg]) * t
+    lat = g.lat[seg] + (g.lat[seg + 1] - g.lat[seg]) * t
+    return km, lon, lat, t
+
+
+# irregular spacing, including a zero-length segment (duplicate vertex)
+IRREGULAR = [0.0, 0.1, 0.9, 0.9, 2.5, 2.6, 4.0]
+
+
+@pytest.mark.parametrize("km", [0.0, 0.05, 0.1, 0.5, 0.9, 1.0, 2.55, 3.999, 4.0])
+def test_locate_interpolates_on_irregular_spacing(km):
+    g = _geometry(IRREGULAR)
+    pos = g.locate(km)
+    assert g.cum_km[pos.seg] <= pos.km <= g.cum_km[pos.seg + 1]
+    ref_km, lon, lat, _ = _scan(g, km)
+    assert (pos.km, pos.lon, pos.lat) == pytest.approx((ref_km, lon, lat))
+    assert pos.progress == pytest.approx(km / 4.0)
+
+
+def test_locate_clamps_and_handles_ends():
+    g = _geometry(IRREGULAR)
+    assert g.locate(-3) == Position(0.0, 100.0, 30.0, 0, 0.0, 0.0)
+    end = g.locate(99)
+    assert (end.km, end.seg, end.t, end.progress) == (4.0, len(g) - 2, 1.0, 1.0)
+
+    single = _geometry([0.0])
+    assert single.locate(5) == Position(0.0, 100.0, 30.0, 0, 0.0, 0.0)
+    with pytest.raises(ValueError):
+        RouteGeometry(array("d"), array("d"), array("d"), 0.0, 0.5).locate(1)
+
+
+def test_locate_many_matches_locate_in_input_order():
+    g = _geometry(IRREGULAR)
+    kms = [3.2, -1, 0.9, 4.5, 0.0, 2.5, 1.7, 0.9]
+    assert g.locate_many(kms) == [g.locate(k) for k in kms]
+
+
+def test_real_route_against_reference_and_old_step_index():
+    g = route_assets.load_route_geometry(PRO_ROUTE, compile_missing=False)
+    with open(PRO_NODES, "r", encoding="utf-8") as f:
+        nodes = json.load(f)
+    rng = random.Random(1)
+    kms = [rng.uniform(0, g.total_km) for _ in range(200)]
+
+    for km, pos in zip(kms, g.locate_many(kms)):
+        assert (pos.km, pos.lon, pos.lat) == pytest.approx(_scan(g, km)[:3])
+
+    # the old app index int(km / step_km) into the 0.5 km node list: nodes are existing
+    # route vertices with irregular spacing, so it often picks a node that does not
+    # bracket km, while a bisect on cum_km always does
+    pts = nodes["nodes"]
+    cum = [float(p["cum_km"]) for p in pts]
+    old = [min(int(km / 0.5), len(pts) - 1) for km in kms]
+    new = [bisect.bisect_right(cum, km) - 1 for km in kms]
+    assert all(cum[i] <= km < cum[i + 1] for i, km in zip(new, kms))
+    assert sum(o != i for o, i in zip(old, new)) > len(kms) // 10
+
+
+def test_paths_end_exactly_at_positions():
+    g = _geometry(IRREGULAR)
+    a, b = g.locate(0.5), g.locate(2.55)
+
+    to_a = g.path_to(a)
+    assert to_a[0] == [100.0, 30.0] and to_a[-1] == [a.lon, a.lat]
+    from_b = g.path_from(b)
+    assert from_b[0] == [b.lon, b.lat] and from_b[-1] == [g.lon[-1], g.lat[-1]]
+    between = g.path_between(a, b)
+    assert between[0] == [a.lon, a.lat] and between[-1] == [b.lon, b.lat]
+    assert between[1:-1] == g.coords(a.seg + 1, b.seg + 1)
+    assert g.path_between(b, a) == []
+
+    # on a vertex no duplicate point is added
+    v = g.locate(0.1)
+    assert v.t == 0.0 and g.path_to(v) == g.coords(0, 2)
+    assert g.path_from(g.locate(4.0)) == [[g.lon[-1], g.lat[-1]]]
+
+
+def _assert_batch_matches(batch, positions):
+    for field in Position._fields:
+        col = [float(x) for x in getattr(batch, field)]
+        assert col == pytest.approx([float(getattr(p, field)) for p in positions]), field
+
+
+def test_locate_batch_python_fallback():
+    g = _geometry(IRREGULAR)
+    kms = [3.2, -1, 0.9, 4.5, 0.0, 2.5, 1.7]
+    batch = g.locate_batch(kms, use_numpy=False)
+    assert isinstance(batch.km, array) and batch.seg.typecode == "q"
+    _assert_batch_matches(batch, g.locate_many(kms))
+
+
+def test_locate_batch_numpy_matches_locate_many():
+    np = pytest.importorskip("numpy")
+    g = route_assets.load_route_geometry(PRO_ROUTE, compile_missing=False)
+    rng = random.Random(2)
+    kms = [rng.uniform(-10, g.total_km + 10) for _ in range(500)] + [0.0, g.total_km]
+    batch = g.locate_batch(np.asarray(kms), use_numpy=True)
+    _assert_batch_matches(batch, g.locate_many(kms))
+
+    single = _geometry([0.0]).locate_batch([1.0, 2.0], use_numpy=True)
+    assert list(single.seg) == [0, 0] and list(single.lon) == [100.0, 100.0]
+
+
+def test_locate_batch_numpy_required(monkeypatch):
+    monkeypatch.setattr(route_assets, "_np", None)
+    with pytest.raises(RuntimeError):
+        _geometry(IRREGULAR).locate_batch([1.0], use_numpy=True)
+    assert math.isclose(_geometry(IRREGULAR).locate_batch([1.0]).km[0], 1.0)
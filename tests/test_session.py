@@ -0,0 +1,47 @@
+import storage
+
+
+def test_untouched_session_does_not_write(backend, user_path):
+    storage.load_data(user_path)
+    s = storage.UserDataSession(user_path)
+    assert s.is_dirty is False  # nothing loaded yet
+    s.data
+    assert s.is_dirty is False
+    assert s.flush() is False
+
+
+def test_rederived_identical_state_is_not_dirty(backend, user_path):
+    storage.load_data(user_path)
+    s = storage.UserDataSession(user_path)
+    storage.ensure_profile_v3(s.data)
+    assert s.is_dirty is False
+
+
+def test_history_mutation_is_flushed_once(backend, user_path):
+    storage.load_data(user_path)
+    s = storage.UserDataSession(user_path)
+    s.data["profile"]["current_route_id"] = "js_free_nj_zj"
+    storage.add_run_km(s.data, km=5.0, run_date="2024-01-01")
+    assert s.is_dirty is True
+    assert s.flush() is True
+    assert s.is_dirty is False
+    assert s.flush() is False
+    assert storage.route_km(storage.load_data(user_path), "js_free_nj_zj") == 5.0
+
+
+def test_direct_profile_edit_is_caught_by_fingerprint(backend, user_path):
+    storage.load_data(user_path)
+    s = storage.UserDataSession(user_path)
+    s.data["profile"]["nickname"] = "runner"
+    assert s.is_dirty is True
+    assert s.flush() is True
+    assert storage.load_data(user_path)["profile"]["nickname"] == "runner"
+
+
+def test_mark_dirty_forces_write(backend, user_path):
+    storage.load_data(user_path)
+    s = storage.UserDataSession(user_path)
+    s.data
+    s.mark_dirty()
+    assert s.flush() is True
+    assert s.flush() is False
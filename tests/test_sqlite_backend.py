@@ -0,0 +1,69 @@
+import os
+
+import storage
+
+
+def _add(path, run_date, km, route_id):
+    data = storage.load_data(path)
+    data["profile"]["current_route_id"] = route_id
+    storage.add_run_km(data, km=km, run_date=run_date)
+    storage.save_data(path, data)
+
+
+def test_document_lives_in_sqlite_db(backend, user_path, tmp_path):
+    backend("sqlite")
+    data = storage.load_data(user_path)
+    data["profile"]["nickname"] = "runner"
+    storage.save_data(user_path, data)
+
+    assert not os.path.exists(user_path)
+    assert os.path.exists(tmp_path / "runningworld.sqlite3")
+    assert storage.load_data(user_path)["profile"]["nickname"] == "runner"
+
+
+def test_sqlite_path_override(backend, user_path, tmp_path, monkeypatch):
+    backend("sqlite")
+    db = tmp_path / "other" / "rw.db"
+    db.parent.mkdir()
+    monkeypatch.setenv("RW_SQLITE_PATH", str(db))
+    storage.load_data(user_path)
+    assert os.path.exists(db)
+
+
+def test_ops_are_mirrored_into_history_rows(backend, user_path):
+    backend("sqlite")
+    _add(user_path, "2024-01-01", 5.0, "js_free_nj_zj")
+    _add(user_path, "2024-01-01", 2.5, "js_free_nj_zj")  # merge into the same day
+    _add(user_path, "2024-01-02", 3.0, "js_free_nj_cz")
+
+    data = storage.load_data(user_path)
+    assert storage.route_history(data, "js_free_nj_zj") == [
+        {"date": "2024-01-01", "km": 7.5, "route_id": "js_free_nj_zj", "note": ""}
+    ]
+    assert storage.verify_aggregates(data) == []
+    assert storage.route_km_totals(user_path) == {"js_free_nj_zj": 7.5, "js_free_nj_cz": 3.0}
+
+    storage.undo_run_km(data, 7.5, "js_free_nj_zj", run_date="2024-01-01")
+    storage.save_data(user_path, data)
+    assert storage.route_km_totals(user_path) == {"js_free_nj_cz": 3.0}
+
+
+def test_broadcast_records_count_for_every_route(backend, user_path):
+    backend("sqlite")
+    data = storage.load_data(user_path)
+    storage.add_daily_km(data, 4.0, ["js_free_nj_zj", "js_free_nj_cz"], run_date="2024-01-01")
+    storage.save_data(user_path, data)
+
+    assert storage.route_km_totals(user_path) == {"js_free_nj_zj": 4.0, "js_free_nj_cz": 4.0}
+    data = storage.load_data(user_path)
+    assert storage.route_has_run(data, "js_free_nj_cz", "2024-01-01")
+    assert storage.verify_aggregates(data) == []
+
+
+def test_users_are_isolated(backend, tmp_path):
+    backend("sqlite")
+    a, b = str(tmp_path / "run_data_a.json"), str(tmp_path / "run_data_b.json")
+    _add(a, "2024-01-01", 5.0, "js_free_nj_zj")
+    storage.load_data(b)
+    assert storage.route_km_totals(b) == {}
+    assert storage.route_km_totals(a) == {"js_free_nj_zj": 5.0}
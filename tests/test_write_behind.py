@@ -0,0 +1,98 @@
+import threading
+
+import pytest
+
+import storage
+
+
+@pytest.fixture
+def wb(backend, monkeypatch):
+    """
+    Write-behind on, with a spy on the real writes. Yields the list of (path, ops) written.
+    """
+    monkeypatch.setattr(storage, "_WRITE_BEHIND", True)
+    monkeypatch.setattr(storage, "WRITE_BEHIND_DELAY_S", 0.2)
+    writes = []
+    real = storage._save_data_now
+
+    def spy(path, data, ops):
+        writes.append((path, [op["op"] for op in ops]))
+        real(path, data, ops)
+
+    monkeypatch.setattr(storage, "_save_data_now", spy)
+    yield writes
+    try:
+        storage.flush_pending_writes(None, 5.0)
+    except Exception:
+        pass
+
+
+def _stored_km(path):
+    with open(path, "rb") as f:
+        doc = storage.json_loads(f.read())
+    return [h["km"] for h in doc["history"]]
+
+
+def test_saves_coalesce_into_one_write(wb, user_path):
+    storage.atomic_write_json(user_path, storage._persistable(storage._new_document()))  # existing user
+
+    data = storage.load_data(user_path)
+    for day in (1, 2, 3):
+        storage.add_run_km(data, km=float(day), run_date=f"2024-01-0{day}")
+        storage.save_data(user_path, data)
+
+    # read-your-writes before anything is on disk
+    assert _stored_km(user_path) == []
+    pending = storage.load_data(user_path)
+    assert [h["km"] for h in storage._as_history(pending).to_list()] == [1.0, 2.0, 3.0]
+
+    storage.flush_pending_writes(user_path, 5.0)
+    assert wb == [(user_path, ["add", "add", "add"])]
+    assert _stored_km(user_path) == [1.0, 2.0, 3.0]
+
+
+def test_conflict_is_raised_at_the_flush_barrier(wb, user_path, monkeypatch):
+    def lose(path, data, ops):
+        raise storage.StorageConflictError("changed")
+
+    monkeypatch.setattr(storage, "_save_data_now", lose)
+    storage.save_data(user_path, storage._new_document())
+    with pytest.raises(storage.StorageConflictError):
+        storage.flush_pending_writes(user_path, 5.0)
+    storage.flush_pending_writes(user_path, 5.0)  # reported once
+
+
+def test_transient_errors_are_retried(wb, user_path, monkeypatch):
+    monkeypatch.setattr(storage, "WRITE_BEHIND_DELAY_S", 0.01)
+    real = storage._save_data_now
+    attempts = []
+
+    def flaky(path, data, ops):
+        attempts.append(path)
+        if len(attempts) == 1:
+            raise OSError("disk hiccup")
+        real(path, data, ops)
+
+    monkeypatch.setattr(storage, "_save_data_now", flaky)
+    data = storage._new_document()
+    data["profile"]["nickname"] = "retry"
+    storage.save_data(user_path, data)
+    storage.flush_pending_writes(user_path, 5.0)
+    assert len(attempts) == 2
+    assert storage.load_data(user_path)["profile"]["nickname"] == "retry"
+
+
+def test_flush_times_out_while_a_write_is_stuck(wb, user_path, monkeypatch):
+    release = threading.Event()
+    real = storage._save_data_now
+
+    def slow(path, data, ops):
+        release.wait(5.0)
+        real(path, data, ops)
+
+    monkeypatch.setattr(storage, "_save_data_now", slow)
+    storage.save_data(user_path, storage._new_document())
+    with pytest.raises(TimeoutError):
+        storage.flush_pending_writes(user_path, 0.3)
+    release.set()
+    storage.flush_pending_writes(user_path, 5.0)
@@ -0,0 +1,75 @@
+# tools/bench_codec.py
+"""
+JSON codec benchmark on synthetic user documents: stdlib indent=2 (old on-disk format),
+stdlib compact, and orjson compact (when installed). Reports encode/decode time and size.
+
+  pip install orjson   # optional
+  python tools/bench_codec.py [SIZES] [REPEAT]      e.g. 1000,10000,100000 5
+"""
+import json
+import os
+import statistics
+import sys
+import time
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import storage  # noqa: E402
+
+ROUTES = ["js_free_nj_zj", "js_free_sz_wx", "pro_nj_sh", "pro_sh_hz"]
+
+
+def sample_doc(n_history: int) -> dict:
+    doc = storage._deepcopy_default()
+    start = date(2000, 1, 1)
+    doc["history"] = [
+        {"date": (start + timedelta(days=i // 3)).isoformat(), "km": round(3.0 + (i % 17) * 0.37, 3),
+         "route_id": ROUTES[i % len(ROUTES)], "note": "晨跑" if i % 5 == 0 else ""}
+        for i in range(n_history)
+    ]
+    return doc
+
+
+def timed(fn, n: int) -> list:
+    out = []
+    for _ in range(n):
+        t0 = time.perf_counter()
+        fn()
+        out.append((time.perf_counter() - t0) * 1000.0)
+    return out
+
+
+def report(label: str, ms: list, size: int) -> None:
+    print(f"  {label:<28} mean {statistics.mean(ms):9.2f} ms | p50 {statistics.median(ms):9.2f} ms | {size:>11} bytes")
+
+
+def codecs() -> list:
+    out = [
+        ("stdlib indent=2", lambda d: json.dumps(d, ensure_ascii=False, indent=2).encode("utf-8"),
+         lambda b: json.loads(b.decode("utf-8"))),
+        ("stdlib compact", lambda d: json.dumps(d, ensure_ascii=False, separators=(",", ":")).encode("utf-8"),
+         lambda b: json.loads(b.decode("utf-8"))),
+    ]
+    if storage._orjson is not None:
+        out.append(("orjson compact", lambda d: storage.json_dumps(d, pretty=False), storage.json_loads))
+    else:
+        print("orjson not installed: skipping orjson rows")
+    return out
+
+
+def main():
+    sizes = [int(x) for x in (sys.argv[1] if len(sys.argv) > 1 else "1000,10000,100000").split(",")]
+    n = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+    for n_history in sizes:
+        doc = sample_doc(n_history)
+        print(f"history={n_history} n={n}")
+        for label, dumps, loads in codecs():
+            body = dumps(doc)
+            report(f"dumps {label}", timed(lambda: dumps(doc), n), len(body))
+            report(f"loads {label}", timed(lambda: loads(body), n), len(body))
+
+
+if __name__ == "__main__":
+    main()
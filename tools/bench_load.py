@@ -0,0 +1,86 @@
+# tools/bench_load.py
+"""
+load_data micro-benchmark for documents already at the current schema version:
+fast path vs the full merge/migrate/heal pass, plus the default-document copy.
+
+Every case gets its own warm-up pass (WARMUP calls, untimed) after a gc.collect(), so
+the first case does not pay for cold caches and the patched full-heal path is warmed
+separately. Compare the p50 column; mean and p95 show the noise.
+
+  python tools/bench_load.py [N_HISTORY] [REPEAT] [WARMUP]
+"""
+import gc
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import storage  # noqa: E402
+
+
+WARMUP = 5
+
+
+def timed(fn, n: int) -> list:
+    for _ in range(WARMUP):
+        fn()
+    gc.collect()
+    out = []
+    for _ in range(n):
+        t0 = time.perf_counter()
+        fn()
+        out.append((time.perf_counter() - t0) * 1000.0)
+    return out
+
+
+def report(label: str, ms: list) -> None:
+    ms = sorted(ms)
+    p95 = ms[int(len(ms) * 0.95) - 1] if len(ms) >= 20 else ms[-1]
+    print(f"{label:<34} p50 {statistics.median(ms):8.3f} ms | mean {statistics.mean(ms):8.3f} ms | p95 {p95:8.3f} ms")
+
+
+def current_doc(n_history: int) -> dict:
+    data = storage._new_document()
+    start = date(2020, 1, 1)
+    for i in range(n_history):
+        data["profile"]["current_route_id"] = "js_free_nj_zj"
+        storage.add_run_km(data, km=5.0, run_date=(start + timedelta(days=i)).isoformat())
+    return storage._persistable(data)
+
+
+def main():
+    global WARMUP
+    n_history = int(sys.argv[1]) if len(sys.argv) > 1 else 3650
+    n = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    WARMUP = int(sys.argv[3]) if len(sys.argv) > 3 else WARMUP
+
+    doc = current_doc(n_history)
+    raw = json.dumps(doc, ensure_ascii=False)
+    print(f"schema v{storage.CURRENT_SCHEMA_VERSION} doc: history={n_history} json={len(raw)} bytes n={n} warmup={WARMUP}")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "run_data.json")
+        storage.atomic_write_json(path, doc)
+        report("load_data (fast path)", timed(lambda: storage.load_data(path), n))
+
+        report("heal: fast path", timed(lambda: storage._heal_document(storage.json_loads(raw)), n))
+        is_current = storage._is_current_document
+        storage._is_current_document = lambda data: False
+        try:
+            report("heal: full merge/migrate/heal", timed(lambda: storage._heal_document(storage.json_loads(raw)), n))
+            report("load_data (full heal)", timed(lambda: storage.load_data(path), n))
+        finally:
+            storage._is_current_document = is_current
+        report("json_loads only (baseline)", timed(lambda: storage.json_loads(raw), n))
+
+    report("default doc: json round-trip", timed(lambda: json.loads(json.dumps(storage.DEFAULT_DATA)), n * 20))
+    report("default doc: deepcopy", timed(storage._deepcopy_default, n * 20))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+# tools/bench_locate.py
+"""
+Batch locate benchmark on a route's full-resolution geometry (default: the 7k-point
+js_pro_nj_lyg loop): per-call locate() loop vs locate_many() vs locate_batch() with the
+pure-Python fallback and with numpy (when installed).
+
+  pip install numpy   # optional
+  python tools/bench_locate.py [ROUTE_JSON] [QUERIES] [REPEAT]      e.g. ... 1000,100000 5
+"""
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import route_assets  # noqa: E402
+
+ROUTE_PATH = os.path.join("routes", "js_pro_nj_lyg", "route_with_dist.json")
+
+
+def timed(fn, n: int) -> list:
+    out = []
+    for _ in range(n):
+        t0 = time.perf_counter()
+        fn()
+        out.append((time.perf_counter() - t0) * 1000.0)
+    return out
+
+
+def report(label: str, ms: list, queries: int) -> None:
+    mean = statistics.mean(ms)
+    print(f"  {label:<26} mean {mean:9.2f} ms | p50 {statistics.median(ms):9.2f} ms | {mean * 1000.0 / queries:7.3f} us/query")
+
+
+def main():
+    path = sys.argv[1] if len(sys.argv) > 1 else ROUTE_PATH
+    sizes = [int(x) for x in (sys.argv[2] if len(sys.argv) > 2 else "1000,100000").split(",")]
+    n = int(sys.argv[3]) if len(sys.argv) > 3 else 5
+
+    g = route_assets.load_route_geometry(path)
+    print(f"{path}: {len(g)} points, {g.total_km:.1f} km")
+    rng = random.Random(42)
+    for queries in sizes:
+        kms = [rng.uniform(0.0, g.total_km) for _ in range(queries)]
+        print(f"queries={queries} n={n}")
+        report("locate() loop", timed(lambda: [g.locate(k) for k in kms], n), queries)
+        report("locate_many()", timed(lambda: g.locate_many(kms), n), queries)
+        report("locate_batch() python", timed(lambda: g.locate_batch(kms, use_numpy=False), n), queries)
+        if route_assets._np is not None:
+            arr = route_assets._np.asarray(kms)
+            report("locate_batch() numpy", timed(lambda: g.locate_batch(arr, use_numpy=True), n), queries)
+        else:
+            print("  numpy not installed: skipping numpy row")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+# tools/bench_r2.py
+"""
+R2 (S3-compatible) latency benchmark against a local S3 stand-in.
+
+  pip install "moto[server]" boto3
+  moto_server -p 5000 &
+  R2_ENDPOINT=http://127.0.0.1:5000 R2_ACCESS_KEY_ID=test R2_SECRET_ACCESS_KEY=test \\
+  R2_BUCKET=rw-bench python tools/bench_r2.py [N]
+"""
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import storage  # noqa: E402
+
+KEY = "users/u_bench/run_data.json"
+
+
+def sample_doc(n_history: int = 365) -> dict:
+    doc = json.loads(json.dumps(storage.DEFAULT_DATA))
+    doc["history"] = [
+        {"date": f"2024-{1 + i // 28 % 12:02d}-{1 + i % 28:02d}", "km": 5.0, "route_id": "js_free_nj_zj", "note": ""}
+        for i in range(n_history)
+    ]
+    return doc
+
+
+def timed(fn, n: int) -> list:
+    out = []
+    for _ in range(n):
+        t0 = time.perf_counter()
+        fn()
+        out.append((time.perf_counter() - t0) * 1000.0)
+    return out
+
+
+def report(label: str, ms: list) -> None:
+    ms = sorted(ms)
+    p95 = ms[int(len(ms) * 0.95) - 1] if len(ms) >= 20 else ms[-1]
+    print(f"{label:<28} mean {statistics.mean(ms):7.2f} ms | p50 {statistics.median(ms):7.2f} ms | p95 {p95:7.2f} ms")
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    bucket = storage._r2_bucket()
+    body = json.dumps(sample_doc(), ensure_ascii=False, indent=2).encode("utf-8")
+    packed, encoding = storage._r2_encode_body(storage.json_dumps(sample_doc()))
+
+    s3 = storage._r2_client()
+    try:
+        s3.create_bucket(Bucket=bucket)
+    except Exception:
+        pass
+    s3.put_object(Bucket=bucket, Key=KEY, Body=body)
+
+    def get_fresh():
+        storage._r2_new_client().get_object(Bucket=bucket, Key=KEY)["Body"].read()
+
+    def get_pooled():
+        storage._r2_client().get_object(Bucket=bucket, Key=KEY)["Body"].read()
+
+    def get_packed():
+        storage._r2_decode_body(storage._r2_client().get_object(Bucket=bucket, Key=KEY + ".packed")["Body"].read())
+
+    def put_fresh():
+        storage._r2_new_client().put_object(Bucket=bucket, Key=KEY, Body=body)
+
+    def put_pooled():
+        storage._r2_client().put_object(Bucket=bucket, Key=KEY, Body=body)
+
+    s3.put_object(Bucket=bucket, Key=KEY + ".packed", Body=packed)
+    print(f"endpoint={os.getenv('R2_ENDPOINT')} bucket={bucket} body={len(body)} bytes "
+          f"{encoding or 'plain'}={len(packed)} bytes n={n}")
+    report("GET  new client per call", timed(get_fresh, n))
+    report("GET  pooled client", timed(get_pooled, n))
+    report(f"GET  pooled, {encoding or 'plain'} body", timed(get_packed, n))
+    report("PUT  new client per call", timed(put_fresh, n))
+    report("PUT  pooled client", timed(put_pooled, n))
+
+
+if __name__ == "__main__":
+    main()
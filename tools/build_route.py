@@ -1,7 +1,11 @@
 # tools/build_route.py
-import json, os, math, requests
+import json, os, math, requests, sys
 from typing import List, Tuple
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import route_assets  # noqa: E402
+
 def haversine_km(a: Tuple[float,float], b: Tuple[float,float]) -> float:
     # a,b = (lat, lon)
     R = 6371.0
@@ -59,7 +63,6 @@ def sample_nodes(points: List[dict], spacing_km: float) -> dict:
     return {"spacing_km": spacing_km, "nodes": nodes, "total_km": points[-1]["cum_km"]}
 
 def main():
-    import sys
     rid = sys.argv[1] if len(sys.argv) > 1 else None
     if not rid:
         print("Usage: python tools/build_route.py <route_id>")
@@ -98,6 +101,13 @@ def main():
     with open(os.path.join(route_dir, f"nodes_{str(spacing).replace('.','p')}km.json"), "w", encoding="utf-8") as f:
         json.dump(nodes, f, ensure_ascii=False, indent=2)
 
+    # 4) binary assets (mmap) for the app: route_with_dist.bin / nodes_*.bin
+    from compile_routes import compile_route_dir
+    compile_route_dir(route_dir)
+
+    # 5) routes/index.json：picker 用的路线目录（总里程 / 城市里程 / bbox）
+    route_assets.write_route_catalog(routes_dir)
+
     print(f"✅ Built route {rid}: total {with_dist['total_km']} km, nodes {len(nodes['nodes'])}")
 
 if __name__ == "__main__":
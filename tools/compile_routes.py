@@ -0,0 +1,47 @@
+# tools/compile_routes.py
+"""
+Compile every route's route_with_dist.json and nodes_*km.json into the mmap-able binary
+assets next to them (see route_assets.py), then regenerate the routes/index.json catalog
+the picker reads. Run after building/updating routes and as part of deploy; the app also
+compiles missing/stale assets on first use when it can write.
+
+  python tools/compile_routes.py [ROUTES_DIR] [ROUTE_ID ...]
+"""
+import glob
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import route_assets  # noqa: E402
+
+
+def compile_route_dir(route_dir: str) -> list:
+    out = []
+    sources = [os.path.join(route_dir, "route_with_dist.json")] + sorted(glob.glob(os.path.join(route_dir, "nodes_*km.json")))
+    for src in sources:
+        if os.path.isfile(src):
+            out.append(route_assets.compile_route_asset(src))
+    return out
+
+
+def main():
+    routes_dir = sys.argv[1] if len(sys.argv) > 1 else "routes"
+    only = set(sys.argv[2:])
+    t0 = time.perf_counter()
+    n = 0
+    for rid in sorted(os.listdir(routes_dir)):
+        route_dir = os.path.join(routes_dir, rid)
+        if not os.path.isdir(route_dir) or (only and rid not in only):
+            continue
+        for path in compile_route_dir(route_dir):
+            g = route_assets.open_route_asset(path)
+            print(f"  {path}: {len(g)} points, {g.total_km:.3f} km, {os.path.getsize(path)} bytes")
+            n += 1
+    index_path = route_assets.write_route_catalog(routes_dir)
+    print(f"✅ compiled {n} assets + {index_path} in {(time.perf_counter() - t0) * 1000:.0f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+# tools/export_history.py
+"""
+Export run history (CSV / JSON Lines / Parquet) for one user or every stored user on the
+active backend (RW_STORAGE_BACKEND=local|r2|sqlite, RW_STORAGE_DIR), streaming.
+
+  python tools/export_history.py [--user USER_ID] [--format csv|jsonl|parquet] [--out FILE]
+
+Without --out, csv/jsonl go to stdout.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import exporter  # noqa: E402
+import storage  # noqa: E402
+
+
+def usage():
+    print(
+        "Usage:\n"
+        "  python tools/export_history.py [--user USER_ID] [--format csv|jsonl|parquet] [--out FILE]\n"
+    )
+
+
+def main():
+    args = sys.argv[1:]
+    opts = {"--user": None, "--format": "csv", "--out": None}
+    while args:
+        flag = args.pop(0)
+        if flag not in opts or not args:
+            usage()
+            sys.exit(1)
+        opts[flag] = args.pop(0)
+
+    fmt = opts["--format"]
+    if fmt not in exporter.FORMATS:
+        usage()
+        sys.exit(1)
+    if fmt == "parquet" and not exporter.parquet_available():
+        print("❌ parquet needs pyarrow (pip install pyarrow)")
+        sys.exit(1)
+    if fmt == "parquet" and not opts["--out"]:
+        print("❌ parquet needs --out FILE")
+        sys.exit(1)
+
+    storage_dir = os.getenv("RW_STORAGE_DIR", "/tmp/runningworld")
+    if opts["--user"]:
+        path = os.path.join(storage_dir, f"run_data_{opts['--user']}.json")
+        data = storage.read_data(path)  # read-only: never creates / rewrites the document
+        if data is None:
+            print(f"❌ no stored data for user {opts['--user']}")
+            sys.exit(1)
+        rows = exporter.iter_rows(data, user_id=opts["--user"])
+    else:
+        rows = exporter.iter_all_rows(storage_dir)
+
+    counted = _count(rows)
+    if opts["--out"]:
+        with open(opts["--out"], "wb") as f:
+            exporter.export(counted, fmt, f)
+        print(f"✅ exported {counted.n} rows -> {opts['--out']}", file=sys.stderr)
+    else:
+        exporter.export(counted, fmt, sys.stdout.buffer)
+        sys.stdout.flush()
+        print(f"✅ exported {counted.n} rows", file=sys.stderr)
+
+
+class _count:
+    # pass-through iterator that counts rows for the summary line
+    def __init__(self, rows):
+        self.rows, self.n = rows, 0
+
+    def __iter__(self):
+        for row in self.rows:
+            self.n += 1
+            yield row
+
+
+if __name__ == "__main__":
+    main()
@@ -1,33 +1,51 @@
-import json
+"""
+Invite code admin on the live per-code store of the active backend
+(RW_STORAGE_BACKEND=local|r2|sqlite, RW_STORAGE_DIR), under the same lock as the app.
+
+  python tools/invite_admin.py gen <N>
+  python tools/invite_admin.py revoke <CODE>
+  python tools/invite_admin.py issue <CODE> <ISSUED_TO>
+  python tools/invite_admin.py export
+"""
 import os
 import sys
-import secrets
 from datetime import date
 
-INVITES_PATH = os.path.join("data", "invites.json")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import storage  # noqa: E402
+
+STORAGE_DIR = os.getenv("RW_STORAGE_DIR", "/tmp/runningworld")
+INVITES_PATH = os.path.join(STORAGE_DIR, "invites.json")
+INVITES_LOCK_PATH = INVITES_PATH + ".lock"
 PREFIX = "RW-ALPHA"
 CODE_LEN = 3  # 001, 002...
 
 
-def _load() -> dict:
-    if not os.path.exists(INVITES_PATH):
-        os.makedirs(os.path.dirname(INVITES_PATH), exist_ok=True)
-        with open(INVITES_PATH, "w", encoding="utf-8") as f:
-            json.dump({}, f, ensure_ascii=False, indent=2)
-        return {}
-    with open(INVITES_PATH, "r", encoding="utf-8") as f:
-        data = json.load(f)
-    return data if isinstance(data, dict) else {}
+def _store() -> storage.InviteStore:
+    store = storage.invite_store(INVITES_PATH)
+    # a legacy invites.json that the app has not imported yet must not be shadowed
+    with storage.FileLock(INVITES_LOCK_PATH, timeout_s=8.0):
+        storage.import_legacy_invites(INVITES_PATH, store)
+    return store
 
 
-def _save(data: dict) -> None:
-    with open(INVITES_PATH, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+def _iter_codes(store: storage.InviteStore, status=None, after=None):
+    while True:
+        page = store.page(status=status, after=after, limit=500)
+        if not page:
+            return
+        for code, rec in page:
+            yield code, rec
+        after = page[-1][0]
 
 
-def _next_index(existing_codes: list[str]) -> int:
+def _next_index(store: storage.InviteStore) -> int:
     mx = 0
-    for c in existing_codes:
+    # codes are listed in order, so only the PREFIX range is scanned
+    for c, _ in _iter_codes(store, after=PREFIX + "-"):
+        if not c.startswith(PREFIX + "-"):
+            break
         # RW-ALPHA-001
         parts = c.split("-")
         if len(parts) >= 3 and parts[-1].isdigit():
@@ -36,30 +54,27 @@ def _next_index(existing_codes: list[str]) -> int:
 
 
 def gen(n: int) -> None:
-    data = _load()
-    existing = set(data.keys())
-    idx = _next_index(list(existing))
-
-    created = []
-    for _ in range(n):
-        code = f"{PREFIX}-{idx:0{CODE_LEN}d}"
-        # 防撞（理论上不撞，但保底）
-        while code in existing:
-            idx += 1
+    store = _store()
+    with storage.FileLock(INVITES_LOCK_PATH, timeout_s=8.0):
+        idx = _next_index(store)
+        new = {}
+        for _ in range(n):
             code = f"{PREFIX}-{idx:0{CODE_LEN}d}"
+            # 防撞（理论上不撞，但保底）
+            while store.get(code) is not None:
+                idx += 1
+                code = f"{PREFIX}-{idx:0{CODE_LEN}d}"
+            new[code] = {
+                "status": "new",
+                "issued_to": "",
+                "issued_at": "",
+                "activated_at": ""
+            }
+            idx += 1
+        added = store.add_missing(new)
 
-        data[code] = {
-            "status": "new",
-            "issued_to": "",
-            "issued_at": "",
-            "activated_at": ""
-        }
-        existing.add(code)
-        created.append(code)
-        idx += 1
-
-    _save(data)
-    print(f"✅ generated {len(created)} codes")
+    created = sorted(new)
+    print(f"✅ generated {added} codes")
     for c in created[:20]:
         print(" ", c)
     if len(created) > 20:
@@ -67,39 +82,36 @@ def gen(n: int) -> None:
 
 
 def revoke(code: str) -> None:
-    data = _load()
-    rec = data.get(code)
-    if not isinstance(rec, dict):
+    store = _store()
+    with storage.FileLock(INVITES_LOCK_PATH, timeout_s=8.0):
+        rec = store.set_status(code, "revoked")
+    if rec is None:
         print("❌ code not found:", code)
         return
-    rec["status"] = "revoked"
-    data[code] = rec
-    _save(data)
     print("✅ revoked:", code)
 
 
 def issue(code: str, issued_to: str) -> None:
-    data = _load()
-    rec = data.get(code)
-    if not isinstance(rec, dict):
-        print("❌ code not found:", code)
-        return
-    if rec.get("status") != "new":
-        print("❌ code not new (cannot issue):", code, "status=", rec.get("status"))
-        return
-    rec["issued_to"] = issued_to
-    rec["issued_at"] = date.today().isoformat()
-    data[code] = rec
-    _save(data)
+    store = _store()
+    with storage.FileLock(INVITES_LOCK_PATH, timeout_s=8.0):
+        rec = store.get(code)
+        if rec is None:
+            print("❌ code not found:", code)
+            return
+        if rec.get("status") != "new":
+            print("❌ code not new (cannot issue):", code, "status=", rec.get("status"))
+            return
+        store.set_status(code, "new", issued_to=issued_to, issued_at=date.today().isoformat())
     print("✅ issued:", code, "to", issued_to)
 
 
 def export_new() -> None:
-    data = _load()
-    codes = [c for c, rec in data.items() if isinstance(rec, dict) and rec.get("status") == "new"]
-    codes.sort()
+    store = _store()
+    with storage.FileLock(INVITES_LOCK_PATH, timeout_s=2.0, shared=True):
+        codes = [c for c, _ in _iter_codes(store, status="new")]
+        counts = store.counts()
     print("\n".join(codes))
-    print(f"\n✅ total new: {len(codes)}")
+    print(f"\n✅ total new: {len(codes)}  ({', '.join(f'{k}={v}' for k, v in sorted(counts.items()))})")
 
 
 def usage():